@@ -76,6 +76,7 @@ WSGI_APPLICATION = 'backend.wsgi.application'
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:5173",  # React frontend URL
 ]
+CORS_EXPOSE_HEADERS = ['ETag']
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
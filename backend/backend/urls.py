@@ -16,8 +16,11 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from dataeng.views import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('dataeng.urls')),
+    # Scraped by Prometheus at the conventional path
+    path('metrics', metrics_view, name='metrics'),
 ]
\ No newline at end of file
@@ -0,0 +1,318 @@
+# aggregate_agent.py
+import os
+import re
+import json
+import logging
+import threading
+from collections import OrderedDict
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_google_genai import ChatGoogleGenerativeAI
+from pymongo.errors import PyMongoError
+from .transformation_agent import get_mongo_client, DATASET_VERSIONS_COLLECTION
+from .async_mongo import get_async_mongo_client
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Aggregate query settings
+AGGREGATE_MAX_STAGES = int(os.getenv("AGGREGATE_MAX_STAGES", "10"))
+AGGREGATE_MAX_RESULTS = int(os.getenv("AGGREGATE_MAX_RESULTS", "200"))
+AGGREGATE_TIMEOUT_MS = int(os.getenv("AGGREGATE_TIMEOUT_MS", "30000"))
+AGGREGATE_CACHE_SIZE = int(os.getenv("AGGREGATE_CACHE_SIZE", "512"))
+
+# Aggregate wording only; bare "per", "max" or "min" also occur in row lookups ("price per
+# unit of INV001", "5 min readings")
+GROUPINGS = r"(region|category|product|customer|location|day|week|month|quarter|year|hour)s?"
+ANALYTICAL_PATTERN = re.compile(
+    r"\b(total|sum of|average|avg|mean|median|how many|number of|count of|maximum|minimum|highest|lowest|"
+    rf"top \d+|bottom \d+|per {GROUPINGS}|group(ed)? by|by {GROUPINGS}|distribution|breakdown|trend)\b",
+    re.IGNORECASE
+)
+
+ALLOWED_STAGES = {
+    "$match", "$group", "$sort", "$limit", "$skip", "$project", "$addFields", "$set",
+    "$count", "$unwind", "$sortByCount", "$bucket",
+}
+ALLOWED_OPERATORS = {
+    # Query operators
+    "$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$nin", "$and", "$or", "$not", "$nor",
+    "$exists", "$regex", "$options", "$expr",
+    # Accumulators
+    "$sum", "$avg", "$min", "$max", "$first", "$last", "$push", "$addToSet", "$stdDevPop", "$stdDevSamp",
+    # Expressions
+    "$cond", "$ifNull", "$switch", "$add", "$subtract", "$multiply", "$divide", "$mod", "$abs", "$round",
+    "$floor", "$ceil", "$toDouble", "$toInt", "$toLong", "$toString", "$toDate", "$dateFromString",
+    "$dateToString", "$dateTrunc", "$year", "$month", "$week", "$dayOfMonth", "$dayOfWeek", "$hour",
+    "$substr", "$substrCP", "$toLower", "$toUpper", "$concat", "$size", "$literal",
+    # Operator arguments
+    "$branches", "$case", "$then", "$default", "$if", "$else", "$format", "$dateString", "$date", "$unit",
+    "$boundaries", "$output", "$groupBy", "$path",
+}
+ALLOWED_VARIABLES = {"$$ROOT", "$$CURRENT", "$$NOW"}
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+class PipelineValidationError(ValueError):
+    pass
+
+def is_analytical(query: str) -> bool:
+    """Whether a question asks for an aggregate rather than about individual rows."""
+    return bool(ANALYTICAL_PATTERN.search(query))
+
+def normalize_query(query: str) -> str:
+    return " ".join(re.findall(r"\w+", query.lower()))
+
+def _check_value(value, known_fields: set):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key.startswith("$") and key not in ALLOWED_OPERATORS:
+                raise PipelineValidationError(f"Operator {key} is not allowed")
+            _check_value(item, known_fields)
+    elif isinstance(value, list):
+        for item in value:
+            _check_value(item, known_fields)
+    elif isinstance(value, str) and value.startswith("$"):
+        if value.startswith("$$"):
+            if value.split(".")[0] not in ALLOWED_VARIABLES:
+                raise PipelineValidationError(f"Variable {value} is not allowed")
+        elif value[1:].split(".")[0] not in known_fields:
+            raise PipelineValidationError(f"Unknown field reference {value}")
+
+def validate_pipeline(pipeline, columns: list) -> list:
+    """
+    Checks an LLM-generated aggregation pipeline against the stage/operator whitelist and
+    the dataset's columns (plus fields created by earlier stages), and caps its output.
+    Returns the pipeline with a trailing $limit; raises PipelineValidationError otherwise.
+    """
+    if not isinstance(pipeline, list) or not pipeline:
+        raise PipelineValidationError("Pipeline must be a non-empty list")
+    if len(pipeline) > AGGREGATE_MAX_STAGES:
+        raise PipelineValidationError(f"Pipeline has more than {AGGREGATE_MAX_STAGES} stages")
+
+    known_fields = set(columns) | {"_id"}
+    for stage in pipeline:
+        if not isinstance(stage, dict) or len(stage) != 1:
+            raise PipelineValidationError(f"Invalid stage: {stage}")
+        name, spec = next(iter(stage.items()))
+        if name not in ALLOWED_STAGES:
+            raise PipelineValidationError(f"Stage {name} is not allowed")
+        if name == "$match" and isinstance(spec, dict):
+            # Top-level $match keys are field names rather than expressions
+            for key, item in spec.items():
+                if not key.startswith("$") and key.split(".")[0] not in known_fields:
+                    raise PipelineValidationError(f"Unknown field {key}")
+            _check_value({k: v for k, v in spec.items() if k.startswith("$")}, known_fields)
+            _check_value([v for k, v in spec.items() if not k.startswith("$")], known_fields)
+        else:
+            _check_value(spec, known_fields)
+        if name in ("$group", "$project", "$addFields", "$set") and isinstance(spec, dict):
+            known_fields |= set(spec)
+        elif name == "$count" and isinstance(spec, str):
+            known_fields.add(spec)
+        elif name in ("$sortByCount", "$bucket"):
+            known_fields |= {"count"} | set(spec.get("output", {}) if isinstance(spec, dict) else {})
+    return pipeline + [{"$limit": AGGREGATE_MAX_RESULTS}]
+
+def _parse_json(text: str):
+    text = text.strip()
+    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text)
+    return json.loads(text)
+
+def _llm():
+    return ChatGoogleGenerativeAI(
+        model="gemini-2.0-flash",
+        temperature=0.0,
+        google_api_key=os.getenv("GOOGLE_API_KEY")
+    )
+
+def _pipeline_prompt():
+    return ChatPromptTemplate.from_messages([
+        ("system", """
+        You translate analytical questions into MongoDB aggregation pipelines.
+        Collection columns: {columns}
+        Sample documents: {samples}
+        Rules:
+        - Use only these stages: {stages}.
+        - Reference only the listed columns or fields created by earlier stages.
+        - Return only JSON of the form {{"pipeline": [...]}}, with no explanation or markdown.
+        - If the question cannot be answered with an aggregation, return {{"pipeline": null}}.
+        """),
+        ("human", "Question: {query}")
+    ])
+
+def _pipeline_inputs(query: str, columns: list, sample_rows: list) -> dict:
+    return {
+        "columns": ", ".join(columns),
+        "samples": json.dumps(sample_rows, default=str),
+        "stages": ", ".join(sorted(ALLOWED_STAGES)),
+        "query": query,
+    }
+
+def generate_pipeline(query: str, columns: list, sample_rows: list) -> list:
+    """Asks the LLM to translate a question into a MongoDB aggregation pipeline (JSON)."""
+    response = (_pipeline_prompt() | _llm()).invoke(_pipeline_inputs(query, columns, sample_rows))
+    return _parse_json(response.content).get("pipeline")
+
+async def agenerate_pipeline(query: str, columns: list, sample_rows: list) -> list:
+    """Async variant of generate_pipeline."""
+    response = await (_pipeline_prompt() | _llm()).ainvoke(_pipeline_inputs(query, columns, sample_rows))
+    return _parse_json(response.content).get("pipeline")
+
+def _answer_prompt():
+    return ChatPromptTemplate.from_messages([
+        ("system", """
+        You are a helpful chatbot answering a question from the result of a database aggregation.
+        Aggregation result (JSON): {results}
+        Answer concisely and accurately using only this result.
+        Return the answer as plain text, no markdown or extra formatting.
+        """),
+        ("human", "Query: {query}")
+    ])
+
+def phrase_answer(query: str, results: list) -> str:
+    """Has the LLM phrase the (small) aggregation result as an answer."""
+    response = (_answer_prompt() | _llm()).invoke({"query": query, "results": json.dumps(results, default=str)})
+    return response.content
+
+async def aphrase_answer(query: str, results: list) -> str:
+    """Async variant of phrase_answer."""
+    response = await (_answer_prompt() | _llm()).ainvoke({"query": query, "results": json.dumps(results, default=str)})
+    return response.content
+
+def _target(meta: dict):
+    """(db_name, transformed collection, columns) of a dataset, or None when its meta lacks them."""
+    db_name, category, columns = meta.get('db_name'), meta.get('category'), meta.get('columns')
+    if not db_name or not category or not columns:
+        return None
+    return db_name, f"transformed_{category.lower()}", columns
+
+def _cache_key(query: str, meta: dict, db_name: str, collection_name: str, version_doc: dict):
+    """Answer cache key for the collection's data version, or None when it holds another file's data."""
+    if version_doc.get('filename') != meta.get('filename'):
+        logger.info(
+            f"{db_name}.{collection_name} holds {version_doc.get('filename')}, not {meta.get('filename')}; "
+            f"answering from the index instead"
+        )
+        return None
+    return (db_name, collection_name, version_doc.get('version'), normalize_query(query))
+
+def _cached(cache_key):
+    with _cache_lock:
+        if cache_key in _cache:
+            _cache.move_to_end(cache_key)
+            logger.debug(f"Aggregate cache hit for {cache_key}")
+            return _cache[cache_key]
+    return None
+
+def _remember(cache_key, answer: str):
+    with _cache_lock:
+        _cache[cache_key] = answer
+        while len(_cache) > AGGREGATE_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def answer_aggregate(query: str, meta: dict, sample_rows: list = ()) -> str:
+    """
+    Answers an analytical question with a validated aggregation pipeline run server-side
+    over transformed_<category>. Answers are cached per (dataset version, normalized query).
+    Returns None when the question cannot be answered this way, so callers fall back to RAG,
+    including when the collection now holds another file's data: each upload replaces it.
+    """
+    target = _target(meta)
+    if target is None:
+        return None
+    db_name, collection_name, columns = target
+
+    client = get_mongo_client()
+    try:
+        db = client[db_name]
+        version_doc = db[DATASET_VERSIONS_COLLECTION].find_one({'_id': collection_name}) or {}
+        cache_key = _cache_key(query, meta, db_name, collection_name, version_doc)
+        if cache_key is None:
+            return None
+        cached = _cached(cache_key)
+        if cached is not None:
+            return cached
+
+        try:
+            pipeline = generate_pipeline(query, columns, list(sample_rows))
+            if pipeline is None:
+                logger.info(f"LLM found no aggregation for '{query}'")
+                return None
+            pipeline = validate_pipeline(pipeline, columns)
+        except (PipelineValidationError, ValueError, AttributeError) as e:
+            logger.warning(f"Rejected aggregation pipeline for '{query}': {str(e)}")
+            return None
+        except Exception as e:
+            # LLM or network failure
+            logger.warning(f"Could not generate an aggregation pipeline for '{query}': {str(e)}")
+            return None
+
+        logger.debug(f"Running aggregation on {db_name}.{collection_name}: {pipeline}")
+        results = list(db[collection_name].aggregate(pipeline, allowDiskUse=True, maxTimeMS=AGGREGATE_TIMEOUT_MS))
+    except PyMongoError as e:
+        # A whitelisted pipeline can still fail to run (type mismatches, bad arguments, timeouts)
+        logger.warning(f"Aggregation for '{query}' failed on {db_name}.{collection_name}: {str(e)}")
+        return None
+    finally:
+        client.close()
+
+    try:
+        answer = phrase_answer(query, results)
+    except Exception as e:
+        logger.warning(f"Could not phrase the aggregation result for '{query}': {str(e)}")
+        return None
+    _remember(cache_key, answer)
+    logger.info(f"Answered '{query}' from {len(results)} aggregation rows")
+    return answer
+
+async def aanswer_aggregate(query: str, meta: dict, sample_rows: list = ()) -> str:
+    """
+    Async variant of answer_aggregate for ASGI views: MongoDB is read through the event
+    loop's Motor client and the LLM calls are awaited.
+    """
+    target = _target(meta)
+    if target is None:
+        return None
+    db_name, collection_name, columns = target
+
+    db = get_async_mongo_client()[db_name]
+    try:
+        version_doc = await db[DATASET_VERSIONS_COLLECTION].find_one({'_id': collection_name}) or {}
+        cache_key = _cache_key(query, meta, db_name, collection_name, version_doc)
+        if cache_key is None:
+            return None
+        cached = _cached(cache_key)
+        if cached is not None:
+            return cached
+
+        try:
+            pipeline = await agenerate_pipeline(query, columns, list(sample_rows))
+            if pipeline is None:
+                logger.info(f"LLM found no aggregation for '{query}'")
+                return None
+            pipeline = validate_pipeline(pipeline, columns)
+        except (PipelineValidationError, ValueError, AttributeError) as e:
+            logger.warning(f"Rejected aggregation pipeline for '{query}': {str(e)}")
+            return None
+        except Exception as e:
+            # LLM or network failure
+            logger.warning(f"Could not generate an aggregation pipeline for '{query}': {str(e)}")
+            return None
+
+        logger.debug(f"Running aggregation on {db_name}.{collection_name}: {pipeline}")
+        cursor = db[collection_name].aggregate(pipeline, allowDiskUse=True, maxTimeMS=AGGREGATE_TIMEOUT_MS)
+        results = await cursor.to_list(length=None)
+    except PyMongoError as e:
+        # A whitelisted pipeline can still fail to run (type mismatches, bad arguments, timeouts)
+        logger.warning(f"Aggregation for '{query}' failed on {db_name}.{collection_name}: {str(e)}")
+        return None
+
+    try:
+        answer = await aphrase_answer(query, results)
+    except Exception as e:
+        logger.warning(f"Could not phrase the aggregation result for '{query}': {str(e)}")
+        return None
+    _remember(cache_key, answer)
+    logger.info(f"Answered '{query}' from {len(results)} aggregation rows")
+    return answer
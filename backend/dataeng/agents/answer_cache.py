@@ -0,0 +1,122 @@
+# answer_cache.py
+import os
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+from .hybrid_retriever import parse_predicates
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Cache settings
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "256"))
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+
+NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?")
+
+def _normalize(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype='float32').reshape(-1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+def query_specifics(query: str, meta: dict = None) -> tuple:
+    """
+    The column predicates and numbers of a question. Questions differing only in these
+    ("invoice 1001" and "invoice 1002") embed almost identically but have different answers.
+    """
+    meta = meta or {}
+    predicates = parse_predicates(query, meta.get('columns', []), meta.get('primary_key'))
+    numbers = NUMBER_PATTERN.findall(query)
+    return tuple(sorted({(str(column), value) for column, value in predicates} | {('', number) for number in numbers}))
+
+class AnswerCache:
+    """
+    Per-dataset semantic cache of query answers.
+    Each dataset keeps the normalized embeddings of answered queries; a new query whose
+    cosine similarity to a cached one reaches threshold, and whose predicates and numbers
+    (query_specifics) are the same, is answered from the cache.
+    A dataset's entries are dropped whenever its index signature changes (a rebuild or
+    update of the index files), and the oldest entries go once max_entries is reached.
+    """
+
+    def __init__(self, threshold: float = ANSWER_CACHE_THRESHOLD, max_entries: int = ANSWER_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._datasets = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+
+    def _dataset(self, key: str, signature) -> dict:
+        dataset = self._datasets.get(key)
+        if dataset is None or dataset["signature"] != signature:
+            if dataset is not None:
+                logger.debug(f"Index for {key} changed, dropping {len(dataset['entries'])} cached answers")
+            dataset = {"signature": signature, "entries": OrderedDict(), "matrix": None}
+            self._datasets[key] = dataset
+        return dataset
+
+    def lookup(self, filename: str, signature, query_embedding, specifics: tuple = ()):
+        """
+        Returns the cached answer for the closest earlier query with the same specifics,
+        or None below the threshold.
+        """
+        start_time = time.time()
+        key = os.path.splitext(filename)[0]
+        query = _normalize(query_embedding)
+        with self._lock:
+            dataset = self._dataset(key, signature)
+            if dataset["entries"]:
+                if dataset["matrix"] is None:
+                    dataset["matrix"] = np.stack([entry["embedding"] for entry in dataset["entries"].values()])
+                similarities = dataset["matrix"] @ query
+                mismatched = [i for i, entry in enumerate(dataset["entries"].values()) if entry["specifics"] != specifics]
+                similarities[mismatched] = -np.inf
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    entry_key = list(dataset["entries"])[best]
+                    entry = dataset["entries"][entry_key]
+                    self.hits += 1
+                    self.seconds_saved += max(entry["seconds"] - (time.time() - start_time), 0.0)
+                    logger.debug(f"Answer cache hit for {key} (similarity {similarities[best]:.3f}): '{entry_key}'")
+                    return entry["answer"]
+            self.misses += 1
+        return None
+
+    def store(self, filename: str, signature, query: str, query_embedding, answer: str, seconds: float,
+              specifics: tuple = ()):
+        """Caches an answer along with the time it took to produce and the query's specifics."""
+        key = os.path.splitext(filename)[0]
+        with self._lock:
+            dataset = self._dataset(key, signature)
+            entries = dataset["entries"]
+            entries.pop(query, None)
+            entries[query] = {"embedding": _normalize(query_embedding), "answer": answer, "seconds": seconds,
+                              "specifics": specifics}
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            dataset["matrix"] = None
+
+    def invalidate(self, filename: str):
+        """Drops every cached answer for a dataset."""
+        with self._lock:
+            self._datasets.pop(os.path.splitext(filename)[0], None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "threshold": self.threshold,
+                "datasets": {key: len(dataset["entries"]) for key, dataset in self._datasets.items()},
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "seconds_saved": round(self.seconds_saved, 3),
+            }
+
+answer_cache = AnswerCache()
@@ -0,0 +1,41 @@
+# async_mongo.py
+import os
+import asyncio
+import logging
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Motor clients are bound to the event loop they were first used on. Each is closed, and
+# its entry dropped, when its loop shuts down its async generators (asyncio.run, and so
+# uvicorn and asgiref's async_to_sync, do this before closing the loop).
+_clients = {}
+
+async def _close_on_shutdown(loop, client):
+    try:
+        yield
+    finally:
+        _clients.pop(loop, None)
+        client.close()
+        logger.debug("Closed the Motor client of a finished event loop")
+
+def get_async_mongo_client():
+    """Returns a shared Motor client for the running event loop."""
+    mongo_uri = os.getenv("MONGO_URI")
+    if not mongo_uri:
+        logger.error("MONGO_URI not set in environment variables")
+        raise ValueError("MONGO_URI not set")
+    loop = asyncio.get_running_loop()
+    entry = _clients.get(loop)
+    if entry is None:
+        # Imported here so the WSGI deployment does not require motor
+        from motor.motor_asyncio import AsyncIOMotorClient
+        client = AsyncIOMotorClient(mongo_uri)
+        # Run the closer up to its yield; the loop now tracks it and finalizes it on shutdown
+        closer = _close_on_shutdown(loop, client)
+        try:
+            closer.__anext__().send(None)
+        except StopIteration:
+            pass
+        entry = _clients[loop] = (client, closer)
+    return entry[0]
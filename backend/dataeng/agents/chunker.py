@@ -0,0 +1,112 @@
+# chunker.py
+import os
+import logging
+import pandas as pd
+from .vector_index import row_id
+from .embedder import count_tokens, token_budget
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Chunking settings. The embedding model truncates its input (all-MiniLM-L6-v2 at 256 word
+# pieces), so a window is also closed before its text, header included, would exceed the
+# model's limit as counted by its own tokenizer. CHUNK_MAX_TOKENS lowers that limit.
+CHUNK_STRATEGY = os.getenv("CHUNK_STRATEGY", "size")  # row, size, key_range or group_by:<column>
+CHUNK_ROWS = int(os.getenv("CHUNK_ROWS", "8"))
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "0"))
+STRATEGIES = ("row", "size", "key_range", "group_by")
+
+def parse_chunking(spec: str, columns: list, primary_key: str = None) -> str:
+    """
+    Normalizes a chunking spec ("row", "size", "size:16", "key_range", "group_by:region",
+    "group_by:region:4") into "<strategy>[:<column>]:<rows>", falling back to size windows
+    when the key or group-by column is missing from the dataset.
+    """
+    parts = [part.strip() for part in (spec or CHUNK_STRATEGY).split(":")]
+    strategy = parts[0].lower() or "size"
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown chunking strategy: {strategy}")
+    if strategy == "row":
+        return "row"
+
+    column = None
+    if strategy == "group_by":
+        # Column names may themselves contain colons
+        size = parts[-1] if len(parts) > 2 and parts[-1].isdigit() else ""
+        column = ":".join(parts[1:-1] if size else parts[1:])
+        if column not in columns:
+            logger.warning(f"Group-by column '{column}' not in dataset, chunking by size")
+            strategy, column = "size", None
+    else:
+        size = parts[1] if len(parts) > 1 else ""
+        if strategy == "key_range" and not (primary_key and primary_key in columns):
+            logger.warning("No primary key for key-range chunking, chunking by size")
+            strategy = "size"
+    rows = int(size) if size.isdigit() and int(size) > 0 else CHUNK_ROWS
+    return f"{strategy}:{column}:{rows}" if column else f"{strategy}:{rows}"
+
+def _windows(positions: list, tokens: list, rows: int, budget: int) -> list:
+    """
+    Splits positions into windows of at most rows rows whose lines hold at most budget
+    tokens together. A line longer than the budget still gets a window of its own.
+    """
+    windows, current, length = [], [], 0
+    for position in positions:
+        if current and (len(current) >= rows or length + tokens[position] > budget):
+            windows.append(current)
+            current, length = [], 0
+        current.append(position)
+        length += tokens[position]
+    if current:
+        windows.append(current)
+    return windows
+
+def build_chunks(df: pd.DataFrame, ids: list, chunking: str, primary_key: str = None) -> tuple:
+    """
+    Groups rows into retrieval documents according to a normalized chunking spec.
+    Each document starts with the column names (and group value), followed by one
+    " | "-separated line per row. Chunk ids are derived from their member row ids, so
+    unchanged windows keep their vector across incremental updates.
+    Returns (chunks, row_chunks): a list of (chunk id, text) and each row's chunk id.
+    """
+    df = df.reset_index(drop=True)
+    columns = [str(col) for col in df.columns]
+    lines = df.astype(str).agg(' | '.join, axis=1).tolist()
+    parts = chunking.split(":")
+    strategy, rows = parts[0], int(parts[-1])
+    positions = list(range(len(df)))
+
+    if strategy == "key_range":
+        try:
+            order = df[primary_key].sort_values(kind="stable").index
+        except TypeError:
+            # Mixed-type keys are ordered as text
+            order = df[primary_key].astype(str).sort_values(kind="stable").index
+        groups = [(None, list(order))]
+    elif strategy == "group_by":
+        column = ":".join(parts[1:-1])
+        keys = df[column].astype(str)
+        groups = [
+            (f"{column} = {value}", list(members))
+            for value, members in keys.groupby(keys, sort=True).groups.items()
+        ]
+    else:
+        groups = [(None, positions)]
+
+    header = " | ".join(columns)
+    budget = token_budget()
+    if CHUNK_MAX_TOKENS > 0:
+        budget = min(budget, CHUNK_MAX_TOKENS)
+    tokens = count_tokens(lines)
+    header_tokens, *label_tokens = count_tokens([header] + [label or "" for label, _ in groups])
+    chunks = []
+    row_chunks = [None] * len(df)
+    for (label, members), label_length in zip(groups, label_tokens):
+        for window in _windows(members, tokens, rows, budget - header_tokens - label_length):
+            chunk_id = row_id("chunk:" + ",".join(str(ids[position]) for position in window))
+            prefix = f"{label}\n" if label else ""
+            chunks.append((chunk_id, prefix + header + "\n" + "\n".join(lines[position] for position in window)))
+            for position in window:
+                row_chunks[position] = chunk_id
+    logger.debug(f"Chunked {len(df)} rows into {len(chunks)} documents ({chunking})")
+    return chunks, row_chunks
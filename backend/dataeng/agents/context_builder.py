@@ -0,0 +1,143 @@
+# context_builder.py
+import os
+import re
+import math
+import logging
+from .hybrid_retriever import query_terms
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Context settings. Distances are squared L2 between normalized MiniLM embeddings (0 to 4).
+CONTEXT_MIN_K = int(os.getenv("CONTEXT_MIN_K", "3"))
+CONTEXT_MAX_K = int(os.getenv("CONTEXT_MAX_K", "20"))
+CONTEXT_DISTANCE_MARGIN = float(os.getenv("CONTEXT_DISTANCE_MARGIN", "0.25"))
+CONTEXT_MAX_DISTANCE = float(os.getenv("CONTEXT_MAX_DISTANCE", "1.2"))
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+CONTEXT_DEDUPE_THRESHOLD = float(os.getenv("CONTEXT_DEDUPE_THRESHOLD", "0.9"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token), without loading a tokenizer."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def adaptive_k(ranked: list, distances: dict, exact_ids: list) -> list:
+    """
+    Keeps the fused candidates worth sending: rows matching a query predicate, rows whose
+    dense distance is within CONTEXT_DISTANCE_MARGIN of the best (and below
+    CONTEXT_MAX_DISTANCE), and always the first CONTEXT_MIN_K, up to CONTEXT_MAX_K rows.
+    Keyword-only hits have no dense distance; they are kept when fusion ranked them ahead
+    of the last row kept by distance.
+    """
+    candidates = ranked[:CONTEXT_MAX_K]
+    known = [distances[i] for i in candidates if i in distances]
+    cutoff = min(min(known) + CONTEXT_DISTANCE_MARGIN, CONTEXT_MAX_DISTANCE) if known else -1.0
+    close = {row_id for row_id in candidates if distances.get(row_id, math.inf) <= cutoff}
+    horizon = max([rank for rank, row_id in enumerate(candidates) if row_id in close], default=-1)
+    exact = set(exact_ids)
+    return [
+        row_id for rank, row_id in enumerate(candidates)
+        if rank < CONTEXT_MIN_K or row_id in exact or row_id in close
+        or (row_id not in distances and rank < horizon)
+    ]
+
+def _token_set(text: str) -> set:
+    return set(re.findall(r"\w+", text.lower()))
+
+def _jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+def mmr(row_ids: list, texts: dict) -> list:
+    """
+    Reorders rows by maximal marginal relevance, trading rank against Jaccard similarity
+    to rows already chosen, and drops rows at least CONTEXT_DEDUPE_THRESHOLD similar to one.
+    """
+    tokens = {i: _token_set(texts[i]) for i in row_ids}
+    relevance = {i: 1.0 - rank / max(len(row_ids), 1) for rank, i in enumerate(row_ids)}
+    remaining, selected = list(row_ids), []
+    while remaining:
+        scored = []
+        for i in remaining:
+            similarity = max((_jaccard(tokens[i], tokens[j]) for j in selected), default=0.0)
+            scored.append((CONTEXT_MMR_LAMBDA * relevance[i] - (1 - CONTEXT_MMR_LAMBDA) * similarity, similarity, i))
+        remaining = [i for _, similarity, i in scored if similarity < CONTEXT_DEDUPE_THRESHOLD]
+        if not remaining:
+            break
+        best = max((entry for entry in scored if entry[2] in remaining), key=lambda entry: entry[0])[2]
+        selected.append(best)
+        remaining.remove(best)
+    return selected
+
+def relevant_columns(query: str, columns: list, primary_key: str = None) -> list:
+    """
+    Columns named in the query (by full name or a word of it), plus the primary key.
+    All columns when the query names none.
+    """
+    terms = set(query_terms(query))
+    lowered = query.lower()
+    chosen = []
+    for column in columns:
+        name = str(column).lower()
+        words = [word for word in re.split(r"[_\W]+", name) if len(word) > 2]
+        if name in lowered or name.replace('_', ' ') in lowered or terms & set(words):
+            chosen.append(column)
+    if not chosen:
+        return list(columns)
+    if primary_key in columns and primary_key not in chosen:
+        chosen.insert(0, primary_key)
+    return chosen
+
+def build_context(query: str, store, ranked: list, distances: dict, exact_ids: list) -> tuple:
+    """
+    Turns fused retrieval candidates into a compact prompt context: adaptive k, MMR
+    de-duplication, projection onto the columns the query is about and a token budget.
+    Returns (context, stats), where stats lists the row_ids in the context, and logs the
+    tokens saved against sending every candidate adaptive k chose from (the first
+    CONTEXT_MAX_K) as plain rows under a column header.
+    """
+    baseline_ids = ranked[:CONTEXT_MAX_K]
+    selected = adaptive_k(ranked, distances, exact_ids)
+    texts = store.fetch_by_id(baseline_ids)
+    columns = store.meta.get('columns') or []
+    header = f"Columns: {', '.join(columns)}" if columns else ""
+    baseline_tokens = estimate_tokens("\n".join([header] + [texts[i] for i in baseline_ids if i in texts]))
+
+    selected = mmr([i for i in selected if i in texts], texts)
+    projected = relevant_columns(query, columns, store.meta.get('primary_key')) if columns else []
+    if len(projected) == len(columns):
+        # Nothing to project away; plain rows under the header are shorter than labelled fields
+        projected = []
+    fields = store.fetch_fields(selected) if projected else {}
+
+    lines, tokens, rows = [], 0, 0
+    if not fields and columns:
+        lines.append(header)
+        tokens += estimate_tokens(header)
+    for row_id in selected:
+        if row_id in fields:
+            line = "; ".join(f"{column}: {fields[row_id].get(column)}" for column in projected)
+        else:
+            line = texts[row_id]
+        line_tokens = estimate_tokens(line)
+        if lines and tokens + line_tokens > CONTEXT_TOKEN_BUDGET:
+            break
+        lines.append(line)
+        tokens += line_tokens
+        rows += 1
+
+    context = "\n".join(lines)
+    stats = {
+        'candidates': len(ranked),
+        'rows': rows,
+        'row_ids': selected[:rows],
+        'columns': len(projected) or len(columns),
+        'tokens': tokens,
+        'baseline_tokens': baseline_tokens,
+        'tokens_saved': baseline_tokens - tokens,
+    }
+    logger.info(
+        f"Context for '{query}': {stats['rows']} rows x {stats['columns']} columns, "
+        f"~{tokens} tokens, saved ~{stats['tokens_saved']} of {baseline_tokens}"
+    )
+    return context, stats
@@ -2,7 +2,7 @@ import os
 import pandas as pd
 from datetime import datetime
 from shutil import move
-from pymongo import MongoClient
+from pymongo import MongoClient, InsertOne, UpdateOne
 from langchain.agents import AgentExecutor, create_openai_functions_agent
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI
@@ -11,6 +11,11 @@ from pydantic.v1 import BaseModel, Field
 import logging
 import re
 import time
+from .metadata_cache import metadata_cache
+from .ingestion_log import LOG_DIR, append_entry
+from .tracing import span, traced, record, record_llm_usage
+from . import dataset_registry
+from .row_hash import ROW_HASH_FIELD, row_hash
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -20,14 +25,12 @@ logging.getLogger('pymongo').setLevel(logging.WARNING)
 
 RAW_DIR = "raw_data/"
 ORG_DIR = "organized_data/"
-LOG_DIR = "logs/"
 
 os.makedirs(LOG_DIR, exist_ok=True)
 os.makedirs(ORG_DIR, exist_ok=True)
-LOG_FILE = os.path.join(LOG_DIR, "ingestion.log")
-if not os.path.exists(LOG_FILE):
-    with open(LOG_FILE, "a") as f:
-        pass
+
+# Rows per hash lookup and bulk write when ingesting into MongoDB
+MONGO_BATCH_SIZE = int(os.getenv("MONGO_BATCH_SIZE", "1000"))
 
 def get_mongo_client():
     """Initialize MongoDB client from environment variable."""
@@ -42,6 +45,7 @@ class ClassifyDatasetInput(BaseModel):
     db_name: str = Field(description="Name of the MongoDB database")
 
 @tool(args_schema=ClassifyDatasetInput)
+@traced("classify")
 def classify_dataset_tool(columns: list, db_name: str) -> str:
     """Classifies the dataset by matching its columns against schemas in the database."""
     logger.debug(f"Classifying dataset for {db_name}, columns: {columns}")
@@ -83,6 +87,7 @@ class ValidateSchemaInput(BaseModel):
     category: str = Field(description="Category of the file")
 
 @tool(args_schema=ValidateSchemaInput)
+@traced("validate")
 def validate_schema_tool(columns: list, db_name: str, category: str) -> bool:
     """Validates schema columns against constraints stored in MongoDB."""
     logger.debug(f"Validating schema for {db_name}.{category}, columns: {columns}")
@@ -113,6 +118,7 @@ class IdentifyPrimaryKeyInput(BaseModel):
     category: str = Field(description="Category of the file")
 
 @tool(args_schema=IdentifyPrimaryKeyInput)
+@traced("primary_key")
 def identify_primary_key_tool(columns: list, db_name: str, category: str) -> str:
     """Identifies the primary key for the dataset using the schema and LLM analysis."""
     logger.debug(f"Identifying primary key for {db_name}.{category}, columns: {columns}")
@@ -143,6 +149,7 @@ def identify_primary_key_tool(columns: list, db_name: str, category: str) -> str
         )
 
         response = llm.invoke(prompt)
+        record_llm_usage(response)
         primary_key = response.content.strip()
         
         if primary_key not in columns:
@@ -161,13 +168,13 @@ class LogSummaryInput(BaseModel):
     valid: bool = Field(description="Whether the schema is valid")
 
 @tool(args_schema=LogSummaryInput)
+@traced("log_summary")
 def log_summary_tool(filename: str, category: str, valid: bool):
     """Logs the ingestion summary for the file."""
     logger.debug(f"Logging summary: filename={filename}, category={category}, valid={valid}")
     entry = f"{filename} | Category: {category} | Valid: {valid} | Time: {datetime.now()}\n"
     try:
-        with open(LOG_FILE, "a") as f:
-            f.write(entry)
+        append_entry(entry)
         return "Logged"
     except Exception as e:
         logger.error(f"Logging failed: {str(e)}")
@@ -179,6 +186,7 @@ class MoveToCategoryInput(BaseModel):
     filename: str = Field(description="Name of the file")
 
 @tool(args_schema=MoveToCategoryInput)
+@traced("move_file")
 def move_to_category_tool(filepath: str, category: str, filename: str) -> str:
     """Moves the file to its category directory."""
     logger.debug(f"Attempting to move file: {filepath} to {os.path.join(ORG_DIR, category, filename)}")
@@ -204,6 +212,7 @@ class InsertToMongoInput(BaseModel):
     primary_key: str = Field(description="Primary key column for the dataset")
 
 @tool(args_schema=InsertToMongoInput)
+@traced("mongo_insert")
 def insert_to_mongo_tool(filepath: str, filename: str, db_name: str, category: str, primary_key: str) -> str:
     """Inserts or updates file data into a MongoDB collection named after the schema category, preventing duplicates."""
     logger.debug(f"Inserting/updating data from {filename} into {db_name}.{category} using primary key {primary_key}")
@@ -224,6 +233,7 @@ def insert_to_mongo_tool(filepath: str, filename: str, db_name: str, category: s
         if not records:
             logger.warning(f"No records to insert from {filename}")
             return f"Error: No records to insert"
+        record(rows=len(records), bytes=os.path.getsize(filepath))
 
         # Initialize MongoDB client
         client = get_mongo_client()
@@ -234,47 +244,70 @@ def insert_to_mongo_tool(filepath: str, filename: str, db_name: str, category: s
         if category.lower() not in db.list_collection_names():
             logger.info(f"Creating new collection: {db_name}.{category.lower()}")
             db.create_collection(category.lower())
+            # A new collection (and possibly database) changes the cached listings
+            metadata_cache.invalidate('collections', db_name)
+            metadata_cache.invalidate('databases')
+
+        # Change detection by content hash: only the hashes of rows already stored come back
+        # from Mongo, unchanged rows are skipped and the rest are written in bulk
+        collection.create_index(ROW_HASH_FIELD)
+        keyed = primary_key in records[0]
+        if keyed:
+            collection.create_index(primary_key)
+        else:
+            logger.warning(f"Primary key {primary_key} not found in records, inserting changed rows as new")
 
         inserted_count = 0
+        updated_count = 0
         skipped_count = 0
-
-        for record in records:
-            if primary_key not in record:
-                logger.warning(f"Primary key {primary_key} not found in record, inserting as new")
-                collection.insert_one(record)
-                inserted_count += 1
-                continue
-
-            # Check if record with primary key exists
-            existing_record = collection.find_one({primary_key: record[primary_key]})
-            if existing_record:
-                # Compare records to avoid unnecessary updates
-                if all(existing_record.get(k) == v for k, v in record.items()):
-                    logger.debug(f"Skipping duplicate record with {primary_key}: {record[primary_key]}")
+        # Stored copies of each row hash seen so far that no row of the file has matched yet
+        available = {}
+        for start in range(0, len(records), MONGO_BATCH_SIZE):
+            batch = records[start:start + MONGO_BATCH_SIZE]
+            for row in batch:
+                row[ROW_HASH_FIELD] = row_hash(row)
+            new_hashes = list({row[ROW_HASH_FIELD] for row in batch} - available.keys())
+            available.update((row_hash_value, 0) for row_hash_value in new_hashes)
+            for doc in collection.aggregate([
+                {'$match': {ROW_HASH_FIELD: {'$in': new_hashes}}},
+                {'$group': {'_id': f'${ROW_HASH_FIELD}', 'count': {'$sum': 1}}},
+            ]):
+                available[doc['_id']] = doc['count']
+            operations = []
+            for row in batch:
+                if available[row[ROW_HASH_FIELD]] > 0:
                     skipped_count += 1
+                    if not keyed:
+                        # Without a key, identical rows are separate records: each stored copy
+                        # accounts for one occurrence in the file, further ones are inserted
+                        available[row[ROW_HASH_FIELD]] -= 1
                     continue
+                if keyed:
+                    # The row now stored for its key; repeats within the file are written once
+                    available[row[ROW_HASH_FIELD]] = 1
+                    operations.append(UpdateOne({primary_key: row[primary_key]}, {'$set': row}, upsert=True))
                 else:
-                    # Update if record differs
-                    collection.update_one(
-                        {primary_key: record[primary_key]},
-                        {'$set': record},
-                        upsert=True
-                    )
-                    inserted_count += 1
-                    logger.debug(f"Updated record with {primary_key}: {record[primary_key]}")
-            else:
-                # Insert new record
-                collection.insert_one(record)
-                inserted_count += 1
-                logger.debug(f"Inserted new record with {primary_key}: {record[primary_key]}")
+                    operations.append(InsertOne(row))
+            if operations:
+                result = collection.bulk_write(operations, ordered=True)
+                inserted_count += result.inserted_count + result.upserted_count
+                updated_count += result.modified_count
 
         client.close()
-        logger.debug(f"Processed {inserted_count} records, skipped {skipped_count} duplicates in {db_name}.{category.lower()}")
-        return f"Inserted/Updated {inserted_count} records, Skipped {skipped_count} duplicates"
+        logger.debug(
+            f"Inserted {inserted_count}, updated {updated_count} and skipped {skipped_count} unchanged records "
+            f"in {db_name}.{category.lower()}"
+        )
+        dataset_registry.record(
+            filename, db_name, category=category, rows=len(records), raw_bytes=os.path.getsize(filepath),
+            content_hash=dataset_registry.file_digest(filepath), ingested_at=dataset_registry.now()
+        )
+        return f"Inserted/Updated {inserted_count + updated_count} records, Skipped {skipped_count} duplicates"
     except Exception as e:
         logger.error(f"Error processing data into {db_name}.{category.lower()}: {str(e)}")
         return f"Error: {str(e)}"
 
+@traced("ingest")
 def ingest_file(filepath: str, filename: str, db_name: str):
     logger.info(f"Processing file: {filepath} for database {db_name}")
     try:
@@ -303,6 +336,7 @@ def ingest_file(filepath: str, filename: str, db_name: str):
             # Test LLM responsiveness
             start_time = time.time()
             test_response = llm.invoke("Test prompt: Return 'OK'")
+            record_llm_usage(test_response)
             logger.debug(f"LLM test response: {test_response.content}, latency: {time.time() - start_time:.2f}s")
             if test_response.content.strip() != "OK":
                 logger.warning("LLM test failed, proceeding with manual workflow")
@@ -364,18 +398,18 @@ def ingest_file(filepath: str, filename: str, db_name: str):
         ])
 
         agent = create_openai_functions_agent(llm=llm, tools=tools, prompt=prompt)
-        agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True, handle_parsing_errors=True, max_iterations=10)
+        agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True, handle_parsing_errors=True, max_iterations=10, return_intermediate_steps=True)
 
         try:
-            start_time = time.time()
-            result = agent_executor.invoke({
-                "filename": filename,
-                "file_path": filepath,
-                "db_name": db_name,
-                "columns": columns_str,
-                "agent_scratchpad": ""
-            })
-            logger.debug(f"AgentExecutor completed in {time.time() - start_time:.2f}s")
+            with span("ingest_agent") as agent_span:
+                result = agent_executor.invoke({
+                    "filename": filename,
+                    "file_path": filepath,
+                    "db_name": db_name,
+                    "columns": columns_str,
+                    "agent_scratchpad": ""
+                }, config={"callbacks": agent_span.callbacks()})
+            logger.debug(f"AgentExecutor completed in {agent_span.duration:.2f}s")
             logger.debug(f"AgentExecutor raw output: {result.get('output', '')}")
             logger.debug(f"Agent scratchpad: {result.get('agent_scratchpad', '')}")
 
@@ -392,7 +426,12 @@ def ingest_file(filepath: str, filename: str, db_name: str):
 
             category = category_match.group(1).strip()
             valid = valid_match.group(1).strip().lower() == "true"
-            logger.debug(f"Parsed category: {category}, valid: {valid}")
+            primary_key = next(
+                (str(observation) for action, observation in result.get("intermediate_steps", [])
+                 if action.tool == "identify_primary_key_tool" and not str(observation).startswith("Error:")),
+                None
+            )
+            logger.debug(f"Parsed category: {category}, valid: {valid}, primary key: {primary_key}")
 
             # Verify file was moved
             target_path = os.path.join(ORG_DIR, category, filename)
@@ -400,7 +439,8 @@ def ingest_file(filepath: str, filename: str, db_name: str):
                 logger.error(f"File not found at {target_path}")
                 raise RuntimeError(f"File move failed: File not found at {target_path}")
 
-            return {"category": category, "valid": valid}
+            dataset_registry.record(filename, db_name, valid=valid)
+            return {"category": category, "valid": valid, "primary_key": primary_key}
 
         except Exception as e:
             logger.error(f"AgentExecutor failed: {str(e)}, falling back to manual workflow")
@@ -468,7 +508,8 @@ def manual_ingest_file(filepath: str, filename: str, db_name: str, columns: list
             logger.error(f"File not found at {target_path}")
             raise RuntimeError(f"File move failed: File not found at {target_path}")
 
-        return {"category": category, "valid": valid}
+        dataset_registry.record(filename, db_name, valid=valid)
+        return {"category": category, "valid": valid, "primary_key": primary_key}
 
     except Exception as e:
         logger.error(f"Manual ingestion failed for {filename}: {str(e)}")
@@ -0,0 +1,236 @@
+# dataset_registry.py
+import os
+import hashlib
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Paths
+REGISTRY_PATH = os.getenv("DATASET_REGISTRY_PATH", "datasets.sqlite3")
+VECTOR_DB_DIR = "vector_db"
+
+# Registry settings
+DATASET_PAGE_SIZE = int(os.getenv("DATASET_PAGE_SIZE", "100"))
+DATASET_PAGE_MAX = int(os.getenv("DATASET_PAGE_MAX", "1000"))
+
+# One row per uploaded dataset and database. Each pipeline stage fills in its own columns and
+# stage timestamp; later stages find the row by the transformed file name they work on.
+SCHEMA = """
+PRAGMA journal_mode=WAL;
+CREATE TABLE IF NOT EXISTS datasets (
+    filename TEXT NOT NULL,
+    db_name TEXT NOT NULL DEFAULT '',
+    category TEXT COLLATE NOCASE,
+    rows INTEGER,
+    raw_bytes INTEGER,
+    content_hash TEXT,
+    valid INTEGER,
+    clean_file TEXT,
+    transformed_rows INTEGER,
+    clean_bytes INTEGER,
+    report_path TEXT,
+    index_type TEXT,
+    storage TEXT,
+    vectors INTEGER,
+    index_bytes INTEGER,
+    ingested_at TEXT,
+    transformed_at TEXT,
+    reported_at TEXT,
+    embedded_at TEXT,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (filename, db_name)
+);
+CREATE INDEX IF NOT EXISTS datasets_updated ON datasets (updated_at);
+CREATE INDEX IF NOT EXISTS datasets_category ON datasets (category, updated_at);
+CREATE INDEX IF NOT EXISTS datasets_db ON datasets (db_name, updated_at);
+CREATE INDEX IF NOT EXISTS datasets_clean_file ON datasets (clean_file, db_name);
+CREATE INDEX IF NOT EXISTS datasets_content_hash ON datasets (db_name, content_hash);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+
+FIELDS = (
+    "category", "rows", "raw_bytes", "content_hash", "valid", "clean_file", "transformed_rows", "clean_bytes",
+    "report_path", "index_type", "storage", "vectors", "index_bytes",
+    "ingested_at", "transformed_at", "reported_at", "embedded_at",
+)
+
+# Columns added after the first release, with their types; existing registries gain them on open
+ADDED_COLUMNS = {"valid": "INTEGER"}
+
+# The index is older than the data it was built from
+STALE = "(embedded_at IS NULL OR embedded_at < COALESCE(transformed_at, ingested_at, ''))"
+
+_initialized = set()
+_init_lock = threading.Lock()
+
+def now() -> str:
+    """Stage timestamp; ISO strings with a fixed precision compare in time order."""
+    return datetime.now().isoformat(timespec='milliseconds')
+
+def content_hasher():
+    """The hash behind content_hash; uploads are hashed with it while they are streamed to disk."""
+    return hashlib.blake2b(digest_size=16)
+
+def file_digest(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Compact content hash of a file, read in chunks."""
+    digest = content_hasher()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _backfill(conn):
+    """Registers indexes built before the registry existed, once, so they stay listed."""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'backfilled'").fetchone():
+        return
+    if os.path.isdir(VECTOR_DB_DIR):
+        for name in os.listdir(VECTOR_DB_DIR):
+            if not name.endswith('_index.faiss'):
+                continue
+            path = os.path.join(VECTOR_DB_DIR, name)
+            clean_file = name.replace('_index.faiss', '.csv')
+            embedded_at = datetime.fromtimestamp(os.path.getmtime(path)).isoformat(timespec='milliseconds')
+            conn.execute(
+                "INSERT OR IGNORE INTO datasets (filename, db_name, clean_file, index_bytes, embedded_at, updated_at) "
+                "VALUES (?, '', ?, ?, ?, ?)",
+                (clean_file, clean_file, os.path.getsize(path), embedded_at, embedded_at)
+            )
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('backfilled', ?)", (now(),))
+
+def _add_columns(conn):
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(datasets)")}
+    for column, column_type in ADDED_COLUMNS.items():
+        if column not in existing:
+            conn.execute(f"ALTER TABLE datasets ADD COLUMN {column} {column_type}")
+
+def _connect():
+    directory = os.path.dirname(REGISTRY_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(REGISTRY_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    if REGISTRY_PATH not in _initialized:
+        with _init_lock:
+            if REGISTRY_PATH not in _initialized:
+                conn.executescript(SCHEMA)
+                with conn:
+                    _add_columns(conn)
+                    _backfill(conn)
+                _initialized.add(REGISTRY_PATH)
+    return conn
+
+def _checked(fields: dict) -> dict:
+    unknown = [key for key in fields if key not in FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown dataset fields: {', '.join(unknown)}")
+    return fields
+
+def record(filename: str, db_name: str, **fields):
+    """
+    Creates or updates the dataset's row with the given fields. Registry failures are
+    logged rather than raised, so they never fail a pipeline stage.
+    """
+    fields = _checked(fields)
+    columns = ["filename", "db_name", "updated_at"] + list(fields)
+    values = [filename, db_name or "", now()] + list(fields.values())
+    updates = ", ".join(f"{column} = excluded.{column}" for column in columns[2:])
+    try:
+        conn = _connect()
+        try:
+            with conn:
+                conn.execute(
+                    f"INSERT INTO datasets ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                    f"ON CONFLICT (filename, db_name) DO UPDATE SET {updates}",
+                    values
+                )
+        finally:
+            conn.close()
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Failed to record dataset {filename} in the registry: {str(e)}")
+
+def record_output(clean_file: str, db_name: str, **fields):
+    """
+    Updates the dataset whose transformed file is clean_file, as the report and embedding
+    stages only see that name. A file the registry does not know becomes its own dataset.
+    """
+    fields = _checked(fields)
+    assignments = ", ".join(f"{column} = ?" for column in ["updated_at"] + list(fields))
+    try:
+        conn = _connect()
+        try:
+            with conn:
+                updated = conn.execute(
+                    f"UPDATE datasets SET {assignments} WHERE clean_file = ? AND db_name = ?",
+                    [now()] + list(fields.values()) + [clean_file, db_name or ""]
+                ).rowcount
+        finally:
+            conn.close()
+    except (sqlite3.Error, OSError) as e:
+        logger.error(f"Failed to record dataset {clean_file} in the registry: {str(e)}")
+        return
+    if not updated:
+        record(clean_file, db_name, clean_file=clean_file, **fields)
+
+def to_dict(row) -> dict:
+    dataset = dict(row)
+    dataset['stale'] = dataset['embedded_at'] is None or dataset['embedded_at'] < (
+        dataset['transformed_at'] or dataset['ingested_at'] or '')
+    return dataset
+
+def get(filename: str, db_name: str) -> dict:
+    """The dataset's row, or None."""
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT * FROM datasets WHERE filename = ? AND db_name = ?", (filename, db_name or "")
+        ).fetchone()
+    finally:
+        conn.close()
+    return to_dict(row) if row else None
+
+def find_by_hash(db_name: str, content_hash: str) -> dict:
+    """The most recently embedded dataset in db_name with this content and an up-to-date index, or None."""
+    conn = _connect()
+    try:
+        row = conn.execute(
+            f"SELECT * FROM datasets WHERE db_name = ? AND content_hash = ? AND embedded_at IS NOT NULL "
+            f"AND report_path IS NOT NULL AND NOT {STALE} ORDER BY embedded_at DESC LIMIT 1",
+            (db_name or "", content_hash)
+        ).fetchone()
+    finally:
+        conn.close()
+    return to_dict(row) if row else None
+
+def list_datasets(category: str = None, db_name: str = None, embedded: bool = None, stale: bool = None,
+                  offset: int = 0, limit: int = DATASET_PAGE_SIZE) -> tuple:
+    """
+    Returns (datasets, total): one page of datasets matching the filters, most recently
+    updated first, and the number of matches. embedded=True keeps datasets with an index.
+    limit=None returns every match from offset on.
+    """
+    where, params = [], []
+    if category:
+        where.append("category = ?")
+        params.append(category)
+    if db_name is not None:
+        where.append("db_name = ?")
+        params.append(db_name)
+    if embedded is not None:
+        where.append("embedded_at IS NOT NULL" if embedded else "embedded_at IS NULL")
+    if stale is not None:
+        where.append(STALE if stale else f"NOT {STALE}")
+    clause = f"WHERE {' AND '.join(where)}" if where else ""
+    conn = _connect()
+    try:
+        total = conn.execute(f"SELECT COUNT(*) FROM datasets {clause}", params).fetchone()[0]
+        rows = conn.execute(
+            f"SELECT * FROM datasets {clause} ORDER BY updated_at DESC, filename LIMIT ? OFFSET ?",
+            params + [min(limit, DATASET_PAGE_MAX) if limit is not None else -1, offset]
+        ).fetchall()
+    finally:
+        conn.close()
+    return [to_dict(row) for row in rows], total
@@ -0,0 +1,104 @@
+# embedder.py
+import os
+import time
+import logging
+import threading
+import numpy as np
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Embedding model settings
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+EMBEDDER_BACKEND = os.getenv("EMBEDDER_BACKEND", "torch")  # torch, torch-int8, onnx, onnx-int8
+EMBEDDER_ONNX_INT8_FILE = os.getenv("EMBEDDER_ONNX_INT8_FILE", "onnx/model_qint8_avx512_vnni.onnx")
+EMBEDDER_BATCH_SIZE = int(os.getenv("EMBEDDER_BATCH_SIZE", "64"))
+
+_model = None
+_lock = threading.Lock()
+_stats = {}
+
+def _rss_bytes() -> int:
+    """Current resident set size of this process, or 0 where /proc is unavailable."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+def _load_model():
+    # Imported here so processes that never embed do not pay for torch
+    from sentence_transformers import SentenceTransformer
+
+    rss_before = _rss_bytes()
+    start_time = time.time()
+    if EMBEDDER_BACKEND == "onnx":
+        model = SentenceTransformer(EMBEDDING_MODEL, backend="onnx", device="cpu")
+    elif EMBEDDER_BACKEND == "onnx-int8":
+        model = SentenceTransformer(
+            EMBEDDING_MODEL,
+            backend="onnx",
+            device="cpu",
+            model_kwargs={"file_name": EMBEDDER_ONNX_INT8_FILE}
+        )
+    elif EMBEDDER_BACKEND == "torch-int8":
+        import torch
+        model = SentenceTransformer(EMBEDDING_MODEL, device="cpu")
+        torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    elif EMBEDDER_BACKEND == "torch":
+        model = SentenceTransformer(EMBEDDING_MODEL)
+    else:
+        raise ValueError(f"Unknown embedder backend: {EMBEDDER_BACKEND}")
+
+    _stats.update({
+        "model": EMBEDDING_MODEL,
+        "backend": EMBEDDER_BACKEND,
+        "load_seconds": round(time.time() - start_time, 3),
+        "rss_delta_bytes": _rss_bytes() - rss_before,
+    })
+    logger.info(f"Loaded embedding model: {_stats}")
+    return model
+
+def get_embedder():
+    """
+    Returns the process-wide SentenceTransformer, loading it on first use.
+    The backend (plain torch, dynamically quantized int8 torch, ONNX or int8 ONNX)
+    is selected with EMBEDDER_BACKEND.
+    """
+    global _model
+    if _model is None:
+        with _lock:
+            if _model is None:
+                try:
+                    _model = _load_model()
+                except Exception as e:
+                    logger.error(f"Failed to load SentenceTransformer model: {str(e)}")
+                    raise
+    return _model
+
+def encode(texts: list, show_progress_bar: bool = False, batch_size: int = EMBEDDER_BATCH_SIZE) -> np.ndarray:
+    """Encodes texts with the shared model and returns a float32 matrix."""
+    embeddings = get_embedder().encode(texts, batch_size=batch_size, show_progress_bar=show_progress_bar)
+    return np.asarray(embeddings, dtype='float32')
+
+def token_budget() -> int:
+    """Word pieces the model reads per text before truncating, less its [CLS] and [SEP] tokens."""
+    return get_embedder().max_seq_length - 2
+
+def count_tokens(texts: list) -> list:
+    """Number of word pieces the model's tokenizer splits each text into, without special tokens."""
+    if not texts:
+        return []
+    encoded = get_embedder().tokenizer(list(texts), add_special_tokens=False)
+    return [len(ids) for ids in encoded["input_ids"]]
+
+def warm_up():
+    """Loads the model and runs one encode so the first request does not pay for it."""
+    start_time = time.time()
+    encode(["warm up"])
+    _stats["warmup_seconds"] = round(time.time() - start_time, 3)
+    logger.info(f"Embedding model warmed up in {_stats['warmup_seconds']}s")
+
+def embedder_stats() -> dict:
+    """Load time and memory figures for the shared model; empty until it is loaded."""
+    return dict(_stats, loaded=_model is not None)
@@ -0,0 +1,129 @@
+# hybrid_retriever.py
+import os
+import re
+import logging
+from .vector_index import search
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Retrieval settings
+HYBRID_TOP_K = int(os.getenv("HYBRID_TOP_K", "8"))
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "50"))
+RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+
+TERM_PATTERN = re.compile(r"\w+")
+VALUE_PATTERN = r"""(?P<op>=|:|\bis\b|\bequals\b)?\s*(?P<quote>['"]?)(?P<value>[\w\-.:/]+)(?P=quote)"""
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "do", "does", "for", "from", "how", "i", "in",
+    "is", "it", "me", "many", "much", "of", "on", "or", "show", "tell", "that", "the", "to", "was",
+    "what", "when", "where", "which", "who", "why", "with",
+}
+
+def query_terms(query: str) -> list:
+    """Keyword terms for BM25, without stopwords."""
+    return [term for term in TERM_PATTERN.findall(query.lower()) if term not in STOPWORDS]
+
+def _has_digit(token: str) -> bool:
+    return any(ch.isdigit() for ch in token)
+
+def _looks_like_id(token: str) -> bool:
+    """Mixed letters and digits (S-12, INV001), unlike counts, years and ranks ("top 5", "2024")."""
+    return _has_digit(token) and any(ch.isalpha() for ch in token)
+
+def parse_predicates(query: str, columns: list, primary_key: str = None) -> list:
+    """
+    Extracts (column, value) equality predicates from a question.
+    A column named in the query (e.g. "sensor_id S-12", "region = north", "status is 'open'")
+    yields a predicate when its value is quoted, follows an explicit operator or contains a
+    digit; other id-like tokens, mixing letters and digits, are matched against the primary key.
+    """
+    lowered = query.lower()
+    predicates = []
+    used_values = set()
+    for column in columns:
+        names = {str(column).lower(), str(column).lower().replace('_', ' ')}
+        for name in names:
+            for match in re.finditer(rf"\b{re.escape(name)}\b\s*{VALUE_PATTERN}", lowered):
+                value = match.group('value').strip('.:')
+                if value and (match.group('quote') or match.group('op') or _has_digit(value)):
+                    predicates.append((column, value))
+                    used_values.add(value)
+    if primary_key:
+        for token in re.findall(r"[\w\-]+", lowered):
+            if _looks_like_id(token) and token not in used_values:
+                predicates.append((primary_key, token))
+    return predicates
+
+def key_hints(query: str, primary_key: str, predicates: list) -> list:
+    """
+    Bare numbers in a question as possible primary key values. They may just as well be
+    counts or years, so matching rows only raise the ranking and never restrict it.
+    """
+    if not primary_key:
+        return []
+    used_values = {value for _, value in predicates}
+    return [
+        (primary_key, token) for token in re.findall(r"\b\d+\b", query.lower())
+        if token not in used_values
+    ]
+
+def reciprocal_rank_fusion(rankings: list) -> list:
+    """Fuses ranked id lists by summing 1 / (RRF_K + rank) per list."""
+    scores = {}
+    for ranking in rankings:
+        for rank, row_id in enumerate(ranking):
+            scores[row_id] = scores.get(row_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+def hybrid_candidates(index, store, query: str, query_embedding) -> tuple:
+    """
+    Retrieves candidate row ids for a question by fusing dense FAISS results with BM25 keyword
+    hits. Column predicates parsed from the question are pushed down to the row store; when
+    they match rows, results are restricted to those rows. Rows whose primary key equals a
+    bare number in the question are boosted.
+    Returns (ranked row ids, {row id: dense L2 distance}, ids matching the predicates).
+    """
+    params = store.meta.get('index', {})
+    distances, dense = search(index, params, query_embedding, HYBRID_CANDIDATES, store.fetch_vectors)
+    return fuse_candidates(store, query, distances[0], dense[0])
+
+def hybrid_candidates_batch(index, store, queries: list, query_embeddings) -> list:
+    """hybrid_candidates for many queries on one dataset, with a single matrix search."""
+    params = store.meta.get('index', {})
+    distances, dense = search(index, params, query_embeddings, HYBRID_CANDIDATES, store.fetch_vectors)
+    return [fuse_candidates(store, query, distances[row], dense[row]) for row, query in enumerate(queries)]
+
+def fuse_candidates(store, query: str, distances, dense) -> tuple:
+    """Fuses one query's dense search results with its keyword and predicate hits."""
+    # Chunk hits are expanded into their rows, in chunk order, each taking its chunk's distance
+    hits = [(int(i), float(distance)) for i, distance in zip(dense, distances) if i >= 0]
+    members = store.members([i for i, _ in hits])
+    dense_ids, dense_distances = [], {}
+    for vector_id, distance in hits:
+        for row_id in members.get(vector_id, []):
+            dense_ids.append(row_id)
+            dense_distances.setdefault(row_id, distance)
+    keyword_ids = store.keyword_search(query_terms(query), HYBRID_CANDIDATES)
+
+    predicates = parse_predicates(query, store.meta.get('columns', []), store.meta.get('primary_key'))
+    filter_ids = store.filter_ids(predicates, HYBRID_CANDIDATES) if predicates else []
+    if filter_ids:
+        allowed = set(filter_ids)
+        rankings = [filter_ids, [i for i in dense_ids if i in allowed], [i for i in keyword_ids if i in allowed]]
+    else:
+        hints = key_hints(query, store.meta.get('primary_key'), predicates)
+        boost_ids = store.filter_ids(hints, HYBRID_CANDIDATES) if hints else []
+        rankings = [dense_ids, keyword_ids] + ([boost_ids] if boost_ids else [])
+
+    ranked = reciprocal_rank_fusion(rankings)
+    logger.debug(
+        f"Hybrid retrieval: {len(dense_ids)} dense, {len(keyword_ids)} keyword, "
+        f"{len(filter_ids)} filtered by {predicates}, {len(ranked)} fused"
+    )
+    return ranked, dense_distances, filter_ids
+
+def hybrid_search(index, store, query: str, query_embedding, k: int = HYBRID_TOP_K) -> list:
+    """Returns the top k row ids from hybrid_candidates."""
+    ranked, _, _ = hybrid_candidates(index, store, query, query_embedding)
+    return ranked[:k]
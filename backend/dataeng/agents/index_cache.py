@@ -0,0 +1,126 @@
+# index_cache.py
+import os
+import logging
+import threading
+from collections import OrderedDict
+from .vector_index import read_index
+from .row_store import RowStore, migrate_pickle
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Paths
+VECTOR_DB_DIR = "vector_db"
+
+# Cache settings
+INDEX_CACHE_MAX_BYTES = int(os.getenv("INDEX_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+INDEX_CACHE_MMAP = os.getenv("INDEX_CACHE_MMAP", "1") == "1"
+
+def index_paths(filename: str) -> tuple:
+    """Returns the FAISS index and row store paths for a dataset file name."""
+    name = os.path.splitext(filename)[0]
+    return (
+        os.path.join(VECTOR_DB_DIR, f"{name}_index.faiss"),
+        os.path.join(VECTOR_DB_DIR, f"{name}_rows.sqlite3"),
+    )
+
+def legacy_metadata_path(filename: str) -> str:
+    """Returns the path of the pickled metadata written by older versions."""
+    return os.path.join(VECTOR_DB_DIR, f"{os.path.splitext(filename)[0]}_metadata.pkl")
+
+_migration_lock = threading.Lock()
+
+def ensure_row_store(filename: str) -> bool:
+    """Migrates a legacy pickled metadata file to a row store if needed; returns whether a store exists."""
+    _, rows_path = index_paths(filename)
+    if os.path.exists(rows_path):
+        return True
+    with _migration_lock:
+        metadata_path = legacy_metadata_path(filename)
+        if not os.path.exists(rows_path) and os.path.exists(metadata_path):
+            migrate_pickle(metadata_path, rows_path)
+    return os.path.exists(rows_path)
+
+def _signature(path: str) -> tuple:
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def dataset_signature(filename: str) -> tuple:
+    """(mtime, size) of a dataset's index and row store; changes whenever either is rewritten."""
+    vector_db_path, rows_path = index_paths(filename)
+    return (_signature(vector_db_path), _signature(rows_path))
+
+class IndexCache:
+    """
+    Process-level LRU cache of loaded FAISS indexes and their row stores.
+    Entries are evicted least-recently-used first once their combined size passes max_bytes,
+    and reloaded whenever the files on disk change (mtime/size), e.g. after create_embeddings
+    rewrites an index. With use_mmap, IVF inverted lists are memory-mapped so worker processes
+    share pages; only IVF indexes whose lists stay on disk, and the on-disk row stores, are
+    not charged against the budget. Flat and HNSW indexes load fully and are charged in full.
+    """
+
+    def __init__(self, max_bytes: int = INDEX_CACHE_MAX_BYTES, use_mmap: bool = INDEX_CACHE_MMAP):
+        self.max_bytes = max_bytes
+        self.use_mmap = use_mmap
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename: str):
+        """
+        Returns (index, row_store) for a dataset, loading it on a miss or when stale.
+        Legacy pickled metadata is migrated to a row store on first access.
+        Raises FileNotFoundError if the index or metadata is missing.
+        """
+        vector_db_path, rows_path = index_paths(filename)
+        ensure_row_store(filename)
+        signature = dataset_signature(filename)
+        key = os.path.splitext(filename)[0]
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["signature"] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry["index"], entry["store"]
+            self.misses += 1
+
+        store = RowStore(rows_path)
+        index, mmapped = read_index(vector_db_path, store.meta.get('index', {}), mmap=self.use_mmap)
+        size = 0 if mmapped else signature[0][1]
+
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = {"signature": signature, "index": index, "store": store, "bytes": size}
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                evicted_key = next(iter(self._entries))
+                self._pop(evicted_key)
+                logger.debug(f"Evicted {evicted_key} from index cache")
+        logger.debug(f"Loaded {key} into index cache ({size} bytes, mmap={mmapped})")
+        return index, store
+
+    def invalidate(self, filename: str):
+        """Drops a dataset from the cache, e.g. after its index was rewritten."""
+        with self._lock:
+            self._pop(os.path.splitext(filename)[0])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": list(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _pop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= entry["bytes"]
+
+index_cache = IndexCache()
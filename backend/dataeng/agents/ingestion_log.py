@@ -0,0 +1,247 @@
+# ingestion_log.py
+import os
+import re
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: rotation is only serialized within the process
+    fcntl = None
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Paths
+LOG_DIR = "logs/"
+LOG_FILE = os.path.join(LOG_DIR, "ingestion.log")
+LOG_INDEX = os.path.join(LOG_DIR, "ingestion.index.json")
+LOG_LOCK = os.path.join(LOG_DIR, "ingestion.lock")
+
+# Rotation and paging settings. Cursors are byte offsets into the whole log history,
+# counted across rotated segments, so a cursor stays valid after the file rotates.
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+LOG_MAX_SEGMENTS = int(os.getenv("LOG_MAX_SEGMENTS", "20"))
+LOG_PAGE_SIZE = int(os.getenv("LOG_PAGE_SIZE", "200"))
+LOG_SCAN_BYTES = int(os.getenv("LOG_SCAN_BYTES", str(4 * 1024 * 1024)))
+
+ENTRY_PATTERN = re.compile(r"^(?P<filename>.*?) \| Category: (?P<category>.*?) \| Valid: (?P<valid>\w+) \| Time: (?P<time>.+)$")
+
+_lock = threading.Lock()
+
+@contextmanager
+def _log_lock(shared: bool = False):
+    """
+    flock on LOG_LOCK, shared by every worker process. Writers hold it exclusively around
+    the size check, rotation, index write and append; readers hold it shared so the index
+    and the files it names stay consistent while they read.
+    """
+    os.makedirs(LOG_DIR, exist_ok=True)
+    with open(LOG_LOCK, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def _read_index() -> dict:
+    try:
+        with open(LOG_INDEX, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"segments": [], "next_segment": 1}
+
+def _write_index(index: dict):
+    tmp_path = LOG_INDEX + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, LOG_INDEX)
+
+def _parse_time(value: str):
+    try:
+        return datetime.fromisoformat(value.strip())
+    except (AttributeError, ValueError):
+        return None
+
+def parse_entry(line: str) -> dict:
+    """Splits a summary line into its fields. Lines in another format keep only their text."""
+    match = ENTRY_PATTERN.match(line)
+    if not match:
+        return {"text": line}
+    return {
+        "text": line,
+        "filename": match.group("filename"),
+        "category": match.group("category"),
+        "valid": match.group("valid") == "True",
+        "time": match.group("time"),
+    }
+
+def _rotate(index: dict):
+    """Moves the active file into a numbered segment and records its offsets and time range."""
+    base = index["segments"][-1]["end"] if index["segments"] else 0
+    size = os.path.getsize(LOG_FILE)
+    first_time = last_time = None
+    with open(LOG_FILE, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            entry = parse_entry(line.rstrip("\n"))
+            if "time" in entry:
+                first_time = first_time or entry["time"]
+                last_time = entry["time"]
+    name = f"ingestion.{index['next_segment']}.log"
+    os.replace(LOG_FILE, os.path.join(LOG_DIR, name))
+    index["segments"].append({"name": name, "start": base, "end": base + size, "first_time": first_time, "last_time": last_time})
+    index["next_segment"] += 1
+    while len(index["segments"]) > LOG_MAX_SEGMENTS:
+        dropped = index["segments"].pop(0)
+        try:
+            os.remove(os.path.join(LOG_DIR, dropped["name"]))
+        except OSError:
+            pass
+    _write_index(index)
+    logger.info(f"Rotated {LOG_FILE} into {name} at offset {base + size}")
+
+def append_entry(line: str):
+    """
+    Appends one line to the ingestion log, rotating the file once it exceeds LOG_MAX_BYTES.
+    The index is re-read under the lock, as another worker may have just rotated.
+    """
+    with _lock, _log_lock():
+        if os.path.exists(LOG_FILE) and os.path.getsize(LOG_FILE) >= LOG_MAX_BYTES:
+            _rotate(_read_index())
+        with open(LOG_FILE, "a", encoding='utf-8') as f:
+            f.write(line.rstrip("\n") + "\n")
+
+def _complete_end(path: str) -> int:
+    """Size of the file up to its last newline, leaving out a line that is still being written."""
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if size == 0:
+        return 0
+    with open(path, 'rb') as f:
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return size
+        f.seek(max(0, size - 64 * 1024))
+        data = f.read()
+    return size - len(data) + data.rfind(b"\n") + 1
+
+def _segments() -> list:
+    """Rotated segments followed by the active file, each with its global start and end offsets."""
+    index = _read_index()
+    segments = [dict(segment, path=os.path.join(LOG_DIR, segment["name"])) for segment in index["segments"]]
+    base = segments[-1]["end"] if segments else 0
+    segments.append({"name": os.path.basename(LOG_FILE), "path": LOG_FILE, "start": base,
+                     "end": base + _complete_end(LOG_FILE), "first_time": None, "last_time": None})
+    return segments
+
+def _outside(segment: dict, since, until) -> bool:
+    """True when the segment's recorded time range cannot contain matching entries."""
+    last_time, first_time = _parse_time(segment.get("last_time")), _parse_time(segment.get("first_time"))
+    return bool((since and last_time and last_time < since) or (until and first_time and first_time > until))
+
+def _matches(entry: dict, filename: str, category: str, since, until) -> bool:
+    if filename and filename.lower() not in entry.get("filename", "").lower():
+        return False
+    if category and entry.get("category", "").lower() != category.lower():
+        return False
+    if since or until:
+        entry_time = _parse_time(entry.get("time"))
+        if entry_time is None or (since and entry_time < since) or (until and entry_time > until):
+            return False
+    return True
+
+def read_forward(offset: int, limit: int = LOG_PAGE_SIZE, filename: str = "", category: str = "", since=None, until=None) -> dict:
+    """
+    Returns complete lines written at or after the global byte offset, oldest first, and
+    the offset to pass on the next poll. A partly written last line is left for that poll.
+    Offsets older than the retained segments start at the oldest one.
+    """
+    with _log_lock(shared=True):
+        return _read_forward(offset, limit, filename, category, since, until)
+
+def _read_forward(offset: int, limit: int, filename: str, category: str, since, until) -> dict:
+    segments = _segments()
+    offset = max(offset, segments[0]["start"])
+    entries, scanned, position = [], 0, offset
+    for segment in segments:
+        if segment["end"] <= position or _outside(segment, since, until):
+            position = max(position, segment["end"])
+            continue
+        with open(segment["path"], 'rb') as f:
+            f.seek(position - segment["start"])
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break
+                line_offset = position
+                position += len(raw)
+                scanned += len(raw)
+                entry = parse_entry(raw.decode('utf-8', errors='replace').rstrip("\n"))
+                if _matches(entry, filename, category, since, until):
+                    entries.append(dict(entry, offset=line_offset))
+                if len(entries) >= limit or scanned >= LOG_SCAN_BYTES:
+                    break
+        if len(entries) >= limit or scanned >= LOG_SCAN_BYTES or position < segment["end"]:
+            break
+    end = segments[-1]["end"]
+    return {"entries": entries, "next_offset": position, "end_offset": end, "has_more": position < end}
+
+def _lines_backward(path: str, end: int, block: int = 64 * 1024):
+    """Yields (offset, line) for the lines in the first end bytes of a file, newest first."""
+    with open(path, 'rb') as f:
+        remainder, position = b"", end
+        while position > 0:
+            size = min(block, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + remainder).split(b"\n")
+            # The first piece may continue in the previous block
+            remainder = lines.pop(0)
+            line_offset = position + len(remainder) + 1
+            located = []
+            for line in lines:
+                located.append((line_offset, line))
+                line_offset += len(line) + 1
+            for line_offset, line in reversed(located):
+                if line:
+                    yield line_offset, line
+        if remainder:
+            yield 0, remainder
+
+def read_backward(before: int = None, limit: int = LOG_PAGE_SIZE, filename: str = "", category: str = "", since=None, until=None) -> dict:
+    """
+    Returns the newest lines that start before the global byte offset (the end of the log
+    when omitted), in file order, with the cursor for the previous page and the offset
+    to tail from.
+    """
+    with _log_lock(shared=True):
+        return _read_backward(before, limit, filename, category, since, until)
+
+def _read_backward(before: int, limit: int, filename: str, category: str, since, until) -> dict:
+    segments = _segments()
+    end = segments[-1]["end"]
+    before = end if before is None else min(before, end)
+    entries, scanned, cursor = [], 0, segments[0]["start"]
+    for segment in reversed(segments):
+        if segment["start"] >= before:
+            continue
+        cursor = segment["start"]
+        if _outside(segment, since, until):
+            continue
+        for line_offset, raw in _lines_backward(segment["path"], min(before, segment["end"]) - segment["start"]):
+            scanned += len(raw) + 1
+            entry = parse_entry(raw.decode('utf-8', errors='replace'))
+            if _matches(entry, filename, category, since, until):
+                entries.append(dict(entry, offset=segment["start"] + line_offset))
+            if len(entries) >= limit or scanned >= LOG_SCAN_BYTES:
+                cursor = segment["start"] + line_offset
+                break
+        if len(entries) >= limit or scanned >= LOG_SCAN_BYTES:
+            break
+    entries.reverse()
+    return {"entries": entries, "before": cursor, "next_offset": end, "end_offset": end,
+            "has_more": cursor > segments[0]["start"]}
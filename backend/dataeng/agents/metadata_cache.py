@@ -0,0 +1,59 @@
+# metadata_cache.py
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Cache settings
+METADATA_CACHE_TTL = float(os.getenv("METADATA_CACHE_TTL", "30"))
+
+class MetadataCache:
+    """
+    Process-level TTL cache for database, collection and schema listings, keyed by tuples
+    such as ("collections", db_name). Each value carries an ETag derived from its content.
+    Writers in this process invalidate entries directly; other worker processes see the
+    change once the TTL expires.
+    """
+
+    def __init__(self, ttl: float = METADATA_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        """Returns (value, etag) for a fresh entry, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires"] > time.monotonic():
+                self.hits += 1
+                return entry["value"], entry["etag"]
+            self.misses += 1
+            return None
+
+    def set(self, key: tuple, value) -> tuple:
+        """Stores a freshly loaded value and returns (value, etag)."""
+        digest = hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        etag = f'"{digest}"'
+        with self._lock:
+            self._entries[key] = {"value": value, "etag": etag, "expires": time.monotonic() + self.ttl}
+        return value, etag
+
+    def invalidate(self, *prefix):
+        """Drops every entry whose key starts with prefix, e.g. ("schemas", db_name)."""
+        with self._lock:
+            for key in [key for key in self._entries if key[:len(prefix)] == prefix]:
+                del self._entries[key]
+        logger.debug(f"Invalidated metadata cache entries for {prefix}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "ttl": self.ttl, "hits": self.hits, "misses": self.misses}
+
+metadata_cache = MetadataCache()
@@ -0,0 +1,182 @@
+# profiling.py
+import io
+import os
+import json
+import time
+import pstats
+import fnmatch
+import cProfile
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Paths
+PROFILE_DIR = "profiles"
+
+# Profiling settings. PROFILE_JOBS lists file name patterns (e.g. "sales_*.csv") whose
+# uploads are always profiled, without a per-request switch.
+PROFILE_JOBS = [pattern.strip() for pattern in os.getenv("PROFILE_JOBS", "").split(",") if pattern.strip()]
+PROFILE_TOP_FUNCTIONS = int(os.getenv("PROFILE_TOP_FUNCTIONS", "40"))
+PROFILE_TOP_ALLOCATIONS = int(os.getenv("PROFILE_TOP_ALLOCATIONS", "10"))
+
+# cProfile and tracemalloc are process-wide, so one profiled job runs at a time
+_session_lock = threading.Lock()
+
+# Pipeline jobs running in this worker, and whether one of them is being profiled
+_jobs_lock = threading.Lock()
+_running_jobs = 0
+_profiling = False
+
+class WorkerBusy(Exception):
+    """A pipeline job arrived while another job is being profiled in this worker."""
+
+def job_profiling_enabled(filename: str) -> bool:
+    """True when the file name matches one of the PROFILE_JOBS patterns."""
+    return any(fnmatch.fnmatch(filename, pattern) for pattern in PROFILE_JOBS)
+
+class JobSlot:
+    """A pipeline job admitted by admit_job; leaving its with block releases the slot."""
+
+    def __init__(self, profiled: bool):
+        self.profiled = profiled
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        global _running_jobs, _profiling
+        with _jobs_lock:
+            _running_jobs -= 1
+            if self.profiled:
+                _profiling = False
+        return False
+
+def admit_job(job_name: str, profile: bool) -> JobSlot:
+    """
+    Admits a pipeline job to this worker. tracemalloc measures the whole process, so a job
+    is only profiled (slot.profiled) when no other job is running here, and while it runs,
+    other jobs raise WorkerBusy rather than adding their allocations to its figures.
+    Requests that are not pipeline jobs, such as queries, are not held back and still count.
+    """
+    global _running_jobs, _profiling
+    with _jobs_lock:
+        if _profiling:
+            raise WorkerBusy(f"A job is being profiled in this worker, retry {job_name} later")
+        profiled = profile and _running_jobs == 0
+        if profile and not profiled:
+            logger.warning(f"Other jobs are running, running {job_name} without profiling")
+        _running_jobs += 1
+        _profiling = profiled
+    return JobSlot(profiled)
+
+class ProfileSession:
+    """
+    CPU profile (cProfile) and memory timeline (tracemalloc) of one pipeline run. The
+    trace calls span_finished() at every stage boundary, which records current memory,
+    the peak since the previous boundary and the lines that allocated most in between.
+    """
+
+    def __init__(self, job_name: str, trace_id: str):
+        stem = os.path.splitext(os.path.basename(job_name))[0]
+        self.directory = os.path.join(PROFILE_DIR, f"{stem}_{trace_id[:12]}")
+        self.boundaries = []
+        self._profiler = cProfile.Profile()
+        self._owns_tracemalloc = False
+        self._snapshot = None
+        self._start = None
+
+    def _take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._owns_tracemalloc = True
+        tracemalloc.reset_peak()
+        self._snapshot = self._take_snapshot()
+        self._start = time.perf_counter()
+        self._profiler.enable()
+
+    def span_finished(self, span):
+        # Snapshots are not part of the job, so keep them out of the CPU profile
+        self._profiler.disable()
+        try:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            snapshot = self._take_snapshot()
+            growth = snapshot.compare_to(self._snapshot, 'lineno')[:PROFILE_TOP_ALLOCATIONS]
+            self._snapshot = snapshot
+            self.boundaries.append({
+                "stage": span.name,
+                "parent": span.parent,
+                "elapsed_seconds": round(time.perf_counter() - self._start, 4),
+                "stage_seconds": round(span.duration, 4),
+                "current_mb": round(current / (1024 * 1024), 2),
+                "peak_since_previous_mb": round(peak / (1024 * 1024), 2),
+                "top_allocations": [
+                    {"line": str(stat.traceback[0]), "size_diff_kb": round(stat.size_diff / 1024, 1), "count_diff": stat.count_diff}
+                    for stat in growth
+                ],
+            })
+        finally:
+            self._profiler.enable()
+
+    def stop(self):
+        self._profiler.disable()
+        current, peak = tracemalloc.get_traced_memory()
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Binary stats for snakeviz or pstats, plus readable top lists
+        self._profiler.dump_stats(os.path.join(self.directory, "cpu.prof"))
+        text = io.StringIO()
+        for sort_key in ("cumulative", "tottime"):
+            text.write(f"=== Top {PROFILE_TOP_FUNCTIONS} functions by {sort_key} time ===\n")
+            pstats.Stats(self._profiler, stream=text).strip_dirs().sort_stats(sort_key).print_stats(PROFILE_TOP_FUNCTIONS)
+        with open(os.path.join(self.directory, "cpu.txt"), "w", encoding="utf-8") as f:
+            f.write(text.getvalue())
+
+        with open(os.path.join(self.directory, "memory.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "total_seconds": round(time.perf_counter() - self._start, 4),
+                "final_current_mb": round(current / (1024 * 1024), 2),
+                "final_peak_since_previous_mb": round(peak / (1024 * 1024), 2),
+                "max_peak_mb": max([b["peak_since_previous_mb"] for b in self.boundaries] + [round(peak / (1024 * 1024), 2)]),
+                "boundaries": self.boundaries,
+            }, f, indent=2)
+        logger.info(f"Saved profile to {self.directory}")
+
+@contextmanager
+def profile_session(job_name: str, trace, enabled: bool = True):
+    """
+    Profiles the block and attaches the session to the trace, so every span end is a
+    memory boundary. Yields None when disabled or when another job is being profiled.
+    """
+    if not enabled:
+        yield None
+        return
+    if not _session_lock.acquire(blocking=False):
+        logger.warning(f"Another job is being profiled, running {job_name} without profiling")
+        yield None
+        return
+    session = ProfileSession(job_name, trace.trace_id)
+    try:
+        trace.profiler = session
+        session.start()
+        yield session
+    finally:
+        trace.profiler = None
+        try:
+            session.stop()
+        except Exception as e:
+            logger.error(f"Failed to save profile for {job_name}: {str(e)}")
+        finally:
+            _session_lock.release()
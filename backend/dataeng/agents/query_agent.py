@@ -1,79 +1,409 @@
 # query_agent.py
 import os
+import time
+import asyncio
 import logging
-import faiss
-import numpy as np
-from sentence_transformers import SentenceTransformer
+from concurrent.futures import ThreadPoolExecutor
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI
-import pickle
+from .embedder import encode
+from .aggregate_agent import is_analytical, answer_aggregate, aanswer_aggregate
+from .answer_cache import answer_cache, query_specifics, ANSWER_CACHE_ENABLED
+from .hybrid_retriever import hybrid_candidates, hybrid_candidates_batch
+from .context_builder import build_context, CONTEXT_MAX_K
+from .sharded_search import list_shards, sharded_search, shards_signature, shard_sources, merged_meta, MergedRows
+from .index_cache import index_cache, index_paths, ensure_row_store, dataset_signature
 
 # Setup logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Paths
-VECTOR_DB_DIR = "vector_db"
+# Batch query settings
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "8"))
+# Sharded queries run an aggregate pipeline per shard up to this many shards
+SHARD_AGGREGATE_MAX = int(os.getenv("SHARD_AGGREGATE_MAX", "8"))
 
-# Initialize SentenceTransformer model
-try:
-    embedder = SentenceTransformer('all-MiniLM-L6-v2')
-except Exception as e:
-    logger.error(f"Failed to load SentenceTransformer model: {str(e)}")
-    raise
+def _answer_chain():
+    llm = ChatGoogleGenerativeAI(
+        model="gemini-2.0-flash",
+        temperature=0.7,
+        google_api_key=os.getenv("GOOGLE_API_KEY")
+    )
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", """
+        You are a helpful chatbot that answers user queries based on provided data context.
+        Use the following context to answer the query concisely and accurately:
+        {context}
+        If the context is insufficient, say so and provide a general answer if possible.
+        Return the answer as plain text, no markdown or extra formatting.
+        """),
+        ("human", "Query: {query}")
+    ])
+    return prompt | llm
+
+def generate_answer(query: str, context: str) -> str:
+    """Has the LLM answer a query from the retrieved context."""
+    response = _answer_chain().invoke({"query": query, "context": context})
+    logger.info(f"Generated response: {response.content}")
+    return response.content
+
+def _sample_rows(store) -> list:
+    """A few rows showing the LLM what the data looks like."""
+    return [text for _, text in zip(range(3), store.iter_rows())]
+
+def aggregate_answer(query: str, store) -> str:
+    """
+    Answers aggregate questions by a pipeline over the full transformed collection, since a
+    handful of retrieved rows cannot give totals or averages. None for other questions.
+    """
+    if not is_analytical(query):
+        return None
+    answer = answer_aggregate(query, store.meta, _sample_rows(store))
+    if answer is not None:
+        logger.info(f"Generated aggregate response: {answer}")
+    return answer
+
+async def aaggregate_answer(query: str, store) -> str:
+    """Async variant of aggregate_answer; only the row store read runs in a worker thread."""
+    if not is_analytical(query):
+        return None
+    sample_rows = await asyncio.to_thread(_sample_rows, store)
+    answer = await aanswer_aggregate(query, store.meta, sample_rows)
+    if answer is not None:
+        logger.info(f"Generated aggregate response: {answer}")
+    return answer
+
+def retrieve_context(query: str, index, store, query_embedding) -> str:
+    """
+    Fuses dense, keyword and column-filter hits, then compresses the candidates into a
+    context of adaptive size within the token budget.
+    """
+    ranked, distances, exact_ids = hybrid_candidates(index, store, query, query_embedding)
+    context, _ = build_context(query, store, ranked, distances, exact_ids)
+    logger.debug(f"Context (first 1000 chars): {context[:1000]}")
+    return context
+
+def open_dataset(filename: str) -> tuple:
+    """
+    Returns the (index, store) of a dataset from the index cache.
+    Raises FileNotFoundError when the dataset has no vector DB.
+    """
+    vector_db_path, rows_path = index_paths(filename)
+    logger.debug(f"Loading FAISS index: {vector_db_path}, rows: {rows_path}")
+    if not os.path.exists(vector_db_path) or not ensure_row_store(filename):
+        logger.error(f"Vector DB or metadata not found for {filename}")
+        raise FileNotFoundError(f"Vector DB not found for {filename}")
+    return index_cache.get(filename)
+
+def _cached_query(query: str, cache_key: str, signature, query_embedding, meta: dict) -> dict:
+    """Starts the prepared dict of a query, with its answer when the answer cache has one."""
+    prepared = {"filename": cache_key, "signature": signature, "embedding": query_embedding[0],
+                "specifics": query_specifics(query, meta), "answer": None, "context": None, "source": "cache"}
+    if ANSWER_CACHE_ENABLED:
+        prepared["answer"] = answer_cache.lookup(cache_key, signature, query_embedding[0], prepared["specifics"])
+        if prepared["answer"] is not None:
+            logger.info(f"Served cached response for '{query}'")
+    return prepared
+
+def load_query(query: str, filename: str) -> tuple:
+    """
+    Loads the dataset, encodes the query and looks it up in the answer cache.
+    Returns (prepared, index, store, query_embedding); see prepare_query for prepared.
+    Raises FileNotFoundError when the dataset has no vector DB.
+    """
+    # FAISS index and row store are cached across queries
+    index, store = open_dataset(filename)
+    query_embedding = encode([query])
+    prepared = _cached_query(query, filename, dataset_signature(filename), query_embedding, store.meta)
+    return prepared, index, store, query_embedding
+
+def prepare_query(query: str, filename: str) -> dict:
+    """
+    Runs everything before generation for a query: loads the dataset, encodes the query and
+    either finds an answer (answer cache or aggregate pipeline) or builds the RAG context.
+    Returns a dict with the answer or context, its source and what the answer cache needs.
+    Raises FileNotFoundError when the dataset has no vector DB.
+    """
+    prepared, index, store, query_embedding = load_query(query, filename)
+    if prepared["answer"] is not None:
+        return prepared
+    prepared["answer"] = aggregate_answer(query, store)
+    if prepared["answer"] is not None:
+        prepared["source"] = "aggregate"
+        return prepared
+    prepared["context"] = retrieve_context(query, index, store, query_embedding)
+    prepared["source"] = "rag"
+    return prepared
+
+def remember_answer(query: str, prepared: dict, answer: str, seconds: float):
+    """Adds a freshly produced answer to the answer cache."""
+    if ANSWER_CACHE_ENABLED and prepared["source"] != "cache":
+        answer_cache.store(prepared["filename"], prepared["signature"], query, prepared["embedding"], answer, seconds,
+                           prepared["specifics"])
 
 def process_query(query: str, filename: str) -> str:
     """
     Processes a user query by searching the FAISS vector database and generating a response using the LLM.
+    Answers to semantically equivalent earlier queries on the same index are served from the answer cache.
     Returns the response as a string.
     """
     logger.debug(f"Processing query '{query}' for {filename}")
+    start_time = time.time()
     try:
-        # Load FAISS index and metadata
-        vector_db_path = os.path.join(VECTOR_DB_DIR, f"{os.path.splitext(filename)[0]}_index.faiss")
-        metadata_path = os.path.join(VECTOR_DB_DIR, f"{os.path.splitext(filename)[0]}_metadata.pkl")
-        logger.debug(f"Loading FAISS index: {vector_db_path}, metadata: {metadata_path}")
-        if not os.path.exists(vector_db_path) or not os.path.exists(metadata_path):
-            logger.error(f"Vector DB or metadata not found for {filename}")
-            return f"Error: Vector DB not found for {filename}"
-
-        index = faiss.read_index(vector_db_path)
-        with open(metadata_path, 'rb') as f:
-            metadata = pickle.load(f)
-        texts = metadata['texts']
-        logger.debug(f"Metadata texts (first 1000 chars): {''.join(texts)[:1000]}")
-
-        # Encode query
-        query_embedding = embedder.encode([query], show_progress_bar=False)
-        query_embedding = np.array(query_embedding, dtype='float32')
-
-        # Search FAISS index
-        k = 20  # Number of nearest neighbors
-        distances, indices = index.search(query_embedding, k)
-        retrieved_texts = [texts[i] for i in indices[0]]
-        context = "\n".join(retrieved_texts)
-        logger.debug(f"Retrieved context (first 1000 chars): {context[:1000]}")
-
-        # Generate response using LLM
-        llm = ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash",
-            temperature=0.7,
-            google_api_key=os.getenv("GOOGLE_API_KEY")
-        )
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", """
-            You are a helpful chatbot that answers user queries based on provided data context.
-            Use the following context to answer the query concisely and accurately:
-            {context}
-            If the context is insufficient, say so and provide a general answer if possible.
-            Return the answer as plain text, no markdown or extra formatting.
-            """),
-            ("human", "Query: {query}")
-        ])
-        chain = prompt | llm
-        response = chain.invoke({"query": query, "context": context})
-        logger.info(f"Generated response: {response.content}")
-        return response.content
+        prepared = prepare_query(query, filename)
+        answer = prepared["answer"]
+        if answer is None:
+            answer = generate_answer(query, prepared["context"])
+        remember_answer(query, prepared, answer, time.time() - start_time)
+        return answer
     except Exception as e:
         logger.error(f"Error processing query for {filename}: {str(e)}")
-        return f"Error: {str(e)}"
\ No newline at end of file
+        return f"Error: {str(e)}"
+
+async def aprepare_query(query: str, filename: str) -> dict:
+    """
+    Async variant of prepare_query. Retrieval (FAISS, embedding, SQLite) runs in worker
+    threads, while aggregate queries go through Motor, so the event loop is never blocked.
+    """
+    prepared, index, store, query_embedding = await asyncio.to_thread(load_query, query, filename)
+    if prepared["answer"] is not None:
+        return prepared
+    prepared["answer"] = await aaggregate_answer(query, store)
+    if prepared["answer"] is not None:
+        prepared["source"] = "aggregate"
+        return prepared
+    prepared["context"] = await asyncio.to_thread(retrieve_context, query, index, store, query_embedding)
+    prepared["source"] = "rag"
+    return prepared
+
+async def aprocess_query(query: str, filename: str) -> str:
+    """
+    Async variant of process_query for ASGI views; see aprepare_query. Every LLM call is
+    awaited.
+    """
+    logger.debug(f"Processing async query '{query}' for {filename}")
+    start_time = time.time()
+    try:
+        prepared = await aprepare_query(query, filename)
+        answer = prepared["answer"]
+        if answer is None:
+            response = await _answer_chain().ainvoke({"query": query, "context": prepared["context"]})
+            answer = response.content
+            logger.info(f"Generated response: {answer}")
+        remember_answer(query, prepared, answer, time.time() - start_time)
+        return answer
+    except Exception as e:
+        logger.error(f"Error processing query for {filename}: {str(e)}")
+        return f"Error: {str(e)}"
+
+def stream_query(query: str, filename: str):
+    """
+    Streaming variant of process_query. Yields ("token", text) events as the LLM produces
+    them, then one ("metadata", timings) event; failures yield ("error", message).
+    Cached and aggregate answers arrive as a single token event.
+    """
+    logger.debug(f"Streaming query '{query}' for {filename}")
+    start_time = time.time()
+    timings = {}
+    try:
+        prepared = prepare_query(query, filename)
+        retrieval_end = time.time()
+        timings["retrieval_seconds"] = round(retrieval_end - start_time, 3)
+        answer = prepared["answer"]
+        if answer is not None:
+            yield "token", answer
+        else:
+            parts = []
+            for chunk in _answer_chain().stream({"query": query, "context": prepared["context"]}):
+                if not chunk.content:
+                    continue
+                if not parts:
+                    timings["first_token_seconds"] = round(time.time() - start_time, 3)
+                parts.append(chunk.content)
+                yield "token", chunk.content
+            answer = "".join(parts)
+            timings["llm_seconds"] = round(time.time() - retrieval_end, 3)
+            logger.info(f"Streamed response: {answer}")
+
+        remember_answer(query, prepared, answer, time.time() - start_time)
+        timings["total_seconds"] = round(time.time() - start_time, 3)
+        yield "metadata", dict(timings, source=prepared["source"])
+    except Exception as e:
+        logger.error(f"Error streaming query for {filename}: {str(e)}")
+        yield "error", f"Error: {str(e)}"
+
+async def astream_query(query: str, filename: str):
+    """Async variant of stream_query for ASGI views, yielding the same events."""
+    logger.debug(f"Streaming async query '{query}' for {filename}")
+    start_time = time.time()
+    timings = {}
+    try:
+        prepared = await aprepare_query(query, filename)
+        retrieval_end = time.time()
+        timings["retrieval_seconds"] = round(retrieval_end - start_time, 3)
+        answer = prepared["answer"]
+        if answer is not None:
+            yield "token", answer
+        else:
+            parts = []
+            async for chunk in _answer_chain().astream({"query": query, "context": prepared["context"]}):
+                if not chunk.content:
+                    continue
+                if not parts:
+                    timings["first_token_seconds"] = round(time.time() - start_time, 3)
+                parts.append(chunk.content)
+                yield "token", chunk.content
+            answer = "".join(parts)
+            timings["llm_seconds"] = round(time.time() - retrieval_end, 3)
+            logger.info(f"Streamed response: {answer}")
+
+        remember_answer(query, prepared, answer, time.time() - start_time)
+        timings["total_seconds"] = round(time.time() - start_time, 3)
+        yield "metadata", dict(timings, source=prepared["source"])
+    except Exception as e:
+        logger.error(f"Error streaming query for {filename}: {str(e)}")
+        yield "error", f"Error: {str(e)}"
+
+def process_batch(items: list) -> list:
+    """
+    Answers many {"query", "filename"} items at once: all queries are encoded in one batch,
+    each file's index is searched once with the matrix of its queries, and the LLM calls are
+    fanned out over BATCH_LLM_CONCURRENCY threads.
+    Returns one {"query", "filename", "response"} or {..., "error"} result per item, in order.
+    """
+    logger.debug(f"Processing batch of {len(items)} queries")
+    start_time = time.time()
+    results = [{"query": item["query"], "filename": item["filename"]} for item in items]
+    embeddings = encode([item["query"] for item in items])
+
+    # Per file: cached answers, aggregate answers, then one matrix search for the rest
+    jobs = []
+    specifics = {}
+    by_file = {}
+    for position, item in enumerate(items):
+        by_file.setdefault(item["filename"], []).append(position)
+    for filename, positions in by_file.items():
+        try:
+            index, store = open_dataset(filename)
+            signature = dataset_signature(filename)
+        except Exception as e:
+            logger.error(f"Batch query failed for {filename}: {str(e)}")
+            for position in positions:
+                results[position]["error"] = f"Error: {str(e)}"
+            continue
+
+        pending = []
+        for position in positions:
+            specifics[position] = query_specifics(items[position]["query"], store.meta)
+            cached = answer_cache.lookup(filename, signature, embeddings[position], specifics[position]) if ANSWER_CACHE_ENABLED else None
+            if cached is not None:
+                results[position]["response"] = cached
+            else:
+                pending.append(position)
+        if not pending:
+            continue
+        try:
+            candidates = hybrid_candidates_batch(index, store, [items[p]["query"] for p in pending], embeddings[pending])
+        except Exception as e:
+            logger.error(f"Batch retrieval failed for {filename}: {str(e)}")
+            for position in pending:
+                results[position]["error"] = f"Error: {str(e)}"
+            continue
+        for position, (ranked, distances, exact_ids) in zip(pending, candidates):
+            jobs.append((position, filename, signature, store, ranked, distances, exact_ids))
+
+    def answer(job):
+        position, filename, signature, store, ranked, distances, exact_ids = job
+        query = items[position]["query"]
+        job_start = time.time()
+        try:
+            response = aggregate_answer(query, store)
+            if response is None:
+                context, _ = build_context(query, store, ranked, distances, exact_ids)
+                response = generate_answer(query, context)
+            if ANSWER_CACHE_ENABLED:
+                answer_cache.store(filename, signature, query, embeddings[position], response, time.time() - job_start,
+                                   specifics[position])
+            results[position]["response"] = response
+        except Exception as e:
+            logger.error(f"Batch query '{query}' failed for {filename}: {str(e)}")
+            results[position]["error"] = f"Error: {str(e)}"
+
+    with ThreadPoolExecutor(max_workers=BATCH_LLM_CONCURRENCY) as pool:
+        list(pool.map(answer, jobs))
+    logger.info(f"Processed batch of {len(items)} queries over {len(by_file)} files in {time.time() - start_time:.2f}s")
+    return results
+
+def shard_aggregate_answer(query: str, shards: list) -> str:
+    """
+    aggregate_answer over each shard's own collection, labelled by file when there are
+    several. None unless every shard produced an answer, or past SHARD_AGGREGATE_MAX shards.
+    """
+    if not is_analytical(query) or len(shards) > SHARD_AGGREGATE_MAX:
+        return None
+    stores = [open_dataset(shard)[1] for shard in shards]
+    with ThreadPoolExecutor(max_workers=min(BATCH_LLM_CONCURRENCY, len(shards))) as pool:
+        answers = list(pool.map(lambda store: aggregate_answer(query, store), stores))
+    if any(answer is None for answer in answers):
+        return None
+    if len(answers) == 1:
+        return answers[0]
+    return "\n".join(f"{shard}: {answer}" for shard, answer in zip(shards, answers))
+
+def prepare_shard_query(query: str, category: str = None, db_name: str = None) -> dict:
+    """
+    prepare_query across every dataset index of a category and/or database: the answer
+    cache, then per-shard aggregate pipelines, then a context built from the shards'
+    merged nearest rows. prepared["sources"] gives the provenance of the rows in the
+    context, or of the datasets for cached and aggregate answers.
+    Raises FileNotFoundError when no shard matches.
+    """
+    shards = list_shards(category, db_name)
+    if not shards:
+        logger.error(f"No vector DBs found for category={category}, db_name={db_name}")
+        raise FileNotFoundError(f"No vector DBs found for category={category}, db_name={db_name}")
+
+    meta = merged_meta(shards)
+    query_embedding = encode([query])
+    prepared = _cached_query(query, f"shards:{db_name or '*'}:{category or '*'}", shards_signature(shards),
+                             query_embedding, meta)
+    prepared["sources"] = shard_sources(shards)
+    if prepared["answer"] is not None:
+        return prepared
+    prepared["answer"] = shard_aggregate_answer(query, shards)
+    if prepared["answer"] is not None:
+        prepared["source"] = "aggregate"
+        return prepared
+
+    # Adaptive k, MMR and the token budget choose from the CONTEXT_MAX_K nearest rows
+    results = sharded_search(shards, query_embedding, CONTEXT_MAX_K)
+    rows = MergedRows(results, meta)
+    distances = {(result['filename'], result['row_id']): result['distance'] for result in results}
+    prepared["context"], stats = build_context(query, rows, list(rows.texts), distances, [])
+    logger.debug(f"Retrieved {len(results)} rows from {len(shards)} shards, context (first 1000 chars): {prepared['context'][:1000]}")
+    used = set(stats['row_ids'])
+    prepared["sources"] = [
+        {key: value for key, value in result.items() if key != 'text'}
+        for result in results if (result['filename'], result['row_id']) in used
+    ]
+    prepared["source"] = "rag"
+    return prepared
+
+def process_shard_query(query: str, category: str = None, db_name: str = None):
+    """
+    Answers a query across every dataset index of a category and/or database, searched as
+    shards and merged by distance, the way process_query answers one dataset.
+    Returns (response, sources); see prepare_shard_query for sources.
+    """
+    logger.debug(f"Processing query '{query}' across shards of category={category}, db_name={db_name}")
+    start_time = time.time()
+    try:
+        prepared = prepare_shard_query(query, category, db_name)
+        answer = prepared["answer"]
+        if answer is None:
+            answer = generate_answer(query, prepared["context"])
+        remember_answer(query, prepared, answer, time.time() - start_time)
+        return answer, prepared["sources"]
+    except Exception as e:
+        logger.error(f"Error processing sharded query: {str(e)}")
+        return f"Error: {str(e)}", []
@@ -2,16 +2,23 @@
 import os
 import pandas as pd
 import logging
-import faiss
-import numpy as np
-from sentence_transformers import SentenceTransformer
 from langchain.agents import AgentExecutor, create_openai_functions_agent
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.tools import tool
 from langchain_google_genai import ChatGoogleGenerativeAI
 from pydantic.v1 import BaseModel, Field
-import pickle
 import io
+import re
+import threading
+from collections import defaultdict
+from .embedder import encode
+from .vector_index import build_index, update_index, read_index, write_index, row_id
+from .answer_cache import answer_cache
+from .index_cache import index_cache, index_paths, legacy_metadata_path, ensure_row_store
+from .chunker import parse_chunking, build_chunks
+from .row_store import RowStore, write_row_store, read_digests, apply_row_changes, text_digest
+from .tracing import span, traced
+from . import dataset_registry
 
 # Setup logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -22,21 +29,135 @@ CLEAN_DIR = "transformed_datas"
 VECTOR_DB_DIR = "vector_db"
 os.makedirs(VECTOR_DB_DIR, exist_ok=True)
 
-# Initialize SentenceTransformer model
-try:
-    embedder = SentenceTransformer('all-MiniLM-L6-v2')
-except Exception as e:
-    logger.error(f"Failed to load SentenceTransformer model: {str(e)}")
-    raise
+# Incremental update settings
+COMPACTION_THRESHOLD = float(os.getenv("VECTOR_INDEX_COMPACTION_THRESHOLD", "0.3"))
+MAX_FILTER_INDEXES = 5
+_file_locks = defaultdict(threading.Lock)
+
+def infer_primary_key(columns: list) -> str:
+    """Picks the first id-like column, as the report agent does; None if there is none."""
+    for col in columns:
+        if 'id' in str(col).lower():
+            return col
+    return None
+
+def filter_columns(columns: list, primary_key: str = None) -> list:
+    """Columns worth an expression index for predicate pushdown: the primary key and id-like columns."""
+    id_like = [col for col in columns if re.search(r"id|number|code|\bno\b", str(col).lower())]
+    ordered = ([primary_key] if primary_key in columns else []) + [col for col in id_like if col != primary_key]
+    return ordered[:MAX_FILTER_INDEXES]
+
+def record_ids(df: pd.DataFrame, text_data: list, primary_key: str = None) -> list:
+    """
+    Derives a stable vector id for each row from its primary key value; repeated keys are
+    told apart by occurrence. Without a usable key the row content itself is the key.
+    """
+    if primary_key and primary_key in df.columns:
+        keys = df[primary_key].astype(str)
+    else:
+        keys = pd.Series(text_data, index=df.index)
+    keys = keys + '#' + keys.groupby(keys).cumcount().astype(str)
+    return [row_id(key) for key in keys]
+
+def _update_embeddings(filename: str, rows: list, documents: list, meta: dict, source: dict) -> bool:
+    """
+    Applies only the changed rows and documents (chunks, or rows when unchunked) to an
+    existing ID-mapped index.
+    Returns False when a full rebuild is needed instead (compaction).
+    """
+    vector_db_path, rows_path = index_paths(filename)
+    chunked = meta.get('chunking', 'row') != 'row'
+    stored = read_digests(rows_path)
+    if chunked:
+        stored_documents = read_digests(rows_path, "chunks")
+        document_upserts = [doc for doc in documents if stored_documents.get(doc[0]) != text_digest(doc[1])]
+        document_ids = {doc[0] for doc in documents}
+        document_deletes = [i for i in stored_documents if i not in document_ids]
+        # Rows moved into a new window must point at it even if their text is unchanged
+        changed_chunks = {doc[0] for doc in document_upserts}
+        upserts = [row for row in rows if stored.get(row[0]) != text_digest(row[1]) or row[3] in changed_chunks]
+    else:
+        upserts = [row for row in rows if stored.get(row[0]) != text_digest(row[1])]
+        document_upserts = [(row[0], row[1]) for row in upserts]
+    row_ids = {row[0] for row in rows}
+    delete_ids = [i for i in stored if i not in row_ids]
+    if not chunked:
+        document_deletes = delete_ids
+    if not upserts and not delete_ids and not document_upserts and not document_deletes:
+        logger.info(f"No changed rows for {filename}, keeping existing index")
+        if source:
+            apply_row_changes(rows_path, [], [], source)
+        return True
+
+    changes = meta.get('changes_since_build', 0) + len(document_upserts) + len(document_deletes)
+    fragmentation = changes / max(meta.get('built_vectors', meta.get('built_rows', 1)), 1)
+    if fragmentation > COMPACTION_THRESHOLD:
+        logger.info(f"Fragmentation {fragmentation:.2f} for {filename} passes {COMPACTION_THRESHOLD}, compacting")
+        return False
+
+    index, _ = read_index(vector_db_path, meta['index'])
+    if int(index.ntotal) != meta['index'].get('ntotal'):
+        # The index and row store were left out of step (e.g. a crash between the two writes)
+        logger.warning(f"Index for {filename} holds {index.ntotal} vectors, row store expects {meta['index'].get('ntotal')}, rebuilding")
+        return False
+    vector_ids = [doc[0] for doc in document_upserts]
+    with span("embedding", rows=len(document_upserts), bytes=sum(len(doc[1]) for doc in document_upserts)):
+        embeddings = encode([doc[1] for doc in document_upserts]) if document_upserts else None
+    with span("faiss_update", rows=len(document_upserts) + len(document_deletes)):
+        index_params = update_index(index, meta['index'], embeddings, vector_ids, document_deletes)
+        rerank_vectors = embeddings if index_params.get('storage') == 'binary' else None
+        # The row store is committed only once the new index is on disk, and the index is
+        # swapped in only once the row store is committed
+        write_index(index, vector_db_path, before_swap=lambda: apply_row_changes(
+            rows_path, upserts, delete_ids, dict(source, index=index_params, changes_since_build=changes),
+            vector_ids, rerank_vectors,
+            chunk_upserts=document_upserts if chunked else (), chunk_delete_ids=document_deletes if chunked else ()
+        ))
+    index_cache.invalidate(filename)
+    answer_cache.invalidate(filename)
+    logger.info(
+        f"Updated {len(upserts)} and removed {len(delete_ids)} rows, "
+        f"{len(document_upserts)} and {len(document_deletes)} vectors in {vector_db_path}"
+    )
+    return True
+
+def register_index(filename: str, db_name: str, category: str):
+    """Records the dataset's current index in the dataset registry."""
+    vector_db_path, rows_path = index_paths(filename)
+    index_params = RowStore(rows_path).meta.get('index', {})
+    fields = {'category': category} if category else {}
+    dataset_registry.record_output(
+        filename, db_name, index_type=index_params.get('type'), storage=index_params.get('storage'),
+        vectors=index_params.get('ntotal'), index_bytes=os.path.getsize(vector_db_path) + os.path.getsize(rows_path),
+        embedded_at=dataset_registry.now(), **fields
+    )
 
 class CreateEmbeddingsInput(BaseModel):
     filename: str = Field(description="Name of the CSV file to process")
     csv_data: str = Field(description="Raw CSV data as a string")
+    primary_key: str = Field(default="", description="Primary key column of the dataset, if known")
+    storage: str = Field(default="", description="Vector storage: float32, float16, int8, pq or binary; empty for automatic")
+    category: str = Field(default="", description="Dataset category from ingestion, if known")
+    db_name: str = Field(default="", description="MongoDB database holding the dataset, if known")
+    chunking: str = Field(default="", description="Chunking: row, size[:rows], key_range[:rows] or group_by:<column>[:rows]; empty for the default")
 
 @tool(args_schema=CreateEmbeddingsInput)
-def create_embeddings(filename: str, csv_data: str) -> str:
+@traced("create_embeddings")
+def create_embeddings(filename: str, csv_data: str, primary_key: str = "", storage: str = "",
+                      category: str = "", db_name: str = "", chunking: str = "") -> str:
     """
-    Converts CSV data into embeddings using all-MiniLM-L6-v2 and stores them in a FAISS index.
+    Converts CSV data into embeddings using all-MiniLM-L6-v2 and stores them in a FAISS index
+    whose type (flat, IVF or HNSW) is chosen from the number of vectors.
+    Rows are embedded in chunks (windows by size, primary-key range or group-by column,
+    with the column names) per chunking, or one vector per row with chunking "row".
+    Vectors are stored as float32, float16, int8 scalar-quantized, PQ codes or binary codes
+    (re-ranked on float16 copies) according to storage.
+    Vector ids are derived from the primary key, so an existing index is updated in place
+    with only the added, changed and removed rows until fragmentation calls for a rebuild.
+    Row texts and column values go to a SQLite row store keyed by vector id, with a BM25
+    keyword index and value indexes on id-like columns for hybrid retrieval.
+    The dataset's category and database are recorded so aggregate questions can be run
+    against transformed_<category>.
     Returns the path to the saved FAISS index.
     """
     logger.debug(f"Creating embeddings for {filename}")
@@ -49,24 +170,75 @@ def create_embeddings(filename: str, csv_data: str) -> str:
 
         # Combine relevant columns for embedding (e.g., all columns as text)
         text_data = df.astype(str).agg(' '.join, axis=1).tolist()
-        logger.debug(f"Text data for embedding (first 1000 chars): {''.join(text_data)[:1000]}")
+        logger.debug(f"Text data for embedding: {len(text_data)} rows, first row: {text_data[0][:1000]}")
+        primary_key = primary_key or infer_primary_key(df.columns.tolist())
+        ids = record_ids(df, text_data, primary_key)
+        # Column values per row, for predicate pushdown at query time
+        fields = df.astype(object).where(df.notna(), None).to_dict('records')
+
+        # Group rows into the documents that are embedded
+        chunking = parse_chunking(chunking, [str(col) for col in df.columns], primary_key)
+        if chunking == 'row':
+            documents = list(zip(ids, text_data))
+            rows = list(zip(ids, text_data, fields, ids))
+        else:
+            documents, row_chunks = build_chunks(df, ids, chunking, primary_key)
+            rows = list(zip(ids, text_data, fields, row_chunks))
+        logger.debug(f"Embedding {len(documents)} documents for {len(rows)} rows ({chunking})")
+
+        # Where the transformed rows live in MongoDB, for aggregate queries
+        source = {key: value for key, value in (('category', category), ('db_name', db_name)) if value}
+
+        vector_db_path, rows_path = index_paths(filename)
+        with _file_locks[vector_db_path]:
+            # Apply only the changed rows when the existing index allows it
+            if os.path.exists(vector_db_path) and ensure_row_store(filename):
+                meta = RowStore(rows_path).meta
+                stored_params = meta.get('index', {})
+                same_storage = not storage or stored_params.get('storage') == storage
+                same_columns = meta.get('columns') == [str(col) for col in df.columns]
+                same_chunking = meta.get('chunking') == chunking
+                if (meta.get('ids') == 'key' and stored_params.get('supports_remove') and same_storage
+                        and same_columns and same_chunking):
+                    if _update_embeddings(filename, rows, documents, meta, source):
+                        register_index(filename, db_name, category)
+                        return vector_db_path
 
-        # Generate embeddings
-        embeddings = embedder.encode(text_data, show_progress_bar=True)
-        embeddings = np.array(embeddings, dtype='float32')
-        logger.debug(f"Generated embeddings shape: {embeddings.shape}")
+            # Generate embeddings
+            vector_ids = [doc[0] for doc in documents]
+            with span("embedding", rows=len(documents), bytes=sum(len(doc[1]) for doc in documents)):
+                embeddings = encode([doc[1] for doc in documents], show_progress_bar=True)
+            logger.debug(f"Generated embeddings shape: {embeddings.shape}")
 
-        # Create FAISS index
-        dimension = embeddings.shape[1]
-        index = faiss.IndexFlatL2(dimension)
-        index.add(embeddings)
+            # Create FAISS index sized for the number of vectors
+            with span("faiss_build", rows=len(vector_ids)) as build_span:
+                index, index_params = build_index(embeddings, ids=vector_ids, storage=storage or None)
+                build_span.set(index_type=index_params.get('type'), storage=index_params.get('storage'))
 
-        # Save FAISS index and metadata
-        vector_db_path = os.path.join(VECTOR_DB_DIR, f"{os.path.splitext(filename)[0]}_index.faiss")
-        faiss.write_index(index, vector_db_path)
-        metadata_path = os.path.join(VECTOR_DB_DIR, f"{os.path.splitext(filename)[0]}_metadata.pkl")
-        with open(metadata_path, 'wb') as f:
-            pickle.dump({'texts': text_data, 'filename': filename}, f)
+            # Save FAISS index and row store; write to temp files and swap them in so
+            # concurrent readers never see a partially written index
+            with span("index_write", rows=len(rows)):
+                rerank_vectors = embeddings if index_params['storage'] == 'binary' else None
+                write_row_store(rows_path, rows, {
+                    'filename': filename,
+                    'index': index_params,
+                    'ids': 'key',
+                    'primary_key': primary_key,
+                    'columns': [str(col) for col in df.columns],
+                    'chunking': chunking,
+                    'built_rows': len(ids),
+                    'built_vectors': len(vector_ids),
+                    'changes_since_build': 0,
+                    **source,
+                }, vector_ids, rerank_vectors, indexed_fields=filter_columns([str(col) for col in df.columns], primary_key),
+                   chunks=documents if chunking != 'row' else None)
+                write_index(index, vector_db_path)
+            legacy_path = legacy_metadata_path(filename)
+            if os.path.exists(legacy_path):
+                os.remove(legacy_path)
+            index_cache.invalidate(filename)
+            answer_cache.invalidate(filename)
+            register_index(filename, db_name, category)
 
         logger.info(f"Saved FAISS index to {vector_db_path}")
         return vector_db_path
@@ -74,9 +246,15 @@ def create_embeddings(filename: str, csv_data: str) -> str:
         logger.error(f"Error creating embeddings for {filename}: {str(e)}")
         return f"Error: {str(e)}"
 
-def run_rag_agent(filename: str, csv_data: str) -> str:
+@traced("rag")
+def run_rag_agent(filename: str, csv_data: str, primary_key: str = None, storage: str = None,
+                  category: str = None, db_name: str = None, chunking: str = None) -> str:
     """
     Runs the RAG agent to create embeddings from CSV data.
+    The primary key found during ingestion, if any, keys the incremental index updates;
+    storage selects the dataset's vector storage format; category and db_name locate the
+    transformed collection for aggregate queries; chunking selects how rows are grouped
+    into embedded documents.
     Returns the vector DB path.
     """
     logger.info(f"Running RAG agent for {filename}, has_csv: {bool(csv_data)}")
@@ -96,10 +274,11 @@ def run_rag_agent(filename: str, csv_data: str) -> str:
             ("system", """
             You are a RAG agent that processes CSV data to create embeddings.
             - Use the create_embeddings tool to generate and store embeddings, returning the vector DB path.
+            - Pass the primary key, vector storage, category, database name and chunking through to the tool unchanged (they may be empty).
             - Return the result as a plain string (the vector DB path).
             - If the input is invalid, return an error message starting with 'Error: '.
             """),
-            ("human", "Filename: {filename}\nCSV Data: {csv_data}\n{agent_scratchpad}")
+            ("human", "Filename: {filename}\nPrimary Key: {primary_key}\nVector Storage: {storage}\nCategory: {category}\nDatabase Name: {db_name}\nChunking: {chunking}\nCSV Data: {csv_data}\n{agent_scratchpad}")
         ])
         agent = create_openai_functions_agent(llm=llm, tools=tools, prompt=prompt)
         executor = AgentExecutor(
@@ -110,11 +289,17 @@ def run_rag_agent(filename: str, csv_data: str) -> str:
             max_iterations=3
         )
 
-        result = executor.invoke({
-            "filename": filename,
-            "csv_data": csv_data,
-            "agent_scratchpad": ""
-        })
+        with span("rag_agent") as agent_span:
+            result = executor.invoke({
+                "filename": filename,
+                "csv_data": csv_data,
+                "primary_key": primary_key or "",
+                "storage": storage or "",
+                "category": category or "",
+                "db_name": db_name or "",
+                "chunking": chunking or "",
+                "agent_scratchpad": ""
+            }, config={"callbacks": agent_span.callbacks()})
         output = result["output"]
         if output.startswith("Error:"):
             logger.error(f"RAG agent failed: {output}")
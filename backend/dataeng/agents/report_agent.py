@@ -10,6 +10,8 @@ from langchain_core.tools import tool
 from pydantic.v1 import BaseModel, Field
 from pymongo import MongoClient
 from google.api_core.exceptions import ResourceExhausted
+from .tracing import span, traced
+from . import dataset_registry
 
 # Setup logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -48,6 +50,7 @@ def generate_report(csv_data: str, filename: str, category: str, db_name: str) -
     return csv_data
 
 # ------------------ Agent Runner ------------------ #
+@traced("report")
 def run_report_agent(filename: str, category: str, db_name: str) -> str:
     logger.info(f"📊 Starting report generation for {filename} (category: {category}, db: {db_name})")
     file_path = os.path.join(CLEAN_DIR, filename)
@@ -113,10 +116,10 @@ def run_report_agent(filename: str, category: str, db_name: str) -> str:
             google_api_key=os.getenv("GOOGLE_API_KEY_report_agent")
         )
 
-        def invoke_with_retry(llm, prompt, max_retries=3, retry_delay=2):
+        def invoke_with_retry(llm, prompt, max_retries=3, retry_delay=2, config=None):
             for attempt in range(max_retries):
                 try:
-                    return llm.invoke(prompt)
+                    return llm.invoke(prompt, config=config)
                 except ResourceExhausted as e:
                     if attempt == max_retries - 1:
                         raise
@@ -169,13 +172,14 @@ def run_report_agent(filename: str, category: str, db_name: str) -> str:
             max_iterations=7
         )
 
-        result = invoke_with_retry(executor, {
-            "filename": filename,
-            "csv_data": csv_data,
-            "category": category,
-            "db_name": db_name,
-            "agent_scratchpad": ""
-        })
+        with span("report_llm", rows=len(df), bytes=len(csv_data)) as llm_span:
+            result = invoke_with_retry(executor, {
+                "filename": filename,
+                "csv_data": csv_data,
+                "category": category,
+                "db_name": db_name,
+                "agent_scratchpad": ""
+            }, config={"callbacks": llm_span.callbacks()})
 
         report_text = result["output"]
         if report_text.startswith("# Error"):
@@ -186,6 +190,7 @@ def run_report_agent(filename: str, category: str, db_name: str) -> str:
         with open(report_path, "w", encoding="utf-8") as f:
             f.write(report_text)
 
+        dataset_registry.record_output(filename, db_name, report_path=report_path, reported_at=dataset_registry.now())
         logger.info(f"✅ Report saved at: {report_path}")
         return report_path
 
@@ -0,0 +1,12 @@
+# row_hash.py
+import json
+import hashlib
+
+# Field holding each ingested document's content hash; indexed, and excluded when documents are read back
+ROW_HASH_FIELD = "_row_hash"
+
+def row_hash(record: dict) -> str:
+    """Compact content hash of a record, independent of key order; Mongo's _id is not part of it."""
+    content = {key: value for key, value in record.items() if key not in ('_id', ROW_HASH_FIELD)}
+    canonical = json.dumps(content, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).hexdigest()
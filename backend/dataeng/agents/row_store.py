@@ -0,0 +1,309 @@
+# row_store.py
+import os
+import json
+import hashlib
+import pickle
+import sqlite3
+import logging
+import threading
+import numpy as np
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# SQLite caps the number of bound parameters per statement
+FETCH_BATCH_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS rows (id INTEGER PRIMARY KEY, text TEXT NOT NULL, digest TEXT, fields TEXT, chunk INTEGER);
+CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY, text TEXT NOT NULL, digest TEXT);
+CREATE TABLE IF NOT EXISTS vectors (id INTEGER PRIMARY KEY, vec BLOB NOT NULL);
+"""
+
+# BM25 keyword index over the row texts, kept in sync with the rows table by triggers
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS rows_fts USING fts5(text, content='rows', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS rows_fts_insert AFTER INSERT ON rows BEGIN
+    INSERT INTO rows_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS rows_fts_delete AFTER DELETE ON rows BEGIN
+    INSERT INTO rows_fts (rows_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+CREATE TRIGGER IF NOT EXISTS rows_fts_update AFTER UPDATE ON rows BEGIN
+    INSERT INTO rows_fts (rows_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    INSERT INTO rows_fts (rowid, text) VALUES (new.id, new.text);
+END;
+"""
+
+def text_digest(text: str) -> str:
+    """Compact content hash used to detect changed rows."""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+def field_expression(column: str) -> str:
+    """SQL expression reading a column value from the fields JSON, compared case-insensitively as text."""
+    path = column.replace("'", "''")
+    return f"""lower(CAST(json_extract(fields, '$."{path}"') AS TEXT))"""
+
+def filterable(column: str) -> bool:
+    """Columns whose names cannot be expressed as a JSON path label are not filterable."""
+    return '"' not in str(column)
+
+def _row_values(rows):
+    """Rows are (id, text, fields) or (id, text, fields, chunk id); a row is its own chunk by default."""
+    for row in rows:
+        row_id, text, fields = row[:3]
+        chunk = row[3] if len(row) > 3 else row_id
+        fields = json.dumps(fields, default=str) if fields is not None else None
+        yield int(row_id), text, text_digest(text), fields, int(chunk)
+
+def _chunk_values(chunks):
+    for chunk_id, text in chunks:
+        yield int(chunk_id), text, text_digest(text)
+
+def _vector_rows(ids, vectors):
+    """Float vectors are kept as float16 blobs, used to re-rank binary index candidates."""
+    return ((int(row_id), np.asarray(vector, dtype='float16').tobytes()) for row_id, vector in zip(ids, vectors))
+
+def write_row_store(path: str, rows, meta: dict, vector_ids=None, vectors=None, indexed_fields=(), chunks=None):
+    """
+    Writes (id, text, fields[, chunk id]) row payloads plus dataset metadata to a SQLite file,
+    along with a BM25 keyword index over the texts, expression indexes on indexed_fields
+    and float vectors by id when given. When rows are chunked, the embedded (chunk id, text)
+    documents go to the chunks table and vector ids are chunk ids. The file is written
+    beside the target and swapped in atomically.
+    """
+    # Unique per writing thread: threads of one worker may rewrite the same store at once
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.executescript(SCHEMA)
+        conn.executemany("INSERT INTO rows (id, text, digest, fields, chunk) VALUES (?, ?, ?, ?, ?)", _row_values(rows))
+        conn.execute("CREATE INDEX rows_chunk ON rows (chunk)")
+        if chunks is not None:
+            conn.executemany("INSERT INTO chunks (id, text, digest) VALUES (?, ?, ?)", _chunk_values(chunks))
+        if vectors is not None:
+            conn.executemany("INSERT INTO vectors (id, vec) VALUES (?, ?)", _vector_rows(vector_ids, vectors))
+        indexed_fields = [column for column in indexed_fields if filterable(column)]
+        for position, column in enumerate(indexed_fields):
+            conn.execute(f"CREATE INDEX field_{position} ON rows ({field_expression(column)})")
+        try:
+            conn.executescript(FTS_SCHEMA)
+            conn.execute("INSERT INTO rows_fts (rows_fts) VALUES ('rebuild')")
+            keyword_index = True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"SQLite FTS5 unavailable, skipping keyword index for {path}: {str(e)}")
+            keyword_index = False
+        meta = dict(meta, keyword_index=keyword_index, indexed_fields=indexed_fields)
+        conn.executemany(
+            "INSERT INTO meta (key, value) VALUES (?, ?)",
+            [(key, json.dumps(value)) for key, value in meta.items()]
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+
+def migrate_pickle(metadata_path: str, path: str):
+    """Converts a legacy pickled metadata file into a row store and removes the pickle."""
+    logger.info(f"Migrating {metadata_path} to row store {path}")
+    with open(metadata_path, 'rb') as f:
+        metadata = pickle.load(f)
+    texts = metadata.pop('texts')
+    metadata['ids'] = 'position'
+    write_row_store(path, ((row_id, text, None) for row_id, text in enumerate(texts)), metadata)
+    try:
+        os.remove(metadata_path)
+    except FileNotFoundError:
+        pass  # Already migrated by another worker
+
+def read_digests(path: str, table: str = "rows") -> dict:
+    """Returns {id: text digest} for every stored row, or every chunk with table="chunks"."""
+    if table not in ("rows", "chunks"):
+        raise ValueError(f"Unknown table: {table}")
+    conn = sqlite3.connect(path)
+    try:
+        return dict(conn.execute(f"SELECT id, digest FROM {table}"))
+    finally:
+        conn.close()
+
+def apply_row_changes(path: str, upserts: list, delete_ids: list, meta: dict, vector_ids=(), vectors=None,
+                      chunk_upserts=(), chunk_delete_ids=()):
+    """
+    Inserts or updates (id, text, fields[, chunk id]) rows and (chunk id, text) chunks, deletes
+    rows and chunks by id and updates metadata in a single transaction. vectors, when given,
+    holds the float vectors for vector_ids; vectors of deleted rows and chunks are dropped.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        conn.executescript(SCHEMA)
+        with conn:
+            # An upsert rather than INSERT OR REPLACE so the keyword index update trigger fires
+            conn.executemany(
+                "INSERT INTO rows (id, text, digest, fields, chunk) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET text = excluded.text, digest = excluded.digest, "
+                "fields = excluded.fields, chunk = excluded.chunk",
+                _row_values(upserts)
+            )
+            conn.executemany("DELETE FROM rows WHERE id = ?", ((int(row_id),) for row_id in delete_ids))
+            conn.executemany("INSERT OR REPLACE INTO chunks (id, text, digest) VALUES (?, ?, ?)", _chunk_values(chunk_upserts))
+            conn.executemany("DELETE FROM chunks WHERE id = ?", ((int(chunk_id),) for chunk_id in chunk_delete_ids))
+            conn.executemany(
+                "DELETE FROM vectors WHERE id = ?",
+                ((int(vector_id),) for vector_id in list(delete_ids) + list(chunk_delete_ids))
+            )
+            if vectors is not None:
+                conn.executemany("INSERT OR REPLACE INTO vectors (id, vec) VALUES (?, ?)", _vector_rows(vector_ids, vectors))
+            conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in meta.items()]
+            )
+    finally:
+        conn.close()
+
+class RowStore:
+    """
+    Read-only random access to a dataset's row payloads by vector id.
+    Connections are opened per call so a store swapped in by create_embeddings is picked up.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        conn = self._connect()
+        try:
+            self.meta = {key: json.loads(value) for key, value in conn.execute("SELECT key, value FROM meta")}
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+
+    def _select_by_ids(self, sql: str, ids: list) -> dict:
+        """Runs sql (with an {ids} placeholder list) in batches and returns {id: value}."""
+        found = {}
+        conn = self._connect()
+        try:
+            for start in range(0, len(ids), FETCH_BATCH_SIZE):
+                batch = ids[start:start + FETCH_BATCH_SIZE]
+                found.update(conn.execute(sql.format(ids=",".join("?" * len(batch))), batch))
+        finally:
+            conn.close()
+        return found
+
+    def fetch_by_id(self, ids: list) -> dict:
+        """Returns {vector id: text} for the given ids that exist."""
+        return self._select_by_ids("SELECT id, text FROM rows WHERE id IN ({ids})", [int(i) for i in ids])
+
+    def fetch(self, ids: list) -> list:
+        """Returns the texts for the given vector ids, in the same order; unknown ids are skipped."""
+        ids = [int(i) for i in ids]
+        found = self.fetch_by_id(ids)
+        return [found[i] for i in ids if i in found]
+
+    def fetch_vectors(self, ids: list) -> np.ndarray:
+        """Returns float32 vectors for the given ids in order; rows without a stored vector are NaN."""
+        ids = [int(i) for i in ids]
+        found = self._select_by_ids("SELECT id, vec FROM vectors WHERE id IN ({ids})", ids)
+        dimension = self.meta.get('index', {}).get('dimension', 0)
+        vectors = np.full((len(ids), dimension), np.nan, dtype='float32')
+        for row, row_id in enumerate(ids):
+            if row_id in found:
+                vectors[row] = np.frombuffer(found[row_id], dtype='float16')
+        return vectors
+
+    def keyword_search(self, terms: list, limit: int) -> list:
+        """Returns ids of rows matching any of the terms, best BM25 score first."""
+        if not terms or not self.meta.get('keyword_index'):
+            return []
+        match = " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT rowid FROM rows_fts WHERE rows_fts MATCH ? ORDER BY bm25(rows_fts) LIMIT ?",
+                (match, limit)
+            )
+            return [row_id for (row_id,) in rows]
+        finally:
+            conn.close()
+
+    def filter_ids(self, predicates: list, limit: int) -> list:
+        """Returns ids of rows where any (column, value) predicate holds, compared case-insensitively."""
+        predicates = [(column, value) for column, value in predicates if filterable(column)]
+        if not predicates:
+            return []
+        where = " OR ".join(f"{field_expression(column)} = ?" for column, _ in predicates)
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                f"SELECT id FROM rows WHERE {where} LIMIT ?",
+                [str(value).lower() for _, value in predicates] + [limit]
+            )
+            return [row_id for (row_id,) in rows]
+        finally:
+            conn.close()
+
+    @property
+    def chunked(self) -> bool:
+        """Whether vectors index multi-row chunks rather than single rows."""
+        return self.meta.get('chunking', 'row') != 'row'
+
+    def members(self, vector_ids: list) -> dict:
+        """Returns {vector id: [row ids]}; each row is its own vector when unchunked."""
+        vector_ids = [int(i) for i in vector_ids]
+        if not self.chunked:
+            return {i: [i] for i in vector_ids}
+        members = {}
+        conn = self._connect()
+        try:
+            for start in range(0, len(vector_ids), FETCH_BATCH_SIZE):
+                batch = vector_ids[start:start + FETCH_BATCH_SIZE]
+                sql = f"SELECT chunk, id FROM rows WHERE chunk IN ({','.join('?' * len(batch))})"
+                for chunk_id, row_id in conn.execute(sql, batch):
+                    members.setdefault(chunk_id, []).append(row_id)
+        finally:
+            conn.close()
+        return members
+
+    def expand(self, vector_ids: list) -> list:
+        """
+        Expands vector ids (chunk ids when chunked) into row ids, keeping the vectors'
+        order and each chunk's rows together.
+        """
+        vector_ids = [int(i) for i in vector_ids]
+        members = self.members(vector_ids)
+        return [row_id for vector_id in vector_ids for row_id in members.get(vector_id, [])]
+
+    def fetch_fields(self, ids: list) -> dict:
+        """Returns {row id: column values} for the given ids; rows stored without fields are skipped."""
+        found = self._select_by_ids("SELECT id, fields FROM rows WHERE id IN ({ids}) AND fields IS NOT NULL", [int(i) for i in ids])
+        return {row_id: json.loads(fields) for row_id, fields in found.items()}
+
+    def iter_documents(self):
+        """Yields every embedded (vector id, text) document: chunks when chunked, otherwise rows."""
+        if not self.chunked:
+            yield from self.iter_rows()
+            return
+        conn = self._connect()
+        try:
+            for row in conn.execute("SELECT id, text FROM chunks ORDER BY id"):
+                yield row
+        finally:
+            conn.close()
+
+    def iter_rows(self):
+        """Yields every (vector id, text) pair in id order."""
+        conn = self._connect()
+        try:
+            for row in conn.execute("SELECT id, text FROM rows ORDER BY id"):
+                yield row
+        finally:
+            conn.close()
+
+    def count(self) -> int:
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM rows").fetchone()[0]
+        finally:
+            conn.close()
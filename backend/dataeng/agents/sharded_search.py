@@ -0,0 +1,164 @@
+# sharded_search.py
+import os
+import glob
+import heapq
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .vector_index import search
+from .index_cache import VECTOR_DB_DIR, index_cache, index_paths, dataset_signature
+from .row_store import RowStore
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Sharded search settings; loaded shards are held in the shared index cache, so
+# INDEX_CACHE_MAX_BYTES is their memory budget
+SHARD_SEARCH_WORKERS = int(os.getenv("SHARD_SEARCH_WORKERS", str(min(8, os.cpu_count() or 1))))
+SHARD_TOP_K = int(os.getenv("SHARD_TOP_K", "8"))
+
+_meta_cache = {}
+_meta_lock = threading.Lock()
+
+def _shard_meta(rows_path: str) -> dict:
+    """Row store metadata, re-read only when the store file changes."""
+    mtime = os.stat(rows_path).st_mtime_ns
+    with _meta_lock:
+        cached = _meta_cache.get(rows_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    meta = RowStore(rows_path).meta
+    with _meta_lock:
+        _meta_cache[rows_path] = (mtime, meta)
+    return meta
+
+def list_shards(category: str = None, db_name: str = None) -> list:
+    """
+    Returns the dataset file names whose indexes belong to a category and/or database,
+    as recorded in their row store metadata at embedding time.
+    """
+    shards = []
+    for rows_path in sorted(glob.glob(os.path.join(VECTOR_DB_DIR, "*_rows.sqlite3"))):
+        filename = os.path.basename(rows_path)[:-len("_rows.sqlite3")] + ".csv"
+        if not os.path.exists(index_paths(filename)[0]):
+            continue
+        try:
+            meta = _shard_meta(rows_path)
+        except Exception as e:
+            logger.warning(f"Skipping unreadable shard {rows_path}: {str(e)}")
+            continue
+        if category and str(meta.get('category', '')).lower() != category.lower():
+            continue
+        if db_name and meta.get('db_name') != db_name:
+            continue
+        shards.append(filename)
+    return shards
+
+def shards_signature(shards: list) -> tuple:
+    """Combined index signature of a set of shards, for caches keyed on their contents."""
+    return tuple((shard, dataset_signature(shard)) for shard in shards)
+
+def shard_sources(shards: list) -> list:
+    """Dataset-level provenance of shards, for answers not drawn from individual rows."""
+    sources = []
+    for shard in shards:
+        meta = _shard_meta(index_paths(shard)[1])
+        sources.append({'filename': shard, 'category': meta.get('category'), 'db_name': meta.get('db_name')})
+    return sources
+
+def merged_meta(shards: list) -> dict:
+    """
+    Row store metadata standing for a set of shards: their columns and primary key when
+    every shard has the same ones, otherwise none.
+    """
+    metas = [_shard_meta(index_paths(shard)[1]) for shard in shards]
+    columns = [list(meta.get('columns') or []) for meta in metas]
+    primary_keys = {meta.get('primary_key') for meta in metas}
+    return {
+        'columns': columns[0] if columns and all(c == columns[0] for c in columns) else [],
+        'primary_key': primary_keys.pop() if len(primary_keys) == 1 else None,
+    }
+
+class MergedRows:
+    """
+    The rows of merged shard hits behind the part of the RowStore interface that
+    build_context uses, keyed by (filename, row_id). Texts are prefixed with their file.
+    """
+
+    def __init__(self, results: list, meta: dict):
+        self.meta = meta
+        self.texts = {(result['filename'], result['row_id']): f"[{result['filename']}] {result['text']}" for result in results}
+
+    def fetch_by_id(self, ids: list) -> dict:
+        return {key: self.texts[key] for key in ids if key in self.texts}
+
+    def fetch_fields(self, ids: list) -> dict:
+        by_shard = {}
+        for filename, row_id in ids:
+            by_shard.setdefault(filename, []).append(row_id)
+        fields = {}
+        for filename, row_ids in by_shard.items():
+            _, store = index_cache.get(filename)
+            fields.update({(filename, row_id): values for row_id, values in store.fetch_fields(row_ids).items()})
+        return fields
+
+def _search_shard(filename: str, query_embedding, k: int) -> list:
+    index, store = index_cache.get(filename)
+    params = store.meta.get('index', {})
+    if params.get('dimension') not in (None, query_embedding.shape[1]):
+        logger.warning(f"Skipping shard {filename}: dimension {params.get('dimension')} does not match the query")
+        return []
+    distances, ids = search(index, params, query_embedding, k, store.fetch_vectors)
+    return [(float(distance), filename, int(i)) for distance, i in zip(distances[0], ids[0]) if i >= 0]
+
+def sharded_search(shards: list, query_embedding, k: int = SHARD_TOP_K) -> list:
+    """
+    Searches every shard's index in parallel on a thread pool (FAISS releases the GIL)
+    and merges the per-shard top-k by L2 distance. Returns the k best rows as dicts with
+    their provenance: filename, category, db_name, row_id, distance and text.
+    """
+    if not shards:
+        return []
+    hits = []
+    with ThreadPoolExecutor(max_workers=min(SHARD_SEARCH_WORKERS, len(shards))) as pool:
+        futures = {pool.submit(_search_shard, shard, query_embedding, k): shard for shard in shards}
+        for future, shard in futures.items():
+            try:
+                hits.extend(future.result())
+            except Exception as e:
+                logger.error(f"Search failed for shard {shard}: {str(e)}")
+    best = heapq.nsmallest(k, hits)
+
+    # Expand chunk hits into rows, each taking its chunk's distance, and read the
+    # winning rows with one batched fetch per shard
+    by_shard = {}
+    for _, filename, vector_id in best:
+        by_shard.setdefault(filename, []).append(vector_id)
+    texts, members = {}, {}
+    for filename, vector_ids in by_shard.items():
+        _, store = index_cache.get(filename)
+        for vector_id, row_ids in store.members(vector_ids).items():
+            members[(filename, vector_id)] = row_ids
+        row_ids = [i for vector_id in vector_ids for i in members.get((filename, vector_id), [])]
+        texts.update({(filename, i): text for i, text in store.fetch_by_id(row_ids).items()})
+    best = [
+        (distance, filename, row_id)
+        for distance, filename, vector_id in best
+        for row_id in members.get((filename, vector_id), [])
+    ][:k]
+
+    results = []
+    for distance, filename, row_id in best:
+        if (filename, row_id) not in texts:
+            continue
+        meta = _shard_meta(index_paths(filename)[1])
+        results.append({
+            'filename': filename,
+            'category': meta.get('category'),
+            'db_name': meta.get('db_name'),
+            'row_id': row_id,
+            'distance': distance,
+            'text': texts[(filename, row_id)],
+        })
+    logger.debug(f"Sharded search over {len(shards)} shards: {len(hits)} candidates, returning {len(results)}")
+    return results
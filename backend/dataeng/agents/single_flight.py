@@ -0,0 +1,46 @@
+# single_flight.py
+import logging
+import threading
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. Callers arriving while a call with their key
+    is running wait for it and share its result (or exception) instead of running again.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func) -> tuple:
+        """Returns (result, shared), where shared is True when another caller's run was joined."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            logger.info(f"Joining call in progress for {key}")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
@@ -0,0 +1,303 @@
+# tracing.py
+import os
+import time
+import uuid
+import sqlite3
+import functools
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Paths. Every worker process adds to the same metrics file, so a scrape of any worker
+# sees the totals of all of them.
+METRICS_PATH = os.getenv("METRICS_PATH", "metrics.sqlite3")
+
+# Histogram buckets in seconds; pipeline stages range from milliseconds to minutes of LLM time
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+COUNTED = ("rows", "bytes", "llm_tokens")
+
+_current_trace = contextvars.ContextVar("dataeng_trace", default=None)
+_current_span = contextvars.ContextVar("dataeng_span", default=None)
+
+class Span:
+    """One timed stage of a trace, with counts such as rows, bytes and LLM tokens."""
+
+    def __init__(self, name: str, parent: str = None, **attrs):
+        self.name = name
+        self.parent = parent
+        self.attrs = dict(attrs)
+        self.status = "ok"
+        self.start = time.perf_counter()
+        self.offset = 0.0
+        self.duration = None
+
+    def add(self, **counts):
+        """Adds to numeric attributes (rows, bytes, llm_tokens, ...)."""
+        for key, value in counts.items():
+            if value:
+                self.attrs[key] = self.attrs.get(key, 0) + value
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def callbacks(self) -> list:
+        """LangChain callbacks that add the LLM tokens of an agent or chain run to this span."""
+        return [_token_usage_handler()(self)]
+
+    def to_dict(self) -> dict:
+        duration = self.duration if self.duration is not None else time.perf_counter() - self.start
+        return {
+            "name": self.name,
+            "parent": self.parent,
+            "start_seconds": round(self.offset, 4),
+            "duration_seconds": round(duration, 4),
+            "status": self.status,
+            **self.attrs,
+        }
+
+class Trace:
+    """The spans recorded while handling one request, in the order they started."""
+
+    def __init__(self, name: str):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.start = time.perf_counter()
+        self.spans = []
+        # Set by agents/profiling.py while the request is profiled
+        self.profiler = None
+        self._lock = threading.Lock()
+
+    def append(self, span: Span):
+        span.offset = span.start - self.start
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = [span.to_dict() for span in self.spans]
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "duration_seconds": round(time.perf_counter() - self.start, 4),
+            "llm_tokens": sum(span.get("llm_tokens", 0) for span in spans),
+            "spans": spans,
+        }
+
+class Metrics:
+    """
+    Duration histograms and counters per stage, rendered in Prometheus text format.
+    Observations are added to a SQLite file shared by all worker processes, so the totals
+    do not depend on which worker serves the scrape.
+    """
+
+    SCHEMA = """
+    PRAGMA journal_mode=WAL;
+    CREATE TABLE IF NOT EXISTS samples (
+        metric TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        le TEXT NOT NULL DEFAULT '',
+        value REAL NOT NULL,
+        PRIMARY KEY (metric, stage, le)
+    );
+    """
+
+    def __init__(self, path: str = METRICS_PATH, buckets: tuple = DURATION_BUCKETS):
+        self.path = path
+        self.buckets = buckets
+        self._initialized = False
+        self._init_lock = threading.Lock()
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    conn.executescript(self.SCHEMA)
+                    self._initialized = True
+        return conn
+
+    def observe(self, span: Span):
+        samples = [("duration_bucket", span.name, str(bound), 1) for bound in self.buckets if span.duration <= bound]
+        samples += [("duration_count", span.name, "", 1), ("duration_sum", span.name, "", span.duration)]
+        samples += [(f"{key}_total", span.name, "", span.attrs[key]) for key in COUNTED if span.attrs.get(key)]
+        if span.status != "ok":
+            samples.append(("errors_total", span.name, "", 1))
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany(
+                        "INSERT INTO samples (metric, stage, le, value) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (metric, stage, le) DO UPDATE SET value = value + excluded.value",
+                        samples
+                    )
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f"Failed to record metrics for {span.name}: {str(e)}")
+
+    def _samples(self) -> dict:
+        try:
+            conn = self._connect()
+            try:
+                rows = conn.execute("SELECT metric, stage, le, value FROM samples").fetchall()
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f"Failed to read metrics: {str(e)}")
+            rows = []
+        return {(metric, stage, le): int(value) if float(value).is_integer() else value for metric, stage, le, value in rows}
+
+    def render(self) -> str:
+        samples = self._samples()
+        stages = sorted({stage for metric, stage, _ in samples if metric == "duration_count"})
+        lines = [
+            "# HELP dataeng_stage_duration_seconds Duration of pipeline stages.",
+            "# TYPE dataeng_stage_duration_seconds histogram",
+        ]
+        for stage in stages:
+            count = samples[("duration_count", stage, "")]
+            for bound in self.buckets:
+                lines.append(f'dataeng_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {samples.get(("duration_bucket", stage, str(bound)), 0)}')
+            lines.append(f'dataeng_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+            lines.append(f'dataeng_stage_duration_seconds_sum{{stage="{stage}"}} {float(samples.get(("duration_sum", stage, ""), 0)):.6f}')
+            lines.append(f'dataeng_stage_duration_seconds_count{{stage="{stage}"}} {count}')
+        for key in COUNTED:
+            lines.append(f"# HELP dataeng_stage_{key}_total {key.replace('_', ' ').capitalize()} processed by pipeline stages.")
+            lines.append(f"# TYPE dataeng_stage_{key}_total counter")
+            for (metric, stage, _), value in sorted(samples.items()):
+                if metric == f"{key}_total":
+                    lines.append(f'dataeng_stage_{key}_total{{stage="{stage}"}} {value}')
+        lines.append("# HELP dataeng_stage_errors_total Pipeline stages that raised or reported an error.")
+        lines.append("# TYPE dataeng_stage_errors_total counter")
+        for (metric, stage, _), value in sorted(samples.items()):
+            if metric == "errors_total":
+                lines.append(f'dataeng_stage_errors_total{{stage="{stage}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+@contextmanager
+def start_trace(name: str):
+    """Collects the spans of the stages run inside the block, in this thread or context."""
+    trace = Trace(name)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        logger.info(f"Trace {trace.trace_id} ({name}) finished in {time.perf_counter() - trace.start:.2f}s with {len(trace.spans)} spans")
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Times a stage. The span is added to the active trace, if any, and always to the
+    stage histograms. Exceptions mark it as an error; mark_error() covers stages that
+    report failures as "Error: ..." strings.
+    """
+    parent = _current_span.get()
+    current = Span(name, parent.name if parent else None, **attrs)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.append(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except Exception as e:
+        current.status = "error"
+        current.set(error=str(e))
+        raise
+    finally:
+        _current_span.reset(token)
+        current.duration = time.perf_counter() - current.start
+        metrics.observe(current)
+        if trace is not None and trace.profiler is not None:
+            trace.profiler.span_finished(current)
+
+def traced(name: str):
+    """
+    Runs the decorated function in a span. Results that are None or "Error: ..." strings,
+    the pipeline's failure convention, mark the span as failed.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                result = func(*args, **kwargs)
+                if result is None:
+                    mark_error("No result")
+                elif isinstance(result, str) and result.startswith("Error"):
+                    mark_error(result)
+                return result
+        return wrapper
+    return decorator
+
+def record(**counts):
+    """Adds counts to the innermost active span; a no-op outside any span."""
+    current = _current_span.get()
+    if current is not None:
+        current.add(**counts)
+
+def mark_error(message: str):
+    """Marks the innermost active span as failed."""
+    current = _current_span.get()
+    if current is not None:
+        current.status = "error"
+        current.set(error=message)
+
+def usage_tokens(message) -> int:
+    """Total tokens reported on a LangChain chat message, 0 when the provider reports none."""
+    usage = getattr(message, "usage_metadata", None) or {}
+    return usage.get("total_tokens") or (usage.get("input_tokens", 0) + usage.get("output_tokens", 0))
+
+def record_llm_usage(response):
+    """Adds the tokens of a direct llm.invoke() response to the innermost active span."""
+    record(llm_tokens=usage_tokens(response))
+
+@functools.lru_cache(maxsize=None)
+def _token_usage_handler():
+    """
+    The callback handler class, built on first use so importing this module (and the
+    views) does not import langchain.
+    """
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    class TokenUsageHandler(BaseCallbackHandler):
+        """
+        Adds the tokens of every LLM call in an agent run to a span. Calls made inside a tool
+        are skipped: tools record their own usage on their own span.
+        """
+
+        def __init__(self, target: Span):
+            self.target = target
+            self._tool_runs = set()
+
+        def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+            self._tool_runs.add(run_id)
+
+        def on_tool_end(self, output, *, run_id, **kwargs):
+            self._tool_runs.discard(run_id)
+
+        def on_tool_error(self, error, *, run_id, **kwargs):
+            self._tool_runs.discard(run_id)
+
+        def on_llm_end(self, response, *, run_id, parent_run_id=None, **kwargs):
+            if parent_run_id in self._tool_runs:
+                return
+            tokens = sum(
+                usage_tokens(getattr(generation, "message", None))
+                for generations in response.generations for generation in generations
+            )
+            if not tokens:
+                usage = (response.llm_output or {}).get("token_usage") or {}
+                tokens = usage.get("total_tokens", 0)
+            self.target.add(llm_tokens=tokens)
+
+    return TokenUsageHandler
@@ -3,6 +3,8 @@ import pandas as pd
 import logging
 import io
 import time
+import uuid
+from datetime import datetime
 from langchain.agents import AgentExecutor, create_openai_functions_agent
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI
@@ -10,6 +12,10 @@ from langchain_core.tools import tool
 from pydantic.v1 import BaseModel, Field
 from pymongo import MongoClient
 from google.api_core.exceptions import ResourceExhausted
+from .metadata_cache import metadata_cache
+from .tracing import span, traced, record, record_llm_usage
+from . import dataset_registry
+from .row_hash import ROW_HASH_FIELD
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -23,6 +29,13 @@ TRANSFORMED_DIR = os.path.abspath("transformed_data")  # Fixed from "transformed
 os.makedirs(CLEAN_DIR, exist_ok=True)
 os.makedirs(TRANSFORMED_DIR, exist_ok=True)
 
+# Collection holding a version stamp per transformed collection
+DATASET_VERSIONS_COLLECTION = "dataset_versions"
+
+def clean_file_name(filename: str) -> str:
+    """Name of the transformed CSV for an uploaded file; the RAG index is named after it."""
+    return f"transformed_{os.path.splitext(filename)[0]}.csv"
+
 def get_mongo_client():
     """Initialize MongoDB client from environment variable."""
     mongo_uri = os.getenv("MONGO_URI")
@@ -37,6 +50,7 @@ class AnalyzeAndTransformInput(BaseModel):
     db_name: str = Field(description="Name of the MongoDB database")
 
 @tool(args_schema=AnalyzeAndTransformInput)
+@traced("transform_llm")
 def analyze_and_transform(filename: str, category: str, db_name: str) -> str:
     """
     Transforms data from a MongoDB collection using AI: cleans data, performs feature engineering,
@@ -48,7 +62,7 @@ def analyze_and_transform(filename: str, category: str, db_name: str) -> str:
         client = get_mongo_client()
         db = client[db_name]
         collection = db[category.lower()]
-        records = list(collection.find({}, {'_id': 0}))
+        records = list(collection.find({}, {'_id': 0, ROW_HASH_FIELD: 0}))
         client.close()
 
         if not records:
@@ -62,6 +76,7 @@ def analyze_and_transform(filename: str, category: str, db_name: str) -> str:
 
         # Convert DataFrame to CSV for LLM processing
         csv_input = df.to_csv(index=False, encoding='utf-8', lineterminator='\n')
+        record(rows=len(df), bytes=len(csv_input))
 
         # Initialize Gemini LLM
         llm = ChatGoogleGenerativeAI(
@@ -115,6 +130,7 @@ def analyze_and_transform(filename: str, category: str, db_name: str) -> str:
         if response is None:
             logger.error(f"Failed to transform data after retries for {filename}")
             return f"Error: Failed to transform data after retries"
+        record_llm_usage(response)
 
         csv_output = response.content.strip()
 
@@ -142,6 +158,7 @@ class IngestTransformedInput(BaseModel):
     csv_data: str = Field(description="The transformed CSV data")
 
 @tool(args_schema=IngestTransformedInput)
+@traced("mongo_insert_transformed")
 def ingest_transformed_tool(filename: str, category: str, db_name: str, csv_data: str) -> str:
     """
     Ingests transformed data into a MongoDB collection named transformed_<category>.
@@ -173,7 +190,17 @@ def ingest_transformed_tool(filename: str, category: str, db_name: str, csv_data
         
         # Insert new records
         result = collection.insert_many(records)
+        record(rows=len(records), bytes=len(csv_data))
+
+        # Stamp a new version so results cached against the old data are not reused, and
+        # record whose data the collection now holds, as each upload replaces it
+        db[DATASET_VERSIONS_COLLECTION].update_one(
+            {'_id': f"transformed_{category.lower()}"},
+            {'$set': {'version': uuid.uuid4().hex, 'filename': clean_file_name(filename), 'updated_at': datetime.utcnow()}},
+            upsert=True
+        )
         client.close()
+        metadata_cache.invalidate('collections', db_name)
         
         logger.info(f"Inserted {len(result.inserted_ids)} records into {db_name}.transformed_{category}")
         return f"Inserted {len(result.inserted_ids)} records"
@@ -181,6 +208,7 @@ def ingest_transformed_tool(filename: str, category: str, db_name: str, csv_data
         logger.error(f"Error ingesting transformed data for {filename}: {str(e)}")
         return f"Error: {str(e)}"
 
+@traced("transform")
 def transform_file(filename: str, category: str, db_name: str) -> str:
     """
     Orchestrates the transformation of data from a MongoDB collection.
@@ -216,12 +244,13 @@ def transform_file(filename: str, category: str, db_name: str) -> str:
 
     # Run transformation
     try:
-        result = agent_executor.invoke({
-            "filename": filename,
-            "category": category,
-            "db_name": db_name,
-            "agent_scratchpad": ""
-        })
+        with span("transform_agent") as agent_span:
+            result = agent_executor.invoke({
+                "filename": filename,
+                "category": category,
+                "db_name": db_name,
+                "agent_scratchpad": ""
+            }, config={"callbacks": agent_span.callbacks()})
         output = result.get("output", "")
         logger.debug(f"AgentExecutor output: {output}")
 
@@ -239,19 +268,21 @@ def transform_file(filename: str, category: str, db_name: str) -> str:
             logger.error(f"Transformation failed for {filename}: {csv_data}")
             return None
 
-        clean_filename = f"transformed_{os.path.splitext(filename)[0]}.csv"
+        clean_filename = clean_file_name(filename)
         clean_path = os.path.join(CLEAN_DIR, clean_filename)
         transformed_path = os.path.join(TRANSFORMED_DIR, clean_filename)
 
-        # Save to clean_data/
-        with open(clean_path, 'w', encoding='utf-8') as f:
-            f.write(csv_data)
-        logger.debug(f"Saved transformed CSV to {clean_path}")
+        with span("csv_write") as write_span:
+            # Save to clean_data/
+            with open(clean_path, 'w', encoding='utf-8') as f:
+                f.write(csv_data)
+            logger.debug(f"Saved transformed CSV to {clean_path}")
 
-        # Save to transformed_data/
-        with open(transformed_path, 'w', encoding='utf-8') as f:
-            f.write(csv_data)
-        logger.debug(f"Saved transformed CSV to {transformed_path}")
+            # Save to transformed_data/
+            with open(transformed_path, 'w', encoding='utf-8') as f:
+                f.write(csv_data)
+            logger.debug(f"Saved transformed CSV to {transformed_path}")
+            write_span.add(bytes=2 * len(csv_data.encode('utf-8')))
 
         # Verify saved file in clean_data/
         try:
@@ -274,6 +305,10 @@ def transform_file(filename: str, category: str, db_name: str) -> str:
             logger.error(f"Ingestion failed for {filename}: {ingest_result}")
             return None
 
+        dataset_registry.record(
+            filename, db_name, category=category, clean_file=clean_filename, transformed_rows=len(df),
+            clean_bytes=os.path.getsize(clean_path), transformed_at=dataset_registry.now()
+        )
         logger.info(f"✅ Successfully transformed and saved: {clean_path} and {transformed_path}")
         return clean_path
 
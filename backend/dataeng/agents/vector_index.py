@@ -0,0 +1,305 @@
+# vector_index.py
+import os
+import time
+import hashlib
+import logging
+import threading
+import faiss
+import numpy as np
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Index selection settings
+INDEX_KIND = os.getenv("VECTOR_INDEX_KIND", "auto")  # auto, flat, ivf, hnsw (ivf_flat/ivf_pq also accepted)
+VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", "auto")  # auto, float32, float16, int8, pq, binary
+FLAT_MAX_VECTORS = int(os.getenv("VECTOR_INDEX_FLAT_MAX", "50000"))
+IVF_PQ_MIN_VECTORS = int(os.getenv("VECTOR_INDEX_IVF_PQ_MIN", "1000000"))
+TRAIN_SAMPLE_MAX = int(os.getenv("VECTOR_INDEX_TRAIN_SAMPLE_MAX", "200000"))
+HNSW_M = int(os.getenv("VECTOR_INDEX_HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("VECTOR_INDEX_HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF_SEARCH = int(os.getenv("VECTOR_INDEX_HNSW_EF_SEARCH", "64"))
+BINARY_RERANK_FACTOR = int(os.getenv("VECTOR_INDEX_BINARY_RERANK_FACTOR", "10"))
+
+# Faiss needs at least this many training points per centroid
+MIN_POINTS_PER_CENTROID = 39
+INDEX_KINDS = ("flat", "ivf", "hnsw")
+KIND_ALIASES = {"ivf_flat": ("ivf", "float32"), "ivf_pq": ("ivf", "pq")}
+STORAGE_OPTIONS = ("float32", "float16", "int8", "pq", "binary")
+SQ_TYPES = {"float16": faiss.ScalarQuantizer.QT_fp16, "int8": faiss.ScalarQuantizer.QT_8bit}
+
+def row_id(key: str) -> int:
+    """Stable non-negative 63-bit vector id derived from a record key."""
+    digest = hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') & 0x7FFFFFFFFFFFFFFF
+
+def binarize(embeddings: np.ndarray) -> np.ndarray:
+    """Packs the sign of each dimension into bits for binary indexes."""
+    return np.packbits(embeddings > 0, axis=1)
+
+def _pq_subquantizers(dimension: int) -> int:
+    """Largest sub-quantizer count dividing the dimension with at least 8 dims per sub-vector."""
+    for m in range(max(1, dimension // 8), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+def choose_index_params(num_vectors: int, dimension: int, kind: str = None, storage: str = None) -> dict:
+    """
+    Picks the index structure, vector storage and their parameters from the number of vectors.
+    Small sets get an exact flat index, larger ones an IVF index stored as PQ codes past
+    IVF_PQ_MIN_VECTORS, unless VECTOR_INDEX_KIND / VECTOR_STORAGE (or the arguments) force them.
+    """
+    kind = (kind or INDEX_KIND).lower()
+    storage = (storage or VECTOR_STORAGE).lower()
+    if kind in KIND_ALIASES:
+        kind, alias_storage = KIND_ALIASES[kind]
+        storage = alias_storage if storage == "auto" else storage
+    if kind == "auto":
+        kind = "flat" if num_vectors <= FLAT_MAX_VECTORS else "ivf"
+    if storage == "auto":
+        storage = "pq" if kind == "ivf" and num_vectors >= IVF_PQ_MIN_VECTORS else "float32"
+    if kind not in INDEX_KINDS:
+        raise ValueError(f"Unknown vector index kind: {kind}")
+    if storage not in STORAGE_OPTIONS:
+        raise ValueError(f"Unknown vector storage: {storage}")
+
+    # HNSW graphs here store raw vectors; compact storage uses an IVF index instead
+    if kind == "hnsw" and storage != "float32":
+        kind = "ivf" if num_vectors > FLAT_MAX_VECTORS else "flat"
+    # 8-bit PQ codebooks need enough points to train 256 centroids per sub-quantizer
+    if storage == "pq" and num_vectors < 256 * MIN_POINTS_PER_CENTROID:
+        logger.info(f"Too few vectors ({num_vectors}) to train PQ codebooks, using int8 storage")
+        storage = "int8"
+
+    params = {
+        "type": kind,
+        "storage": storage,
+        "dimension": dimension,
+        "ntotal": num_vectors,
+        "supports_remove": kind != "hnsw",
+    }
+    if kind == "ivf":
+        nlist = int(4 * np.sqrt(num_vectors))
+        nlist = max(1, min(nlist, num_vectors // MIN_POINTS_PER_CENTROID))
+        params["nlist"] = nlist
+        params["nprobe"] = int(os.getenv("VECTOR_INDEX_NPROBE", max(1, min(nlist, int(np.sqrt(nlist))))))
+    elif kind == "hnsw":
+        params["hnsw_m"] = HNSW_M
+        params["ef_construction"] = HNSW_EF_CONSTRUCTION
+        params["ef_search"] = HNSW_EF_SEARCH
+    if storage == "pq":
+        params["pq_m"] = _pq_subquantizers(dimension)
+        params["pq_nbits"] = 8
+    elif storage == "binary":
+        params["rerank_factor"] = BINARY_RERANK_FACTOR
+    nlist = params.get("nlist", 1)
+    min_train = max(nlist, 256 if storage == "pq" else 1) * MIN_POINTS_PER_CENTROID
+    params["train_size"] = min(num_vectors, max(min_train, min(nlist * 256, TRAIN_SAMPLE_MAX)))
+    return params
+
+def _make_index(params: dict):
+    dimension, kind, storage = params["dimension"], params["type"], params["storage"]
+    if storage == "binary":
+        if kind == "ivf":
+            return faiss.IndexBinaryIVF(faiss.IndexBinaryFlat(dimension), dimension, params["nlist"])
+        return faiss.IndexBinaryFlat(dimension)
+    if kind == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, params["hnsw_m"])
+        index.hnsw.efConstruction = params["ef_construction"]
+        return index
+    if kind == "ivf":
+        quantizer = faiss.IndexFlatL2(dimension)
+        if storage in SQ_TYPES:
+            return faiss.IndexIVFScalarQuantizer(quantizer, dimension, params["nlist"], SQ_TYPES[storage], faiss.METRIC_L2)
+        if storage == "pq":
+            return faiss.IndexIVFPQ(quantizer, dimension, params["nlist"], params["pq_m"], params["pq_nbits"])
+        return faiss.IndexIVFFlat(quantizer, dimension, params["nlist"])
+    if storage in SQ_TYPES:
+        return faiss.IndexScalarQuantizer(dimension, SQ_TYPES[storage], faiss.METRIC_L2)
+    if storage == "pq":
+        return faiss.IndexPQ(dimension, params["pq_m"], params["pq_nbits"])
+    return faiss.IndexFlatL2(dimension)
+
+def _codes(embeddings: np.ndarray, params: dict) -> np.ndarray:
+    return binarize(embeddings) if params.get("storage") == "binary" else embeddings
+
+def build_index(embeddings: np.ndarray, ids: np.ndarray = None, kind: str = None, storage: str = None):
+    """
+    Builds a FAISS index sized for the given float32 embeddings.
+    Trainable indexes (IVF, int8, PQ) are trained on a random sample rather than the full set.
+    With ids, the index is wrapped in an ID map so vectors can later be
+    replaced or removed by id.
+    Returns the populated index and the parameters to store in the index metadata.
+    """
+    num_vectors, dimension = embeddings.shape
+    params = choose_index_params(num_vectors, dimension, kind, storage)
+
+    start_time = time.time()
+    index = _make_index(params)
+    codes = _codes(embeddings, params)
+    if not index.is_trained:
+        rng = np.random.default_rng(0)
+        sample_ids = rng.choice(num_vectors, size=params["train_size"], replace=False)
+        index.train(codes[np.sort(sample_ids)])
+
+    if ids is not None:
+        index = faiss.IndexBinaryIDMap2(index) if params["storage"] == "binary" else faiss.IndexIDMap2(index)
+        index.add_with_ids(codes, np.asarray(ids, dtype='int64'))
+    else:
+        index.add(codes)
+    apply_search_params(index, params)
+    params["build_seconds"] = round(time.time() - start_time, 3)
+    logger.info(f"Built {params['type']}/{params['storage']} index over {num_vectors} vectors in {params['build_seconds']}s: {params}")
+    return index, params
+
+def update_index(index, params: dict, embeddings: np.ndarray, ids: np.ndarray, delete_ids: np.ndarray):
+    """
+    Applies an incremental change to an ID-mapped index: vectors for ids are added or
+    replaced and delete_ids are removed. Returns the updated parameters.
+    """
+    stale_ids = np.concatenate([np.asarray(ids, dtype='int64'), np.asarray(delete_ids, dtype='int64')])
+    if len(stale_ids):
+        index.remove_ids(stale_ids)
+    if len(ids):
+        index.add_with_ids(_codes(embeddings, params), np.asarray(ids, dtype='int64'))
+    return dict(params, ntotal=int(index.ntotal))
+
+def lists_on_disk(index) -> bool:
+    """
+    Whether an index's inverted lists are read from the memory-mapped file. faiss only maps
+    IVF inverted lists; flat and HNSW indexes load fully into memory even with IO_FLAG_MMAP.
+    """
+    invlists = getattr(_base_index(index), "invlists", None)
+    if invlists is None:
+        return False
+    return not isinstance(faiss.downcast_InvertedLists(invlists), faiss.ArrayInvertedLists)
+
+def read_index(path: str, params: dict, mmap: bool = False):
+    """
+    Reads a float or binary index as described by its parameters; returns (index, mmapped),
+    where mmapped is True only when the bulk of the index stays on disk.
+    """
+    reader = faiss.read_index_binary if params.get("storage") == "binary" else faiss.read_index
+    if mmap:
+        try:
+            index = apply_search_params(reader(path, faiss.IO_FLAG_MMAP), params)
+            return index, lists_on_disk(index)
+        except RuntimeError as e:
+            logger.debug(f"Memory-mapped load not supported for {path}, reading into memory: {str(e)}")
+    return apply_search_params(reader(path), params), False
+
+def write_index(index, path: str, before_swap=None):
+    """
+    Writes an index to a temp file and swaps it in so readers never see a partial file.
+    before_swap, when given, runs once the file is written and before it is swapped in, e.g.
+    to commit the matching row store; if it raises, the existing index is kept.
+    """
+    writer = faiss.write_index_binary if isinstance(index, faiss.IndexBinary) else faiss.write_index
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        writer(index, tmp_path)
+        if before_swap is not None:
+            before_swap()
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+def index_bytes(index) -> int:
+    """Serialized size of an index, i.e. what a worker holds in memory once it is loaded."""
+    if isinstance(index, faiss.IndexBinary):
+        return int(faiss.serialize_index_binary(index).nbytes)
+    return int(faiss.serialize_index(index).nbytes)
+
+def _base_index(index):
+    if hasattr(index, "id_map"):
+        if isinstance(index, faiss.IndexBinary):
+            return faiss.downcast_IndexBinary(index.index)
+        return faiss.downcast_index(index.index)
+    return index
+
+def apply_search_params(index, params: dict):
+    """Applies the stored nprobe/efSearch settings to a freshly loaded index."""
+    if not params:
+        return index
+    base = _base_index(index)
+    if "nprobe" in params and hasattr(base, "nprobe"):
+        base.nprobe = params["nprobe"]
+    if "ef_search" in params and hasattr(base, "hnsw"):
+        base.hnsw.efSearch = params["ef_search"]
+    return index
+
+def search(index, params: dict, queries: np.ndarray, k: int, fetch_vectors=None):
+    """
+    Searches any stored index type and returns (distances, ids) like faiss.
+    Binary indexes fetch k * rerank_factor candidates by Hamming distance and re-rank them
+    by L2 distance on float vectors returned by fetch_vectors(ids).
+    """
+    if params.get("storage") != "binary":
+        return index.search(queries, k)
+
+    _, candidates = index.search(binarize(queries), k * params.get("rerank_factor", BINARY_RERANK_FACTOR))
+    distances = np.full((len(queries), k), np.inf, dtype='float32')
+    ids = np.full((len(queries), k), -1, dtype='int64')
+    for row, query in enumerate(queries):
+        candidate_ids = [int(i) for i in candidates[row] if i >= 0]
+        if not candidate_ids:
+            continue
+        vectors = fetch_vectors(candidate_ids)
+        candidate_distances = ((vectors - query) ** 2).sum(axis=1)
+        order = np.argsort(candidate_distances)[:k]
+        distances[row, :len(order)] = candidate_distances[order]
+        ids[row, :len(order)] = np.asarray(candidate_ids, dtype='int64')[order]
+    return distances, ids
+
+def compare_with_flat(index, embeddings: np.ndarray, queries: np.ndarray, k: int = 10, ids: np.ndarray = None,
+                      params: dict = None, fetch_vectors=None) -> dict:
+    """
+    Measures recall@k and per-query latency of an index against an exact flat baseline
+    built over the same embeddings. Pass ids when the index is ID-mapped.
+    """
+    flat = faiss.IndexFlatL2(embeddings.shape[1])
+    flat.add(embeddings)
+    k = min(k, embeddings.shape[0])
+
+    start_time = time.time()
+    _, truth = flat.search(queries, k)
+    flat_seconds = time.time() - start_time
+
+    start_time = time.time()
+    _, found = search(index, params or {}, queries, k, fetch_vectors)
+    index_seconds = time.time() - start_time
+
+    if ids is not None:
+        truth = np.asarray(ids, dtype='int64')[truth]
+    hits = sum(len(set(found[i]) & set(truth[i])) for i in range(len(queries)))
+    return {
+        "k": k,
+        "queries": len(queries),
+        "recall_at_k": hits / float(k * len(queries)),
+        "flat_ms_per_query": 1000 * flat_seconds / len(queries),
+        "index_ms_per_query": 1000 * index_seconds / len(queries),
+    }
+
+def evaluate_storage(embeddings: np.ndarray, queries: np.ndarray, k: int = 10, kind: str = None) -> list:
+    """
+    Builds the index once per storage option and reports its in-memory size, bytes per
+    vector and recall@k/latency against the flat float32 baseline.
+    """
+    ids = np.arange(len(embeddings), dtype='int64')
+    results = []
+    for storage in STORAGE_OPTIONS:
+        index, params = build_index(embeddings, ids=ids, kind=kind, storage=storage)
+        result = compare_with_flat(index, embeddings, queries, k, ids=ids, params=params,
+                                   fetch_vectors=lambda candidate_ids: embeddings[candidate_ids])
+        size = index_bytes(index)
+        result.update({
+            "storage": params["storage"],
+            "type": params["type"],
+            "index_bytes": size,
+            "bytes_per_vector": size / float(len(embeddings)),
+        })
+        results.append(result)
+    return results
@@ -0,0 +1,36 @@
+# warmup.py
+import os
+import time
+import logging
+import importlib
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+# Warm-up settings. The views import each agent on the first request that needs it, so
+# workers boot quickly; production workers can pay that cost before serving instead.
+AGENTS_WARMUP = os.getenv("AGENTS_WARMUP", "0") == "1"
+EMBEDDER_WARMUP = os.getenv("EMBEDDER_WARMUP", "0") == "1"
+
+# The modules behind the views, in pipeline order
+AGENT_MODULES = ("data_ingestion", "transformation_agent", "report_agent", "rag_agent", "query_agent")
+
+def warm_up(agents: bool = True, embedder: bool = True) -> dict:
+    """
+    Imports the agent modules and loads the embedding model. Call it from a worker boot
+    hook (e.g. gunicorn's post_worker_init) or set AGENTS_WARMUP / EMBEDDER_WARMUP.
+    Returns the seconds spent on each step.
+    """
+    timings = {}
+    if agents:
+        for name in AGENT_MODULES:
+            start_time = time.perf_counter()
+            importlib.import_module(f".{name}", __package__)
+            timings[name] = round(time.perf_counter() - start_time, 3)
+    if embedder:
+        from . import embedder as embedder_module
+        start_time = time.perf_counter()
+        embedder_module.warm_up()
+        timings["embedder"] = round(time.perf_counter() - start_time, 3)
+    logger.info(f"Warm-up finished in {sum(timings.values()):.2f}s: {timings}")
+    return timings
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class DataengConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'dataeng'
+
+    def ready(self):
+        # Optional warm-up so production workers load the agents and the embedding model before serving
+        from .agents import warmup
+        if warmup.AGENTS_WARMUP or warmup.EMBEDDER_WARMUP:
+            warmup.warm_up(agents=warmup.AGENTS_WARMUP, embedder=warmup.EMBEDDER_WARMUP)
@@ -0,0 +1,233 @@
+from django.views.decorators.csrf import csrf_exempt
+from django.http import JsonResponse, StreamingHttpResponse
+import json
+import asyncio
+import logging
+import importlib
+from .agents.metadata_cache import metadata_cache
+from .agents.async_mongo import get_async_mongo_client
+from .views import metadata_response, sse_event
+
+logger = logging.getLogger(__name__)
+
+async def load_query_agent():
+    """Imports the query agent off the event loop; its first import loads langchain and faiss."""
+    return await asyncio.to_thread(importlib.import_module, '.agents.query_agent', __package__)
+
+@csrf_exempt
+async def list_databases(request):
+    if request.method == 'GET':
+        try:
+            cached = metadata_cache.get(('databases',))
+            if cached is None:
+                client = get_async_mongo_client()
+                databases = await client.list_database_names()
+                system_dbs = ['admin', 'local', 'config']
+                databases = [db for db in databases if db not in system_dbs]
+                logger.info(f"Retrieved database list: {databases}")
+                cached = metadata_cache.set(('databases',), databases)
+            return metadata_response(request, cached, 'databases')
+        except Exception as e:
+            logger.error(f"Error listing databases: {str(e)}")
+            return JsonResponse({'error': str(e)}, status=500)
+    return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+@csrf_exempt
+async def list_collections(request):
+    if request.method == 'POST':
+        db_name = None
+        try:
+            data = json.loads(request.body)
+            db_name = data.get('db_name')
+            if not db_name:
+                logger.error("Missing db_name")
+                return JsonResponse({'error': 'Missing db_name'}, status=400)
+
+            cached = metadata_cache.get(('collections', db_name))
+            if cached is None:
+                client = get_async_mongo_client()
+                collections = await client[db_name].list_collection_names()
+                collections = [col for col in collections if col not in ('schemas', 'dataset_versions')]
+                logger.info(f"Retrieved collections for {db_name}: {collections}")
+                cached = metadata_cache.set(('collections', db_name), collections)
+            return metadata_response(request, cached, 'collections')
+        except Exception as e:
+            logger.error(f"Error listing collections for {db_name}: {str(e)}")
+            return JsonResponse({'error': str(e)}, status=500)
+    return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+@csrf_exempt
+async def list_schemas(request):
+    if request.method == 'POST':
+        db_name = None
+        try:
+            data = json.loads(request.body)
+            db_name = data.get('db_name')
+            if not db_name:
+                logger.error("Missing db_name")
+                return JsonResponse({'error': 'Missing db_name'}, status=400)
+
+            cached = metadata_cache.get(('schemas', db_name))
+            if cached is None:
+                client = get_async_mongo_client()
+                cursor = client[db_name]['schemas'].find({}, {'_id': 0, 'category': 1, 'columns': 1})
+                schemas = await cursor.to_list(length=None)
+                logger.info(f"Retrieved schemas for {db_name}: {schemas}")
+                cached = metadata_cache.set(('schemas', db_name), schemas)
+            return metadata_response(request, cached, 'schemas')
+        except Exception as e:
+            logger.error(f"Error listing schemas for {db_name}: {str(e)}")
+            return JsonResponse({'error': str(e)}, status=500)
+    return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+@csrf_exempt
+async def get_schema(request):
+    if request.method == 'POST':
+        db_name = category = None
+        try:
+            data = json.loads(request.body)
+            db_name = data.get('db_name')
+            category = data.get('category')
+            if not db_name or not category:
+                logger.error("Missing db_name or category")
+                return JsonResponse({'error': 'Missing db_name or category'}, status=400)
+
+            client = get_async_mongo_client()
+            schema_doc = await client[db_name]['schemas'].find_one({"category": category})
+            if not schema_doc or "columns" not in schema_doc:
+                logger.info(f"No schema found for {db_name}.{category}")
+                return JsonResponse({'columns': []}, status=200)
+            logger.info(f"Retrieved schema for {db_name}.{category}: {schema_doc['columns']}")
+            return JsonResponse({'columns': schema_doc['columns']}, status=200)
+        except Exception as e:
+            logger.error(f"Error fetching schema for {db_name}.{category}: {str(e)}")
+            return JsonResponse({'error': str(e)}, status=500)
+    return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+@csrf_exempt
+async def save_schema(request):
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+            db_name = data.get('db_name')
+            category = data.get('category')
+            columns_raw = data.get('columns', [])
+
+            if not isinstance(columns_raw, list):
+                logger.error("Columns should be a list")
+                return JsonResponse({'error': 'Columns should be a list'}, status=400)
+
+            columns = [col.strip() for col in columns_raw if col.strip()]
+
+            if not db_name or not category or not columns:
+                logger.error("Missing required fields: db_name, category, or columns")
+                return JsonResponse({'error': 'Missing required fields'}, status=400)
+
+            client = get_async_mongo_client()
+            await client[db_name]['schemas'].update_one(
+                {'category': category},
+                {'$set': {'columns': columns}},
+                upsert=True
+            )
+            metadata_cache.invalidate('schemas', db_name)
+
+            logger.info(f"Saved schema for {db_name}.{category}: {columns}")
+            return JsonResponse({'message': 'Schema saved successfully'})
+        except Exception as e:
+            logger.error(f"Error saving schema: {str(e)}")
+            return JsonResponse({'error': str(e)}, status=500)
+    return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+@csrf_exempt
+async def delete_schema(request):
+    if request.method == 'POST':
+        db_name = category = None
+        try:
+            data = json.loads(request.body)
+            db_name = data.get('db_name')
+            category = data.get('category')
+            if not db_name or not category:
+                logger.error("Missing db_name or category")
+                return JsonResponse({'error': 'Missing db_name or category'}, status=400)
+
+            client = get_async_mongo_client()
+            result = await client[db_name]['schemas'].delete_one({"category": category})
+            metadata_cache.invalidate('schemas', db_name)
+            if result.deleted_count == 0:
+                logger.info(f"No schema found to delete for {db_name}.{category}")
+                return JsonResponse({'message': 'No schema found to delete'}, status=200)
+            logger.info(f"Deleted schema for {db_name}.{category}")
+            return JsonResponse({'message': 'Schema deleted successfully'}, status=200)
+        except Exception as e:
+            logger.error(f"Error deleting schema for {db_name}.{category}: {str(e)}")
+            return JsonResponse({'error': str(e)}, status=500)
+    return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+@csrf_exempt
+async def query_rag(request):
+    if request.method == 'POST':
+        query = request.POST.get('query')
+        filename = request.POST.get('filename')
+        category = request.POST.get('category')
+        db_name = request.POST.get('db_name')
+        logs = []
+
+        logger.debug(f"Received async query: '{query}', filename: '{filename}', category: '{category}', db_name: '{db_name}'")
+
+        if not query or not (filename or category or db_name):
+            logger.error("Missing query or filename in RAG query request")
+            logs.append("Error: Missing query or filename")
+            return JsonResponse({'error': 'Missing query or filename', 'logs': logs}, status=400)
+
+        query_agent = await load_query_agent()
+        if filename and (request.POST.get('stream') == '1' or 'text/event-stream' in request.headers.get('Accept', '')):
+            # Tokens are sent as they are generated, then timings as a trailing metadata event
+            logger.info(f"Streaming RAG query: {query} for {filename}")
+
+            async def events():
+                async for event, data in query_agent.astream_query(query, filename):
+                    yield sse_event(event, data)
+
+            response = StreamingHttpResponse(events(), content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
+
+        try:
+            if not filename:
+                # Search every index of the category and/or database as shards; the shard
+                # path is synchronous and runs in a worker thread
+                logger.info(f"Processing sharded RAG query: {query} for category={category}, db_name={db_name}")
+                logs.append(f"Processing sharded RAG query: {query} for category={category}, db_name={db_name}")
+                response, sources = await asyncio.to_thread(query_agent.process_shard_query, query, category, db_name)
+                logs.append(f"Query response: {response}")
+                if response.startswith("Error:"):
+                    logs.append(f"Query error: {response}")
+                    return JsonResponse({'error': response, 'logs': logs}, status=500)
+                return JsonResponse({
+                    'message': 'Query processed successfully',
+                    'response': response,
+                    'sources': sources,
+                    'logs': logs
+                })
+
+            logger.info(f"Processing RAG query: {query} for {filename}")
+            logs.append(f"Processing RAG query: {query} for {filename}")
+            response = await query_agent.aprocess_query(query, filename)
+            logs.append(f"Query response: {response}")
+
+            if response.startswith("Error:"):
+                logs.append(f"Query error: {response}")
+                return JsonResponse({'error': response, 'logs': logs}, status=500)
+
+            return JsonResponse({
+                'message': 'Query processed successfully',
+                'response': response,
+                'logs': logs
+            })
+        except Exception as e:
+            logger.error(f"Query error: {str(e)}")
+            logs.append(f"Query error: {str(e)}")
+            return JsonResponse({'error': str(e), 'logs': logs}, status=500)
+
+    return JsonResponse({'error': 'Invalid request method', 'logs': []}, status=400)
@@ -0,0 +1,243 @@
+"""
+Offline stand-ins for the pipeline's external services, shared by the benchmark and
+load-test commands: a deterministic chat model in place of Gemini, an in-process
+MongoDB (mongomock) or a local mongod, hashed embeddings and synthetic datasets.
+"""
+import io
+import os
+import re
+import ast
+import json
+import time
+import hashlib
+from contextlib import contextmanager, ExitStack
+from typing import Any, List, Optional
+from unittest import mock
+import numpy as np
+import pandas as pd
+from django.core.management.base import CommandError
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+SCHEMAS = {
+    "iot": ["sensor_id", "timestamp", "temperature", "humidity", "location"],
+    "sales": ["invoice_id", "date", "product", "quantity", "unit_price", "region"],
+}
+LOCATIONS = ["plant-a", "plant-b", "warehouse", "office", "lab"]
+PRODUCTS = ["widget", "gadget", "bolt", "panel", "cable", "sensor"]
+REGIONS = ["north", "south", "east", "west"]
+EMBEDDING_DIMENSION = 384
+
+class FakeChatModel(BaseChatModel):
+    """
+    Deterministic replacement for ChatGoogleGenerativeAI. It recognizes each pipeline
+    prompt and answers the way the pipeline expects (primary key, transformed CSV,
+    Markdown report, aggregation pipeline, answer), after an optional fixed latency.
+    The RAG agent is driven through its create_embeddings tool call; the other agents
+    finish on their first step and ingestion takes its manual path.
+    """
+    model: str = "fake"
+    temperature: float = 0.0
+    google_api_key: Optional[str] = None
+    timeout: Optional[float] = None
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-gemini"
+
+    def _generate(self, messages: List[Any], stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        if self.latency:
+            time.sleep(self.latency)
+        prompt = "\n".join(str(message.content) for message in messages)
+        function_call = rag_tool_call(prompt)
+        content = "" if function_call else respond(prompt)
+        input_tokens, output_tokens = len(prompt) // 4, len(content) // 4
+        message = AIMessage(
+            content=content,
+            additional_kwargs={"function_call": function_call} if function_call else {},
+            usage_metadata={
+                "input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens,
+            },
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+def _csv_after(prompt: str, marker: str) -> pd.DataFrame:
+    return pd.read_csv(io.StringIO(prompt.split(marker, 1)[1].strip()))
+
+def transform_csv(df: pd.DataFrame) -> str:
+    """What the transformation prompt asks for: imputation, de-duplication and one derived column."""
+    df = df.drop_duplicates()
+    for column in df.columns:
+        if pd.api.types.is_numeric_dtype(df[column]):
+            df[column] = df[column].fillna(df[column].mean())
+        else:
+            df[column] = df[column].fillna("Unknown")
+    dated = next((column for column in df.columns if column in ("date", "timestamp")), None)
+    if dated:
+        df["day_of_month"] = pd.to_datetime(df[dated], errors="coerce").dt.day.fillna(0).astype(int)
+    else:
+        df["row_total"] = df.select_dtypes("number").sum(axis=1)
+    return df.to_csv(index=False)
+
+def rag_tool_call(prompt: str) -> dict:
+    """
+    The create_embeddings call for the RAG agent's first step, or None. The agent's
+    scratchpad is rendered into its human message, so the tool's result shows up there
+    on the second step.
+    """
+    if "You are a RAG agent" not in prompt or "FunctionMessage(" in prompt:
+        return None
+    fields = {
+        key: (re.search(rf"^{label}: (.*)$", prompt, re.MULTILINE) or [None, ""])[1].strip()
+        for key, label in (("filename", "Filename"), ("primary_key", "Primary Key"), ("storage", "Vector Storage"),
+                           ("category", "Category"), ("db_name", "Database Name"), ("chunking", "Chunking"))
+    }
+    # CSV data runs to the scratchpad on the last line
+    fields["csv_data"] = prompt.split("CSV Data: ", 1)[1].rsplit("\n", 1)[0]
+    return {"name": "create_embeddings", "arguments": json.dumps(fields)}
+
+def respond(prompt: str) -> str:
+    """The fake model's answer to one of the pipeline's prompts."""
+    if prompt.strip().startswith("Test prompt"):
+        # Anything but "OK" sends ingestion down its manual (tool by tool) workflow
+        return "FAKE"
+    if "identify the most likely primary key column" in prompt:
+        match = re.search(r"and the dataset columns (\[.*?\])", prompt)
+        columns = ast.literal_eval(match.group(1)) if match else []
+        return next((column for column in columns if "id" in column.lower()), columns[0] if columns else "")
+    if "Generate a markdown report" in prompt:
+        df = _csv_after(prompt, "CSV Data:")
+        lines = [f"# Report", f"**Shape**: {len(df)} rows x {len(df.columns)} columns", "## Schema"]
+        lines += [f"- {column}: {dtype}" for column, dtype in df.dtypes.astype(str).items()]
+        lines += ["## Missing Values"] + [f"- {column}: {count}" for column, count in df.isna().sum().items() if count]
+        return "\n".join(lines)
+    if "You are a RAG agent" in prompt:
+        match = re.search(r"FunctionMessage\(content=(['\"])(.*?)\1", prompt)
+        return match.group(2) if match else "Error: create_embeddings was not called"
+    if "Transform this data from MongoDB collection" in prompt:
+        return transform_csv(_csv_after(prompt, "CSV Data:"))
+    if "Transform data from MongoDB collection" in prompt:
+        return "clean_data/"
+    if "translate analytical questions into MongoDB aggregation pipelines" in prompt:
+        return json.dumps({"pipeline": [{"$group": {"_id": None, "rows": {"$sum": 1}}}]})
+    if "Aggregation result (JSON):" in prompt:
+        result = prompt.split("Aggregation result (JSON):", 1)[1].splitlines()[0].strip()
+        return f"The aggregation returned {result}."
+    if "answers user queries based on provided data context" in prompt:
+        context = prompt.split("accurately:", 1)[-1].strip().splitlines()
+        return f"Based on {len(context)} context lines: {context[0][:200] if context else 'no data'}"
+    return "OK"
+
+def fake_encode(texts: list, show_progress_bar: bool = False, batch_size: int = 64) -> np.ndarray:
+    """Deterministic bag-of-words hashing embeddings, normalized like the MiniLM ones."""
+    embeddings = np.zeros((len(texts), EMBEDDING_DIMENSION), dtype='float32')
+    for row, text in enumerate(texts):
+        for word in re.findall(r"\w+", str(text).lower()):
+            bucket = int.from_bytes(hashlib.md5(word.encode('utf-8')).digest()[:4], 'little')
+            embeddings[row, bucket % EMBEDDING_DIMENSION] += 1.0
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.where(norms == 0, 1.0, norms)
+
+class SharedMongoClient:
+    """One client shared by every stage; the stages' close() calls leave it open."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getitem__(self, name):
+        return self._client[name]
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def close(self):
+        pass
+
+def mongo_client(uri: str = None, **pool_options):
+    """A client for a local mongod at uri (with pymongo pool options), or an in-process mongomock server."""
+    if uri:
+        from pymongo import MongoClient
+        return SharedMongoClient(MongoClient(uri, **pool_options))
+    try:
+        import mongomock
+    except ImportError:
+        raise CommandError("mongomock is required for the in-process Mongo stand-in; install it or pass --mongo-uri")
+    return SharedMongoClient(mongomock.MongoClient())
+
+def seed_schemas(client, db_name: str):
+    for category, columns in SCHEMAS.items():
+        client[db_name]['schemas'].update_one({'category': category}, {'$set': {'columns': columns}}, upsert=True)
+
+def synthetic_frame(kind: str, rows: int, start: int = 0, seed: int = 0) -> pd.DataFrame:
+    """Rows start..start+rows of a synthetic iot or sales dataset, with a few gaps and duplicates."""
+    rng = np.random.default_rng(seed + start)
+    ids = np.arange(start, start + rows)
+    if kind == "iot":
+        df = pd.DataFrame({
+            "sensor_id": [f"S{i:08d}" for i in ids],
+            "timestamp": (pd.Timestamp("2024-01-01") + pd.to_timedelta(ids * 60, unit="s")).strftime("%Y-%m-%d %H:%M:%S"),
+            "temperature": rng.normal(21.0, 4.0, rows).round(2),
+            "humidity": rng.uniform(20, 80, rows).round(1),
+            "location": rng.choice(LOCATIONS, rows),
+        })
+        df.loc[rng.random(rows) < 0.01, "temperature"] = np.nan
+    elif kind == "sales":
+        df = pd.DataFrame({
+            "invoice_id": [f"INV{i:09d}" for i in ids],
+            "date": (pd.Timestamp("2024-01-01") + pd.to_timedelta(ids % 365, unit="D")).strftime("%Y-%m-%d"),
+            "product": rng.choice(PRODUCTS, rows),
+            "quantity": rng.integers(1, 50, rows),
+            "unit_price": rng.uniform(1, 500, rows).round(2),
+            "region": rng.choice(REGIONS, rows),
+        })
+        df.loc[rng.random(rows) < 0.01, "region"] = None
+    else:
+        raise CommandError(f"Unknown dataset kind: {kind}")
+    return df
+
+def write_dataset(path: str, kind: str, rows: int, seed: int = 0, chunk_rows: int = 1_000_000) -> str:
+    """Writes a synthetic dataset as CSV in chunks, so 10M-row files never sit in memory at once."""
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for start in range(0, rows, chunk_rows):
+            synthetic_frame(kind, min(chunk_rows, rows - start), start, seed).to_csv(f, index=False, header=start == 0)
+    return path
+
+@contextmanager
+def offline_pipeline(workdir: str, client, llm_latency: float = 0.0, fake_embeddings: bool = False):
+    """
+    Points every pipeline stage at the fakes and at directories under workdir, and
+    restores everything on exit.
+    """
+    from dataeng.agents import (
+        data_ingestion, transformation_agent, report_agent, rag_agent, query_agent, aggregate_agent,
+    )
+
+    def fake_llm(**kwargs):
+        return FakeChatModel(latency=llm_latency, **kwargs)
+
+    previous_cwd = os.getcwd()
+    with ExitStack() as stack:
+        os.chdir(workdir)
+        stack.callback(os.chdir, previous_cwd)
+        for directory in ("raw_data", "organized_data", "logs", "clean_data", "transformed_data", "report", "vector_db", "media"):
+            os.makedirs(os.path.join(workdir, directory), exist_ok=True)
+        stack.enter_context(mock.patch.dict(os.environ, {
+            key: os.environ.get(key) or "offline"
+            for key in ("GOOGLE_API_KEY", "GOOGLE_API_KEY_data_ingestion", "GOOGLE_API_KEY_transformation_agent",
+                        "GOOGLE_API_KEY_report_agent", "GOOGLE_API_KEY_rag_agent")
+        }))
+        for module in (data_ingestion, transformation_agent, report_agent, rag_agent, query_agent, aggregate_agent):
+            stack.enter_context(mock.patch.object(module, "ChatGoogleGenerativeAI", fake_llm))
+        for module in (data_ingestion, transformation_agent, report_agent, aggregate_agent):
+            stack.enter_context(mock.patch.object(module, "get_mongo_client", lambda: client))
+        # These directories are resolved to absolute paths at import time
+        stack.enter_context(mock.patch.object(transformation_agent, "CLEAN_DIR", os.path.join(workdir, "clean_data")))
+        stack.enter_context(mock.patch.object(transformation_agent, "TRANSFORMED_DIR", os.path.join(workdir, "transformed_data")))
+        stack.enter_context(mock.patch.object(report_agent, "CLEAN_DIR", os.path.join(workdir, "transformed_data")))
+        stack.enter_context(mock.patch.object(report_agent, "REPORT_DIR", os.path.join(workdir, "report")))
+        if fake_embeddings:
+            stack.enter_context(mock.patch.object(rag_agent, "encode", fake_encode))
+            stack.enter_context(mock.patch.object(query_agent, "encode", fake_encode))
+        yield
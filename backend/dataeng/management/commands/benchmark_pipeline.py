@@ -0,0 +1,269 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+from datetime import datetime
+from unittest import mock
+import numpy as np
+import pandas as pd
+from django.core.management.base import BaseCommand, CommandError
+from dataeng.agents.tracing import start_trace
+from ._pipeline_fakes import SCHEMAS, mongo_client, seed_schemas, write_dataset, synthetic_frame, transform_csv, offline_pipeline
+
+STAGES = ('ingest', 'transform', 'report', 'embed', 'query')
+# Spans from agents/tracing.py reported as sub-stages of a stage
+SUB_STAGES = {'embed': ('embedding', 'faiss_build', 'index_write'), 'transform': ('transform_llm', 'csv_write', 'mongo_insert_transformed')}
+
+
+def _peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ("Benchmarks the data pipeline offline, with a deterministic fake LLM and an in-process "
+            "Mongo stand-in (or a local mongod), over synthetic iot/sales datasets. Reports "
+            "throughput, latency and peak memory per stage and writes the results as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1000,10000',
+                            help="Comma-separated dataset sizes in rows, e.g. 1000,100000,10000000")
+        parser.add_argument('--datasets', default='iot,sales', help="Comma-separated dataset kinds (iot, sales)")
+        parser.add_argument('--stages', default=','.join(STAGES), help=f"Comma-separated stages to time ({', '.join(STAGES)})")
+        parser.add_argument('--queries', type=int, default=20, help="Queries per dataset for the query stage")
+        parser.add_argument('--llm-latency', type=float, default=0.0, help="Seconds the fake LLM sleeps per call")
+        parser.add_argument('--mongo-uri', default='', help="Local mongod to use instead of the in-process stand-in")
+        parser.add_argument('--fake-embeddings', action='store_true',
+                            help="Use hashed embeddings instead of loading the sentence-transformers model")
+        parser.add_argument('--no-tracemalloc', action='store_true',
+                            help="Skip per-stage Python heap tracking (faster on large datasets; peak RSS is still reported)")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default='', help="Results file (default benchmark_results/pipeline_<time>.json)")
+        parser.add_argument('--compare', default='', help="Earlier results file to compare stage times against")
+        parser.add_argument('--tolerance', type=float, default=0.2, help="Slowdown ratio reported as a regression")
+        parser.add_argument('--fail-on-regression', action='store_true')
+
+    def _measure(self, name: str, rows: int, func, track_memory: bool) -> tuple:
+        """Runs one stage under a trace and returns (result, stage figures)."""
+        if track_memory:
+            tracemalloc.start()
+        start_time = time.perf_counter()
+        status, result = 'ok', None
+        with start_trace(f"benchmark:{name}") as trace:
+            try:
+                result = func()
+                if result is None or (isinstance(result, str) and result.startswith("Error")):
+                    status = f"error: {result}"
+            except Exception as e:
+                status = f"error: {e}"
+        seconds = time.perf_counter() - start_time
+        figures = {
+            'status': status,
+            'seconds': round(seconds, 4),
+            'rows_per_second': round(rows / seconds, 1) if seconds else None,
+        }
+        if track_memory:
+            figures['peak_memory_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2)
+            tracemalloc.stop()
+        spans = trace.to_dict()
+        if spans['llm_tokens']:
+            figures['llm_tokens'] = spans['llm_tokens']
+        sub_stages = {
+            span['name']: round(span['duration_seconds'], 4)
+            for span in spans['spans'] if span['name'] in SUB_STAGES.get(name, ())
+        }
+        if sub_stages:
+            figures['sub_stages'] = sub_stages
+        self.stdout.write(f"  {name:<10} {figures['seconds']:>10.3f}s  {status}")
+        return result, figures
+
+    def _run_dataset(self, kind: str, rows: int, stages: list, options: dict, client, workdir: str) -> dict:
+        from dataeng.agents import data_ingestion, transformation_agent, report_agent, rag_agent, query_agent
+
+        db_name = 'benchmark'
+        filename = f"{kind}_{rows}.csv"
+        category = kind
+        track_memory = not options['no_tracemalloc']
+        self.stdout.write(f"{kind} x {rows} rows")
+
+        source_path = os.path.join(workdir, 'raw_data', filename)
+        generate_start = time.perf_counter()
+        write_dataset(source_path, kind, rows, options['seed'])
+        result = {
+            'dataset': kind,
+            'rows': rows,
+            'file_bytes': os.path.getsize(source_path),
+            'generate_seconds': round(time.perf_counter() - generate_start, 4),
+            'stages': {},
+        }
+        # Ingestion moves the uploaded file into organized_data/, so it gets a copy
+        raw_path = os.path.join(workdir, 'media', filename)
+        shutil.copyfile(source_path, raw_path)
+        client[db_name][category].drop()
+        client[db_name][f"transformed_{category}"].drop()
+
+        if 'ingest' in stages:
+            _, result['stages']['ingest'] = self._measure(
+                'ingest', rows, lambda: data_ingestion.ingest_file(raw_path, filename, db_name), track_memory)
+        else:
+            # Untimed: the later stages read the raw rows from Mongo
+            client[db_name][category].insert_many(pd.read_csv(source_path).to_dict('records'))
+
+        clean_filename = transformation_agent.clean_file_name(filename)
+        if 'transform' in stages:
+            _, result['stages']['transform'] = self._measure(
+                'transform', rows, lambda: transformation_agent.transform_file(filename, category, db_name), track_memory)
+        if not os.path.exists(os.path.join(transformation_agent.CLEAN_DIR, clean_filename)):
+            csv_data = transform_csv(pd.read_csv(source_path))
+            for directory in (transformation_agent.CLEAN_DIR, transformation_agent.TRANSFORMED_DIR):
+                with open(os.path.join(directory, clean_filename), 'w', encoding='utf-8') as f:
+                    f.write(csv_data)
+        clean_path = os.path.join(transformation_agent.CLEAN_DIR, clean_filename)
+
+        if 'report' in stages:
+            _, result['stages']['report'] = self._measure(
+                'report', rows, lambda: report_agent.run_report_agent(clean_filename, category, db_name), track_memory)
+
+        if 'embed' in stages or 'query' in stages:
+            with open(clean_path, 'r', encoding='utf-8') as f:
+                csv_data = f.read()
+            embed = lambda: rag_agent.create_embeddings.invoke({
+                'filename': clean_filename, 'csv_data': csv_data, 'primary_key': SCHEMAS[kind][0],
+                'category': category, 'db_name': db_name,
+            })
+            if 'embed' in stages:
+                _, result['stages']['embed'] = self._measure('embed', rows, embed, track_memory)
+            else:
+                embed()
+
+        if 'query' in stages:
+            queries = self._queries(kind, rows, options['queries'], options['seed'])
+            latencies, errors = [], 0
+
+            def run_queries():
+                nonlocal errors
+                for query in queries:
+                    start_time = time.perf_counter()
+                    answer = query_agent.process_query(query, clean_filename)
+                    latencies.append(time.perf_counter() - start_time)
+                    errors += answer.startswith("Error:")
+                return "done"
+
+            _, figures = self._measure('query', len(queries), run_queries, track_memory)
+            latencies_ms = np.asarray(latencies) * 1000
+            figures.update({
+                'queries': len(queries),
+                'errors': errors,
+                'queries_per_second': figures.pop('rows_per_second'),
+                'p50_ms': round(float(np.percentile(latencies_ms, 50)), 2) if len(latencies) else None,
+                'p95_ms': round(float(np.percentile(latencies_ms, 95)), 2) if len(latencies) else None,
+            })
+            result['stages']['query'] = figures
+        return result
+
+    def _queries(self, kind: str, rows: int, count: int, seed: int) -> list:
+        """A fixed mix of lookup, descriptive and aggregate questions over the dataset."""
+        sample = synthetic_frame(kind, min(rows, 1000), 0, seed)
+        id_column = SCHEMAS[kind][0]
+        queries = []
+        for i in range(count):
+            row = sample.iloc[(i * 7919) % len(sample)]
+            if i % 4 == 0:
+                queries.append(f"How many records are there in total? ({i})")
+            elif i % 4 == 1:
+                queries.append(f"Show the details for {id_column} {row[id_column]}")
+            elif kind == "iot":
+                queries.append(f"What was the temperature at {row['location']} around {row['timestamp']}?")
+            else:
+                queries.append(f"How did {row['product']} sell in the {row['region']} region on {row['date']}?")
+        return queries
+
+    def _compare(self, results: dict, baseline_path: str, tolerance: float) -> list:
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        previous = {
+            (run['dataset'], run['rows'], stage): figures['seconds']
+            for run in baseline.get('results', []) for stage, figures in run['stages'].items()
+        }
+        regressions = []
+        self.stdout.write(f"\nCompared with {baseline_path} ({baseline.get('git_commit')}):")
+        for run in results['results']:
+            for stage, figures in run['stages'].items():
+                before = previous.get((run['dataset'], run['rows'], stage))
+                if not before:
+                    continue
+                ratio = figures['seconds'] / before
+                flag = "REGRESSION" if ratio > 1 + tolerance else ""
+                self.stdout.write(f"  {run['dataset']:<6} {run['rows']:>10} {stage:<10} {before:>9.3f}s -> {figures['seconds']:>9.3f}s  x{ratio:.2f} {flag}")
+                if flag:
+                    regressions.append({'dataset': run['dataset'], 'rows': run['rows'], 'stage': stage, 'ratio': round(ratio, 3)})
+        return regressions
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',') if size.strip()]
+        except ValueError:
+            raise CommandError("--sizes must be comma-separated integers")
+        kinds = [kind.strip() for kind in options['datasets'].split(',') if kind.strip()]
+        stages = [stage.strip() for stage in options['stages'].split(',') if stage.strip()]
+        unknown = [kind for kind in kinds if kind not in SCHEMAS] + [stage for stage in stages if stage not in STAGES]
+        if unknown:
+            raise CommandError(f"Unknown datasets or stages: {', '.join(unknown)}")
+
+        output = os.path.abspath(options['output'] or os.path.join(
+            'benchmark_results', f"pipeline_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"))
+        client = mongo_client(options['mongo_uri'])
+        seed_schemas(client, 'benchmark')
+        workdir = tempfile.mkdtemp(prefix='dataeng_benchmark_')
+        results = {
+            'suite': 'pipeline',
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'git_commit': _git_commit(),
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'mongo': 'mongod' if options['mongo_uri'] else 'mongomock',
+                'embeddings': 'hashed' if options['fake_embeddings'] else 'sentence-transformers',
+            },
+            'config': {key: options[key] for key in ('sizes', 'datasets', 'stages', 'queries', 'llm_latency', 'seed')},
+            'results': [],
+        }
+        try:
+            with offline_pipeline(workdir, client, options['llm_latency'], options['fake_embeddings']):
+                from dataeng.agents import query_agent
+                # Every query should run retrieval and the LLM, not the semantic answer cache
+                with mock.patch.object(query_agent, 'ANSWER_CACHE_ENABLED', False):
+                    for kind in kinds:
+                        for rows in sizes:
+                            results['results'].append(self._run_dataset(kind, rows, stages, options, client, workdir))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        results['peak_rss_mb'] = _peak_rss_mb()
+        results['finished_at'] = datetime.now().isoformat(timespec='seconds')
+
+        regressions = self._compare(results, options['compare'], options['tolerance']) if options['compare'] else []
+        results['regressions'] = regressions
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, default=str)
+        self.stdout.write(f"\nWrote results to {output}")
+        if regressions and options['fail_on_regression']:
+            raise CommandError(f"{len(regressions)} stage(s) slower than the baseline by more than {options['tolerance']:.0%}")
@@ -0,0 +1,158 @@
+import os
+import sys
+import json
+import platform
+import statistics
+import subprocess
+from datetime import datetime
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from dataeng.agents.warmup import AGENT_MODULES
+
+# Modules that must not be imported while the server boots; they belong to the agents
+HEAVY_MODULES = (
+    'langchain', 'langchain_core', 'langchain_google_genai', 'pandas', 'numpy', 'faiss',
+    'torch', 'sentence_transformers', 'pymongo', 'markdown',
+)
+
+# Runs in a fresh interpreter: boots Django as a worker does (setup plus the URL conf),
+# then optionally imports one module or runs the warm-up, and prints its figures as JSON
+PROBE = r'''
+import os, sys, json, time, resource, importlib
+
+def rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+interpreter_mb = rss_mb()
+start = time.perf_counter()
+import django
+django.setup()
+from django.conf import settings
+importlib.import_module(settings.ROOT_URLCONF)
+result = {"interpreter_rss_mb": interpreter_mb, "boot_seconds": round(time.perf_counter() - start, 4), "boot_rss_mb": rss_mb()}
+result["boot_modules"] = sorted(name for name in json.loads(sys.argv[1]) if name in sys.modules)
+if len(sys.argv) > 2:
+    start = time.perf_counter()
+    if sys.argv[2] == "warm_up":
+        from dataeng.agents.warmup import warm_up
+        warm_up()
+    else:
+        importlib.import_module(sys.argv[2])
+    result["load_seconds"] = round(time.perf_counter() - start, 4)
+    result["load_rss_mb"] = rss_mb()
+print(json.dumps(result))
+'''
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ("Measures cold start: the time and peak RSS of booting Django with the URL conf in a "
+            "fresh interpreter, which heavy modules that loads, and optionally the first-use "
+            "cost of each agent module and of the full warm-up. Compares against a baseline "
+            "to catch startup regressions.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help="Fresh interpreters per measurement; medians are reported")
+        parser.add_argument('--agents', action='store_true', help="Also measure the first import of each agent module")
+        parser.add_argument('--warm-up', action='store_true', help="Also measure the full warm-up (agents and embedding model)")
+        parser.add_argument('--max-boot-seconds', type=float, default=0.0, help="Fail when booting takes longer")
+        parser.add_argument('--max-boot-rss-mb', type=float, default=0.0, help="Fail when the booted process is larger")
+        parser.add_argument('--output', default='', help="Results file (default benchmark_results/startup_<time>.json)")
+        parser.add_argument('--compare', default='', help="Earlier results file to compare against")
+        parser.add_argument('--tolerance', type=float, default=0.25, help="Growth ratio reported as a regression")
+        parser.add_argument('--fail-on-regression', action='store_true',
+                            help="Exit with an error on a regression, a budget overrun or a heavy module loaded at boot")
+
+    def _probe(self, target: str = None) -> dict:
+        env = dict(os.environ, AGENTS_WARMUP='0', EMBEDDER_WARMUP='0',
+                   DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'backend.settings'))
+        args = [sys.executable, '-c', PROBE, json.dumps(HEAVY_MODULES)] + ([target] if target else [])
+        completed = subprocess.run(args, cwd=settings.BASE_DIR, env=env, capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise CommandError(f"Startup probe for {target or 'boot'} failed:\n{completed.stderr[-2000:]}")
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+
+    def _measure(self, target: str, repeat: int) -> dict:
+        runs = [self._probe(target) for _ in range(repeat)]
+        figures = {
+            key: round(statistics.median(run[key] for run in runs), 4)
+            for key in runs[0] if key != 'boot_modules'
+        }
+        figures['boot_modules'] = runs[0]['boot_modules']
+        return figures
+
+    def _compare(self, results: dict, baseline_path: str, tolerance: float) -> list:
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = []
+        self.stdout.write(f"\nCompared with {baseline_path} ({baseline.get('git_commit')}):")
+        for name, figures in results['results'].items():
+            previous = baseline.get('results', {}).get(name, {})
+            for key in ('boot_seconds', 'boot_rss_mb', 'load_seconds', 'load_rss_mb'):
+                before = previous.get(key)
+                if not before or key not in figures:
+                    continue
+                ratio = figures[key] / before
+                flag = "REGRESSION" if ratio > 1 + tolerance else ""
+                self.stdout.write(f"  {name:<22} {key:<13} {before:>9.3f} -> {figures[key]:>9.3f}  x{ratio:.2f} {flag}")
+                if flag:
+                    regressions.append({'measurement': name, 'figure': key, 'ratio': round(ratio, 3)})
+        return regressions
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError("--repeat must be positive")
+        if sys.platform == 'win32':
+            raise CommandError("The startup benchmark reads peak RSS through the resource module, which Windows lacks")
+
+        targets = {'boot': None}
+        if options['agents']:
+            targets.update({name: f"dataeng.agents.{name}" for name in AGENT_MODULES})
+        if options['warm_up']:
+            targets['warm_up'] = 'warm_up'
+
+        output = os.path.abspath(options['output'] or os.path.join(
+            'benchmark_results', f"startup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"))
+        results = {
+            'suite': 'startup',
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'git_commit': _git_commit(),
+            'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+            'config': {'repeat': options['repeat']},
+            'results': {},
+        }
+        for name, target in targets.items():
+            figures = self._measure(target, options['repeat'])
+            results['results'][name] = figures
+            line = f"{name:<22} boot {figures['boot_seconds']:.3f}s {figures['boot_rss_mb']} MB"
+            if 'load_seconds' in figures:
+                line += f"  load {figures['load_seconds']:.3f}s {figures['load_rss_mb']} MB"
+            self.stdout.write(line)
+
+        boot = results['results']['boot']
+        problems = []
+        if boot['boot_modules']:
+            problems.append(f"heavy modules imported at boot: {', '.join(boot['boot_modules'])}")
+        if options['max_boot_seconds'] and boot['boot_seconds'] > options['max_boot_seconds']:
+            problems.append(f"boot took {boot['boot_seconds']}s (budget {options['max_boot_seconds']}s)")
+        if options['max_boot_rss_mb'] and boot['boot_rss_mb'] > options['max_boot_rss_mb']:
+            problems.append(f"boot peak RSS {boot['boot_rss_mb']} MB (budget {options['max_boot_rss_mb']} MB)")
+        for problem in problems:
+            self.stdout.write(f"WARNING: {problem}")
+
+        regressions = self._compare(results, options['compare'], options['tolerance']) if options['compare'] else []
+        results['regressions'] = regressions
+        results['problems'] = problems
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        self.stdout.write(f"\nWrote results to {output}")
+        if (regressions or problems) and options['fail_on_regression']:
+            raise CommandError(f"{len(regressions)} regression(s) against the baseline; {len(problems)} startup problem(s)")
@@ -0,0 +1,104 @@
+import json
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, AsyncClient
+from django.test.utils import setup_test_environment
+
+ENDPOINTS = ('list_databases', 'list_collections', 'list_schemas', 'get_schema', 'query_rag')
+
+
+def _summary(latencies: list, errors: int, seconds: float) -> dict:
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "throughput_rps": round(len(latencies) / seconds, 1) if seconds else 0.0,
+        "p50_ms": round(float(np.percentile(latencies, 50)), 2) if len(latencies) else None,
+        "p95_ms": round(float(np.percentile(latencies, 95)), 2) if len(latencies) else None,
+    }
+
+
+class Command(BaseCommand):
+    help = ("Compares the synchronous (WSGI) and async (ASGI, Motor) versions of an endpoint "
+            "under concurrent requests and reports throughput and latency for each.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoint', choices=ENDPOINTS, default='list_databases')
+        parser.add_argument('--requests', type=int, default=200, help="Requests per path")
+        parser.add_argument('--concurrency', type=int, default=50, help="Requests in flight at once")
+        parser.add_argument('--db-name', default='', help="Database for the collection and schema endpoints")
+        parser.add_argument('--category', default='', help="Category for get_schema")
+        parser.add_argument('--filename', default='', help="Dataset file name for query_rag")
+        parser.add_argument('--query', default='Give me a summary of the data', help="Question for query_rag")
+
+    def _request(self, options) -> tuple:
+        endpoint = options['endpoint']
+        if endpoint == 'list_databases':
+            return 'get', {}, None
+        if endpoint == 'query_rag':
+            if not options['filename']:
+                raise CommandError("--filename is required for query_rag")
+            return 'post', {'query': options['query'], 'filename': options['filename']}, None
+        if not options['db_name']:
+            raise CommandError(f"--db-name is required for {endpoint}")
+        body = {'db_name': options['db_name'], 'category': options['category']}
+        return 'post', json.dumps(body), 'application/json'
+
+    def _run_sync(self, url: str, method: str, data, content_type, options) -> dict:
+        # The test client keeps per-request state (cookies, the last response), so each thread gets its own
+        local = threading.local()
+
+        def call(_):
+            client = getattr(local, 'client', None)
+            if client is None:
+                client = local.client = Client()
+            start_time = time.perf_counter()
+            if method == 'get':
+                response = client.get(url)
+            elif content_type:
+                response = client.post(url, data, content_type=content_type)
+            else:
+                response = client.post(url, data)
+            return time.perf_counter() - start_time, response.status_code >= 400
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            outcomes = list(pool.map(call, range(options['requests'])))
+        return _summary([o[0] for o in outcomes], sum(o[1] for o in outcomes), time.perf_counter() - start_time)
+
+    async def _run_async(self, url: str, method: str, data, content_type, options) -> dict:
+        client = AsyncClient()
+        semaphore = asyncio.Semaphore(options['concurrency'])
+
+        async def call():
+            async with semaphore:
+                start_time = time.perf_counter()
+                if method == 'get':
+                    response = await client.get(url)
+                elif content_type:
+                    response = await client.post(url, data, content_type=content_type)
+                else:
+                    response = await client.post(url, data)
+                return time.perf_counter() - start_time, response.status_code >= 400
+
+        start_time = time.perf_counter()
+        outcomes = await asyncio.gather(*(call() for _ in range(options['requests'])))
+        return _summary([o[0] for o in outcomes], sum(o[1] for o in outcomes), time.perf_counter() - start_time)
+
+    def handle(self, *args, **options):
+        # Allows the test client's host name
+        setup_test_environment()
+        method, data, content_type = self._request(options)
+        endpoint = options['endpoint']
+        result = {
+            "endpoint": endpoint,
+            "concurrency": options['concurrency'],
+            "wsgi": self._run_sync(f"/api/{endpoint}/", method, data, content_type, options),
+            "asgi": asyncio.run(self._run_async(f"/api/async/{endpoint}/", method, data, content_type, options)),
+        }
+        self.stdout.write(json.dumps(result, indent=2))
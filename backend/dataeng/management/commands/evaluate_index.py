@@ -0,0 +1,44 @@
+import os
+import json
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from dataeng.agents.embedder import encode
+from dataeng.agents.index_cache import index_cache, index_paths, ensure_row_store
+from dataeng.agents.vector_index import compare_with_flat, evaluate_storage
+
+
+class Command(BaseCommand):
+    help = ("Measures recall@k and query latency of a dataset's FAISS index against an exact flat baseline; "
+            "with --storage, also reports memory and recall for every vector storage option.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('filename', help="Dataset file name, e.g. transformed_iot_data.csv")
+        parser.add_argument('--k', type=int, default=10, help="Number of neighbours to compare")
+        parser.add_argument('--queries', type=int, default=100, help="Number of sampled rows used as queries")
+        parser.add_argument('--query', action='append', default=[], help="Explicit query text (repeatable)")
+        parser.add_argument('--storage', action='store_true', help="Compare float32, float16, int8, pq and binary storage")
+
+    def handle(self, *args, **options):
+        vector_db_path, _ = index_paths(options['filename'])
+        if not os.path.exists(vector_db_path) or not ensure_row_store(options['filename']):
+            raise CommandError(f"Vector DB not found for {options['filename']}")
+
+        index, store = index_cache.get(options['filename'])
+        rows = list(store.iter_documents())
+        ids = [row_id for row_id, _ in rows]
+        texts = [text for _, text in rows]
+        embeddings = encode(texts)
+        query_texts = options['query']
+        if not query_texts:
+            rng = np.random.default_rng(0)
+            sample_ids = rng.choice(len(texts), size=min(options['queries'], len(texts)), replace=False)
+            query_texts = [texts[i] for i in sample_ids]
+        queries = encode(query_texts)
+
+        params = store.meta.get('index', {'type': 'flat'})
+        result = compare_with_flat(index, embeddings, queries, k=options['k'], ids=ids,
+                                   params=params, fetch_vectors=store.fetch_vectors)
+        result['index'] = params
+        if options['storage']:
+            result['storage_options'] = evaluate_storage(embeddings, queries, k=options['k'])
+        self.stdout.write(json.dumps(result, indent=2))
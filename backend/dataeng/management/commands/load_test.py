@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import random
+import shutil
+import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment
+from ._pipeline_fakes import SCHEMAS, mongo_client, seed_schemas, synthetic_frame, offline_pipeline
+
+ROUTES = {'upload': '/api/upload/', 'query': '/api/query_rag/'}
+DB_NAME = 'loadtest'
+
+
+def _percentiles(values: list) -> dict:
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None}
+    values = np.asarray(values) * 1000
+    return {f"p{q}": round(float(np.percentile(values, q)), 2) for q in (50, 95, 99)}
+
+
+def _parse_mix(mix: str) -> dict:
+    weights = {}
+    for part in mix.split(','):
+        route, _, weight = part.partition('=')
+        route = route.strip()
+        if route not in ROUTES:
+            raise CommandError(f"Unknown route in --mix: {route} (expected {', '.join(ROUTES)})")
+        try:
+            weights[route] = float(weight or 1)
+        except ValueError:
+            raise CommandError(f"Invalid weight in --mix: {part}")
+    if not any(weights.values()):
+        raise CommandError("--mix needs at least one route with a positive weight")
+    return weights
+
+
+class Command(BaseCommand):
+    help = ("Drives the upload/ and query_rag/ routes with concurrent in-process clients against "
+            "the offline pipeline (fake LLM with configurable latency, Mongo stand-in) and reports "
+            "p50/p95/p99 latency, error rates and throughput for each concurrency level.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', default='1,4,16',
+                            help="Comma-separated concurrency levels; one run per level gives the throughput curve")
+        parser.add_argument('--requests', type=int, default=100, help="Requests per concurrency level")
+        parser.add_argument('--workers', type=int, default=0,
+                            help="Request handler threads, as in a threaded WSGI server (default: one per client)")
+        parser.add_argument('--mix', default='upload=1,query=9', help="Request mix as route=weight pairs")
+        parser.add_argument('--llm-latency', type=float, default=0.5, help="Seconds the fake LLM takes per call")
+        parser.add_argument('--upload-rows', type=int, default=200, help="Rows per uploaded dataset")
+        parser.add_argument('--collision-rate', type=float, default=0.0,
+                            help="Share of uploads that reuse one file name, to exercise MEDIA_ROOT collisions")
+        parser.add_argument('--mongo-uri', default='', help="Local mongod to use instead of the in-process stand-in")
+        parser.add_argument('--mongo-pool-size', type=int, default=0, help="maxPoolSize for --mongo-uri (default pymongo's)")
+        parser.add_argument('--mongo-wait-ms', type=int, default=0,
+                            help="waitQueueTimeoutMS for --mongo-uri, so pool exhaustion surfaces as errors")
+        parser.add_argument('--fake-embeddings', action='store_true',
+                            help="Use hashed embeddings instead of loading the sentence-transformers model")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default='', help="Write the results as JSON to this file")
+
+    def _upload_body(self, kind: str, name: str, rows: int, seed: int) -> dict:
+        content = synthetic_frame(kind, rows, seed * rows, seed).to_csv(index=False).encode('utf-8')
+        return {'file': SimpleUploadedFile(name, content, content_type='text/csv'), 'db_name': DB_NAME}
+
+    def _warm_up(self, options) -> list:
+        """Uploads one dataset per kind, untimed, so queries have indexes to hit. Returns their file names."""
+        client = Client()
+        filenames = []
+        for kind in SCHEMAS:
+            response = client.post(ROUTES['upload'], self._upload_body(kind, f"warmup_{kind}.csv", options['upload_rows'], options['seed']))
+            if response.status_code != 200:
+                raise CommandError(f"Warm-up upload of {kind} failed ({response.status_code}): {response.content[:500]!r}")
+            filenames.append(os.path.basename(response.json()['transformation_result']))
+        return filenames
+
+    def _run_level(self, concurrency: int, options: dict, weights: dict, filenames: list, queries: list) -> dict:
+        workers = threading.BoundedSemaphore(options['workers'] or concurrency)
+        rng = random.Random(f"{options['seed']}:{concurrency}")
+        routes = rng.choices(list(weights), weights=list(weights.values()), k=options['requests'])
+        # Decided up front so a run is reproducible whatever the thread interleaving
+        collides = [rng.random() < options['collision_rate'] for _ in routes]
+        upload_numbers, uploads = [], 0
+        for route in routes:
+            upload_numbers.append(uploads)
+            uploads += route == 'upload'
+        local = threading.local()
+
+        def call(position: int) -> dict:
+            route = routes[position]
+            if route == 'upload':
+                number = upload_numbers[position]
+                kind = list(SCHEMAS)[number % len(SCHEMAS)]
+                if collides[position]:
+                    name = f"collision_{kind}.csv"
+                else:
+                    name = f"load_{concurrency}_{number}_{kind}.csv"
+                data = self._upload_body(kind, name, options['upload_rows'], options['seed'] + number + 1)
+            else:
+                data = {'query': queries[position % len(queries)], 'filename': filenames[position % len(filenames)]}
+            if not hasattr(local, 'client'):
+                local.client = Client()
+
+            start_time = time.perf_counter()
+            with workers:
+                # Time spent waiting for a free handler thread
+                queued = time.perf_counter() - start_time
+                try:
+                    response = local.client.post(ROUTES[route], data)
+                    status = response.status_code
+                    error = ''
+                    if status >= 400:
+                        try:
+                            error = str(response.json().get('error', ''))
+                        except ValueError:
+                            error = response.content.decode('utf-8', errors='replace')
+                except Exception as e:
+                    status, error = 0, str(e)
+            return {'route': route, 'status': status, 'error': error[:120], 'failed': status == 0 or status >= 400,
+                    'seconds': time.perf_counter() - start_time, 'queued': queued}
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            outcomes = list(pool.map(call, range(options['requests'])))
+        seconds = time.perf_counter() - start_time
+
+        failed = [o for o in outcomes if o['failed']]
+        result = {
+            'concurrency': concurrency,
+            'workers': options['workers'] or concurrency,
+            'requests': len(outcomes),
+            'seconds': round(seconds, 3),
+            'throughput_rps': round(len(outcomes) / seconds, 2) if seconds else None,
+            'error_rate': round(len(failed) / len(outcomes), 4) if outcomes else 0.0,
+            'latency_ms': _percentiles([o['seconds'] for o in outcomes]),
+            'queue_wait_ms': _percentiles([o['queued'] for o in outcomes]),
+            'routes': {},
+            'errors': dict(Counter(f"{o['route']} {o['status']}: {o['error']}" for o in failed).most_common(10)),
+        }
+        for route in weights:
+            route_outcomes = [o for o in outcomes if o['route'] == route]
+            if route_outcomes:
+                result['routes'][route] = {
+                    'requests': len(route_outcomes),
+                    'error_rate': round(sum(o['failed'] for o in route_outcomes) / len(route_outcomes), 4),
+                    'latency_ms': _percentiles([o['seconds'] for o in route_outcomes]),
+                }
+        return result
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(level) for level in options['concurrency'].split(',') if level.strip()]
+        except ValueError:
+            raise CommandError("--concurrency must be comma-separated integers")
+        if not levels or min(levels) < 1 or options['requests'] < 1:
+            raise CommandError("--concurrency levels and --requests must be positive")
+        weights = _parse_mix(options['mix'])
+
+        pool_options = {}
+        if options['mongo_pool_size']:
+            pool_options['maxPoolSize'] = options['mongo_pool_size']
+        if options['mongo_wait_ms']:
+            pool_options['waitQueueTimeoutMS'] = options['mongo_wait_ms']
+        client = mongo_client(options['mongo_uri'], **pool_options)
+        seed_schemas(client, DB_NAME)
+
+        # Allows the test client's host name
+        setup_test_environment()
+        workdir = tempfile.mkdtemp(prefix='dataeng_loadtest_')
+        queries = [
+            "How many records are there in total?",
+            "Which location has the highest temperature?",
+            "Show the details for the first invoice",
+            "Summarize the sales by region",
+            "What is the average humidity?",
+        ]
+        results = {
+            'config': {key: options[key] for key in (
+                'requests', 'workers', 'mix', 'llm_latency', 'upload_rows', 'collision_rate', 'mongo_pool_size', 'seed')},
+            'mongo': 'mongod' if options['mongo_uri'] else 'mongomock',
+            'levels': [],
+        }
+        try:
+            with offline_pipeline(workdir, client, options['llm_latency'], options['fake_embeddings']), \
+                    override_settings(MEDIA_ROOT=os.path.join(workdir, 'media')):
+                filenames = self._warm_up(options)
+                for concurrency in levels:
+                    level = self._run_level(concurrency, options, weights, filenames, queries)
+                    results['levels'].append(level)
+                    self.stdout.write(
+                        f"c={concurrency:<4} {level['throughput_rps']:>8} req/s  "
+                        f"p50 {level['latency_ms']['p50']}ms  p95 {level['latency_ms']['p95']}ms  "
+                        f"p99 {level['latency_ms']['p99']}ms  errors {level['error_rate']:.1%}  "
+                        f"queue p95 {level['queue_wait_ms']['p95']}ms"
+                    )
+                    for error, count in level['errors'].items():
+                        self.stdout.write(f"    {count:>4} x {error}")
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        if options['output']:
+            os.makedirs(os.path.dirname(os.path.abspath(options['output'])), exist_ok=True)
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Wrote results to {options['output']}")
+        else:
+            self.stdout.write(json.dumps(results, indent=2))
@@ -1,3 +1,835 @@
-from django.test import TestCase
+import os
+import json
+import asyncio
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from datetime import datetime
+from unittest import mock, skipIf, SkipTest
+from django.test import SimpleTestCase, RequestFactory
+from django.core.management.base import CommandError
+from pymongo.errors import OperationFailure, ExecutionTimeout
+import pandas as pd
+from .agents import aggregate_agent
+from .agents.aggregate_agent import validate_pipeline, PipelineValidationError
+from .agents import ingestion_log
+from .agents import vector_index
+from .agents.vector_index import choose_index_params
+from .agents.hybrid_retriever import parse_predicates, key_hints
+from .agents.answer_cache import AnswerCache, query_specifics
+from .agents import chunker
+from .agents.chunker import parse_chunking, build_chunks, _windows
+from .agents import context_builder
+from .agents.context_builder import adaptive_k, mmr, build_context
+from .agents.metadata_cache import MetadataCache
+from .agents import index_cache, row_store
+from .agents.row_store import RowStore, write_row_store
+from .agents import single_flight
+from .agents.single_flight import SingleFlight
+from . import views
+from .views import metadata_response, processed_upload
+from .agents import data_ingestion
+from .agents.row_hash import ROW_HASH_FIELD, row_hash
+from .management.commands._pipeline_fakes import mongo_client
+from .agents import query_agent
+from .agents import async_mongo
+from . import async_views
 
-# Create your tests here.
+COLUMNS = ["region", "amount", "order_date"]
+META = {"db_name": "shop", "category": "Sales", "columns": COLUMNS, "filename": "transformed_sales.csv"}
+
+
+class ValidatePipelineTests(SimpleTestCase):
+    def test_accepts_whitelisted_pipeline_and_caps_output(self):
+        pipeline = [
+            {"$match": {"region": "north", "amount": {"$gt": 10}}},
+            {"$group": {"_id": "$region", "total": {"$sum": "$amount"}}},
+            {"$sort": {"total": -1}},
+        ]
+        validated = validate_pipeline(pipeline, COLUMNS)
+        self.assertEqual(validated[:3], pipeline)
+        self.assertEqual(validated[-1], {"$limit": aggregate_agent.AGGREGATE_MAX_RESULTS})
+
+    def test_rejects_stages_outside_the_whitelist(self):
+        for stage in (
+            {"$lookup": {"from": "users", "localField": "region", "foreignField": "_id", "as": "u"}},
+            {"$out": "stolen"},
+            {"$merge": {"into": "stolen"}},
+        ):
+            with self.subTest(stage=next(iter(stage))), self.assertRaises(PipelineValidationError):
+                validate_pipeline([stage], COLUMNS)
+
+    def test_rejects_code_execution_operators(self):
+        for pipeline in (
+            [{"$match": {"$where": "sleep(1000)"}}],
+            [{"$match": {"$expr": {"$function": {"body": "return 1", "args": [], "lang": "js"}}}}],
+            [{"$addFields": {"x": {"$function": {"body": "return 1", "args": [], "lang": "js"}}}}],
+        ):
+            with self.subTest(pipeline=pipeline), self.assertRaises(PipelineValidationError):
+                validate_pipeline(pipeline, COLUMNS)
+
+    def test_checks_operators_nested_in_expressions(self):
+        pipeline = [{"$group": {"_id": "$region", "x": {"$sum": {"$cond": [{"$accumulator": {}}, 1, 0]}}}}]
+        with self.assertRaises(PipelineValidationError):
+            validate_pipeline(pipeline, COLUMNS)
+
+    def test_rejects_unknown_field_references(self):
+        for pipeline in (
+            [{"$group": {"_id": "$password", "n": {"$sum": 1}}}],
+            [{"$match": {"secret": 1}}],
+            [{"$project": {"total": 1}}, {"$sort": {"x": 1}}, {"$addFields": {"y": "$missing.nested"}}],
+        ):
+            with self.subTest(pipeline=pipeline), self.assertRaises(PipelineValidationError):
+                validate_pipeline(pipeline, COLUMNS)
+
+    def test_allows_fields_created_by_earlier_stages(self):
+        pipeline = [
+            {"$group": {"_id": "$region", "total": {"$sum": "$amount"}}},
+            {"$project": {"share": {"$divide": ["$total", 100]}}},
+        ]
+        validate_pipeline(pipeline, COLUMNS)
+
+    def test_only_system_variables_are_allowed(self):
+        validate_pipeline([{"$project": {"row": "$$ROOT"}}], COLUMNS)
+        for variable in ("$$SEARCH_META", "$$USER_ROLES", "$$item"):
+            with self.subTest(variable=variable), self.assertRaises(PipelineValidationError):
+                validate_pipeline([{"$project": {"x": variable}}], COLUMNS)
+
+    def test_rejects_malformed_pipelines(self):
+        for pipeline in (None, [], {"$match": {}}, [{"$match": {}, "$limit": 1}], ["$match"]):
+            with self.subTest(pipeline=pipeline), self.assertRaises(PipelineValidationError):
+                validate_pipeline(pipeline, COLUMNS)
+
+
+class AnswerAggregateFallbackTests(SimpleTestCase):
+    def setUp(self):
+        aggregate_agent._cache.clear()
+        self.client = mock.MagicMock()
+        versions = self.client.__getitem__.return_value.__getitem__.return_value
+        versions.find_one.return_value = {"version": "v1", "filename": META["filename"]}
+        patcher = mock.patch.object(aggregate_agent, "get_mongo_client", return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_falls_back_when_the_pipeline_fails_to_run(self):
+        collection = self.client.__getitem__.return_value.__getitem__.return_value
+        for error in (OperationFailure("$sum type mismatch"), ExecutionTimeout("operation exceeded time limit")):
+            collection.aggregate.side_effect = error
+            with self.subTest(error=type(error).__name__), \
+                    mock.patch.object(aggregate_agent, "generate_pipeline", return_value=[{"$count": "n"}]):
+                self.assertIsNone(aggregate_agent.answer_aggregate("how many orders", META))
+
+    def test_falls_back_when_the_llm_fails(self):
+        with mock.patch.object(aggregate_agent, "generate_pipeline", side_effect=RuntimeError("quota exceeded")):
+            self.assertIsNone(aggregate_agent.answer_aggregate("how many orders", META))
+
+        collection = self.client.__getitem__.return_value.__getitem__.return_value
+        collection.aggregate.return_value = [{"n": 3}]
+        with mock.patch.object(aggregate_agent, "generate_pipeline", return_value=[{"$count": "n"}]), \
+                mock.patch.object(aggregate_agent, "phrase_answer", side_effect=ConnectionError("reset")):
+            self.assertIsNone(aggregate_agent.answer_aggregate("how many orders", META))
+
+    def test_falls_back_when_the_collection_holds_another_file(self):
+        versions = self.client.__getitem__.return_value.__getitem__.return_value
+        versions.find_one.return_value = {"version": "v2", "filename": "transformed_other.csv"}
+        with mock.patch.object(aggregate_agent, "generate_pipeline") as generate:
+            self.assertIsNone(aggregate_agent.answer_aggregate("how many orders", META))
+        generate.assert_not_called()
+
+
+def _append_entries(prefix: str, count: int):
+    for i in range(count):
+        ingestion_log.append_entry(f"{prefix}_{i:03d}.csv | Category: Sales | Valid: True | Time: 2026-01-01 10:00:{i % 60:02d}")
+
+
+class IngestionLogRotationTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        for name, value in (
+            ("LOG_DIR", directory),
+            ("LOG_FILE", os.path.join(directory, "ingestion.log")),
+            ("LOG_INDEX", os.path.join(directory, "ingestion.index.json")),
+            ("LOG_LOCK", os.path.join(directory, "ingestion.lock")),
+            # About two entries per segment
+            ("LOG_MAX_BYTES", 150),
+            ("LOG_MAX_SEGMENTS", 1000),
+        ):
+            patcher = mock.patch.object(ingestion_log, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _all_forward(self, limit: int) -> list:
+        entries, offset = [], 0
+        while True:
+            page = ingestion_log.read_forward(offset, limit=limit)
+            entries += page["entries"]
+            if not page["has_more"]:
+                return entries
+            offset = page["next_offset"]
+
+    def _all_backward(self, limit: int) -> list:
+        entries, before = [], None
+        while True:
+            page = ingestion_log.read_backward(before, limit=limit)
+            entries = page["entries"] + entries
+            if not page["has_more"]:
+                return entries
+            before = page["before"]
+
+    def test_cursors_cross_rotation_boundaries(self):
+        _append_entries("file", 20)
+        self.assertGreater(len(ingestion_log._read_index()["segments"]), 5)
+        expected = [f"file_{i:03d}.csv" for i in range(20)]
+        for limit in (1, 3, 7):
+            with self.subTest(limit=limit):
+                self.assertEqual([entry["filename"] for entry in self._all_forward(limit)], expected)
+                self.assertEqual([entry["filename"] for entry in self._all_backward(limit)], expected)
+
+    def test_forward_cursor_survives_a_later_rotation(self):
+        _append_entries("early", 3)
+        page = ingestion_log.read_forward(0, limit=100)
+        _append_entries("late", 6)
+        tail = ingestion_log.read_forward(page["next_offset"], limit=100)
+        self.assertEqual([entry["filename"] for entry in tail["entries"]], [f"late_{i:03d}.csv" for i in range(6)])
+
+    def test_offsets_point_at_their_lines(self):
+        _append_entries("file", 12)
+        for entry in self._all_forward(5):
+            page = ingestion_log.read_forward(entry["offset"], limit=1)
+            self.assertEqual(page["entries"][0]["text"], entry["text"])
+
+    @skipIf(ingestion_log.fcntl is None, "rotation is serialized across processes with fcntl.flock")
+    def test_concurrent_writers_in_several_processes(self):
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=_append_entries, args=(f"worker{w}", 30)) for w in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            self.assertEqual(worker.exitcode, 0)
+        names = [entry["filename"] for entry in self._all_forward(17)]
+        self.assertEqual(sorted(names), sorted(f"worker{w}_{i:03d}.csv" for w in range(4) for i in range(30)))
+        self.assertEqual([entry["filename"] for entry in self._all_backward(11)], names)
+
+
+class ChooseIndexParamsTests(SimpleTestCase):
+    def test_auto_picks_flat_then_ivf_then_pq_by_size(self):
+        small = choose_index_params(vector_index.FLAT_MAX_VECTORS, 384, kind="auto", storage="auto")
+        self.assertEqual((small["type"], small["storage"]), ("flat", "float32"))
+        self.assertNotIn("nlist", small)
+
+        medium = choose_index_params(vector_index.FLAT_MAX_VECTORS + 1, 384, kind="auto", storage="auto")
+        self.assertEqual((medium["type"], medium["storage"]), ("ivf", "float32"))
+
+        large = choose_index_params(vector_index.IVF_PQ_MIN_VECTORS, 384, kind="auto", storage="auto")
+        self.assertEqual((large["type"], large["storage"]), ("ivf", "pq"))
+        self.assertEqual(384 % large["pq_m"], 0)
+        self.assertEqual(large["pq_nbits"], 8)
+
+    def test_ivf_lists_have_enough_training_points(self):
+        for num_vectors in (100, 5000, 60000, 2000000):
+            with self.subTest(num_vectors=num_vectors):
+                params = choose_index_params(num_vectors, 384, kind="ivf", storage="float32")
+                self.assertGreaterEqual(params["nlist"], 1)
+                self.assertLessEqual(params["nlist"] * vector_index.MIN_POINTS_PER_CENTROID, num_vectors)
+                self.assertTrue(1 <= params["nprobe"] <= params["nlist"])
+                self.assertLessEqual(params["train_size"], num_vectors)
+
+    def test_aliases_and_explicit_storage(self):
+        params = choose_index_params(20000, 384, kind="ivf_pq", storage="auto")
+        self.assertEqual((params["type"], params["storage"]), ("ivf", "pq"))
+        self.assertEqual(choose_index_params(20000, 384, kind="ivf_flat", storage="auto")["storage"], "float32")
+        self.assertEqual(choose_index_params(20000, 384, kind="ivf_flat", storage="float16")["storage"], "float16")
+
+    def test_pq_falls_back_to_int8_without_enough_vectors(self):
+        params = choose_index_params(1000, 384, kind="ivf", storage="pq")
+        self.assertEqual(params["storage"], "int8")
+        self.assertNotIn("pq_m", params)
+
+    def test_hnsw_only_keeps_raw_vectors(self):
+        graph = choose_index_params(1000, 384, kind="hnsw", storage="float32")
+        self.assertEqual(graph["type"], "hnsw")
+        self.assertFalse(graph["supports_remove"])
+        self.assertEqual(graph["hnsw_m"], vector_index.HNSW_M)
+        compact = choose_index_params(1000, 384, kind="hnsw", storage="int8")
+        self.assertEqual((compact["type"], compact["storage"]), ("flat", "int8"))
+        self.assertTrue(compact["supports_remove"])
+
+    def test_binary_storage_reranks(self):
+        params = choose_index_params(1000, 384, kind="flat", storage="binary")
+        self.assertEqual(params["rerank_factor"], vector_index.BINARY_RERANK_FACTOR)
+
+    def test_rejects_unknown_kinds_and_storage(self):
+        with self.assertRaises(ValueError):
+            choose_index_params(1000, 384, kind="annoy", storage="auto")
+        with self.assertRaises(ValueError):
+            choose_index_params(1000, 384, kind="flat", storage="float8")
+
+
+class ParsePredicatesTests(SimpleTestCase):
+    columns = ["sensor_id", "region", "status", "reading"]
+
+    def test_named_columns_with_values(self):
+        self.assertEqual(parse_predicates("latest reading for sensor_id S-12", self.columns), [("sensor_id", "s-12")])
+        self.assertEqual(parse_predicates("readings from sensor id S-12", self.columns), [("sensor_id", "s-12")])
+        self.assertEqual(parse_predicates("orders where region = north", self.columns), [("region", "north")])
+        self.assertEqual(parse_predicates("tickets whose status is 'open'", self.columns), [("status", "open")])
+
+    def test_plain_words_after_a_column_are_not_values(self):
+        self.assertEqual(parse_predicates("which region sold most", self.columns), [])
+        self.assertEqual(parse_predicates("average reading for the week", self.columns), [])
+
+    def test_id_like_tokens_match_the_primary_key(self):
+        self.assertEqual(parse_predicates("details of INV001", ["amount"], primary_key="order_id"), [("order_id", "inv001")])
+        # Counts and years are not ids
+        self.assertEqual(parse_predicates("top 5 orders in 2024", ["amount"], primary_key="order_id"), [])
+        # A value already bound to a column is not repeated for the key
+        self.assertEqual(parse_predicates("sensor_id S-12", self.columns, primary_key="sensor_id"), [("sensor_id", "s-12")])
+
+    def test_key_hints_are_bare_numbers_not_already_used(self):
+        self.assertEqual(key_hints("top 5 orders in 2024", "order_id", []), [("order_id", "5"), ("order_id", "2024")])
+        predicates = parse_predicates("sensor_id 12 reading", self.columns, primary_key="sensor_id")
+        self.assertEqual(predicates, [("sensor_id", "12")])
+        self.assertEqual(key_hints("sensor_id 12 reading", "sensor_id", predicates), [])
+        self.assertEqual(key_hints("top 5 orders", None, []), [])
+
+
+class AnswerCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = AnswerCache(threshold=0.95, max_entries=2)
+        self.cache.store("sales.csv", "sig1", "total sales by region", [1.0, 0.0, 0.0], "North leads.", 2.0)
+
+    def test_hit_on_a_close_query(self):
+        self.assertEqual(self.cache.lookup("sales.csv", "sig1", [0.99, 0.05, 0.0]), "North leads.")
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def test_miss_below_threshold_or_on_other_datasets(self):
+        self.assertIsNone(self.cache.lookup("sales.csv", "sig1", [0.6, 0.8, 0.0]))
+        self.assertIsNone(self.cache.lookup("stock.csv", "sig1", [1.0, 0.0, 0.0]))
+        self.assertEqual(self.cache.stats()["misses"], 2)
+
+    def test_miss_when_specifics_differ(self):
+        meta = {"columns": ["invoice"]}
+        first, second = query_specifics("invoice 1001", meta), query_specifics("invoice 1002", meta)
+        self.assertEqual(first, (("", "1001"), ("invoice", "1001")))
+        self.cache.store("sales.csv", "sig1", "invoice 1001", [0.0, 1.0, 0.0], "Paid.", 1.0, specifics=first)
+        self.assertIsNone(self.cache.lookup("sales.csv", "sig1", [0.0, 1.0, 0.0], specifics=second))
+        self.assertEqual(self.cache.lookup("sales.csv", "sig1", [0.0, 1.0, 0.0], specifics=first), "Paid.")
+
+    def test_signature_change_drops_only_that_dataset(self):
+        self.cache.store("stock.csv", "sig1", "items low on stock", [0.0, 0.0, 1.0], "Three items.", 1.0)
+        self.assertIsNone(self.cache.lookup("sales.csv", "sig2", [1.0, 0.0, 0.0]))
+        self.assertIsNone(self.cache.lookup("sales.csv", "sig1", [1.0, 0.0, 0.0]))
+        self.assertEqual(self.cache.lookup("stock.csv", "sig1", [0.0, 0.0, 1.0]), "Three items.")
+
+    def test_invalidate_drops_only_that_dataset(self):
+        self.cache.store("stock.csv", "sig1", "items low on stock", [0.0, 0.0, 1.0], "Three items.", 1.0)
+        self.cache.invalidate("sales.csv")
+        self.assertIsNone(self.cache.lookup("sales.csv", "sig1", [1.0, 0.0, 0.0]))
+        self.assertEqual(self.cache.lookup("stock.csv", "sig1", [0.0, 0.0, 1.0]), "Three items.")
+
+    def test_oldest_entries_are_evicted(self):
+        self.cache.store("sales.csv", "sig1", "q2", [0.0, 1.0, 0.0], "Two.", 1.0)
+        self.cache.store("sales.csv", "sig1", "q3", [0.0, 0.0, 1.0], "Three.", 1.0)
+        self.assertIsNone(self.cache.lookup("sales.csv", "sig1", [1.0, 0.0, 0.0]))
+        self.assertEqual(self.cache.stats()["datasets"], {"sales": 2})
+
+
+class ParseChunkingTests(SimpleTestCase):
+    columns = ["order_id", "region", "ship:mode", "amount"]
+
+    def test_normalizes_specs(self):
+        self.assertEqual(parse_chunking("row", self.columns), "row")
+        self.assertEqual(parse_chunking("size", self.columns), f"size:{chunker.CHUNK_ROWS}")
+        self.assertEqual(parse_chunking(" SIZE : 16 ", self.columns), "size:16")
+        self.assertEqual(parse_chunking("key_range:4", self.columns, primary_key="order_id"), "key_range:4")
+        self.assertEqual(parse_chunking("group_by:region", self.columns), f"group_by:region:{chunker.CHUNK_ROWS}")
+        self.assertEqual(parse_chunking("group_by:region:4", self.columns), "group_by:region:4")
+        self.assertEqual(parse_chunking("group_by:ship:mode:4", self.columns), "group_by:ship:mode:4")
+
+    def test_invalid_sizes_use_the_default(self):
+        for spec in ("size:0", "size:-3", "size:many"):
+            with self.subTest(spec=spec):
+                self.assertEqual(parse_chunking(spec, self.columns), f"size:{chunker.CHUNK_ROWS}")
+
+    def test_falls_back_to_size_without_the_column(self):
+        self.assertEqual(parse_chunking("group_by:country:4", self.columns), "size:4")
+        self.assertEqual(parse_chunking("key_range:4", self.columns), "size:4")
+        self.assertEqual(parse_chunking("key_range:4", self.columns, primary_key="sku"), "size:4")
+
+    def test_rejects_unknown_strategies(self):
+        with self.assertRaises(ValueError):
+            parse_chunking("sentences:4", self.columns)
+
+
+class ChunkWindowTests(SimpleTestCase):
+    def test_windows_partition_positions_without_overlap(self):
+        positions = [4, 0, 3, 1, 2, 5, 6]
+        windows = _windows(positions, [1] * 7, rows=3, budget=100)
+        self.assertEqual(windows, [[4, 0, 3], [1, 2, 5], [6]])
+        self.assertEqual([position for window in windows for position in window], positions)
+
+    def test_windows_close_at_the_token_budget(self):
+        tokens = [4, 4, 4, 1, 1, 9]
+        self.assertEqual(_windows(list(range(6)), tokens, rows=10, budget=8), [[0, 1], [2, 3, 4], [5]])
+        # A line exactly at the budget fits; one over it still gets its own window
+        self.assertEqual(_windows([0, 1], [8, 8], rows=10, budget=8), [[0], [1]])
+        self.assertEqual(_windows([0], [20], rows=10, budget=8), [[0]])
+
+    def test_edge_sizes(self):
+        self.assertEqual(_windows([], [], rows=4, budget=8), [])
+        self.assertEqual(_windows([0, 1, 2], [1, 1, 1], rows=1, budget=8), [[0], [1], [2]])
+        self.assertEqual(_windows([0, 1, 2], [1, 1, 1], rows=3, budget=8), [[0, 1, 2]])
+
+    def test_build_chunks_fits_the_header_in_the_budget(self):
+        df = pd.DataFrame({"region": ["north", "south", "north", "north"], "amount": [1, 2, 3, 4]})
+        word_counts = lambda texts: [len(text.split()) for text in texts]
+        with mock.patch.object(chunker, "count_tokens", side_effect=word_counts), \
+                mock.patch.object(chunker, "token_budget", return_value=9), \
+                mock.patch.object(chunker, "CHUNK_MAX_TOKENS", 0):
+            chunks, row_chunks = build_chunks(df, [10, 11, 12, 13], "group_by:region:8")
+        # "region = north" and the header take 6 of 9 tokens, leaving one 3-token row per window
+        self.assertEqual([text.splitlines()[0] for _, text in chunks], ["region = north"] * 3 + ["region = south"])
+        self.assertEqual(len(set(row_chunks)), 4)
+        self.assertTrue(all(len(text.split()) <= 9 for _, text in chunks))
+
+
+class FakeRowStore:
+    """Row texts and fields in memory, with the lookups build_context makes on a RowStore."""
+
+    def __init__(self, rows: dict, columns: list, primary_key: str = None):
+        self.rows = rows
+        self.meta = {"columns": columns, "primary_key": primary_key}
+
+    def fetch_by_id(self, row_ids: list) -> dict:
+        return {i: " | ".join(str(value) for value in self.rows[i].values()) for i in row_ids if i in self.rows}
+
+    def fetch_fields(self, row_ids: list) -> dict:
+        return {i: self.rows[i] for i in row_ids if i in self.rows}
+
+
+class ContextBuilderTests(SimpleTestCase):
+    def setUp(self):
+        for name, value in (("CONTEXT_MIN_K", 1), ("CONTEXT_MAX_K", 10), ("CONTEXT_DISTANCE_MARGIN", 0.25),
+                            ("CONTEXT_MAX_DISTANCE", 1.2), ("CONTEXT_MMR_LAMBDA", 0.7),
+                            ("CONTEXT_DEDUPE_THRESHOLD", 0.9), ("CONTEXT_TOKEN_BUDGET", 1500)):
+            patcher = mock.patch.object(context_builder, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_adaptive_k_keeps_close_exact_and_earlier_keyword_rows(self):
+        ranked = [1, 2, 3, 4, 5, 6]
+        distances = {1: 0.2, 2: 0.3, 4: 0.9, 5: 0.4}
+        # 3 and 6 are keyword-only; 3 ranks ahead of the last close row (5), 6 after it
+        self.assertEqual(adaptive_k(ranked, distances, []), [1, 2, 3, 5])
+        self.assertEqual(adaptive_k(ranked, distances, [4]), [1, 2, 3, 4, 5])
+
+    def test_adaptive_k_limits(self):
+        with mock.patch.object(context_builder, "CONTEXT_MAX_K", 3):
+            self.assertEqual(adaptive_k([1, 2, 3, 4], {1: 0.1, 2: 0.1, 3: 0.1, 4: 0.1}, [4]), [1, 2, 3])
+        # Nothing within CONTEXT_MAX_DISTANCE: only the first CONTEXT_MIN_K and exact matches
+        self.assertEqual(adaptive_k([1, 2, 3], {1: 1.5, 2: 1.6, 3: 1.7}, [3]), [1, 3])
+        self.assertEqual(adaptive_k([1, 2, 3], {}, []), [1])
+        self.assertEqual(adaptive_k([], {}, []), [])
+
+    def test_mmr_drops_near_duplicates(self):
+        texts = {1: "north 10 apples", 2: "north 10 apples", 3: "south 20 pears"}
+        self.assertEqual(mmr([1, 2, 3], texts), [1, 3])
+
+    def test_mmr_trades_rank_for_diversity(self):
+        texts = {1: "x y z", 2: "x y w", 3: "p q r"}
+        self.assertEqual(mmr([1, 2, 3], texts), [1, 2, 3])
+        with mock.patch.object(context_builder, "CONTEXT_MMR_LAMBDA", 0.5):
+            self.assertEqual(mmr([1, 2, 3], texts), [1, 3, 2])
+
+    def test_build_context_stops_at_the_token_budget(self):
+        rows = {i: {"a": f"id{i:02d}", "b": f"value{i:02d}" * 3} for i in range(5)}
+        store = FakeRowStore(rows, ["a", "b"])
+        header_tokens = context_builder.estimate_tokens("Columns: a, b")
+        row_tokens = context_builder.estimate_tokens(store.fetch_by_id([0])[0])
+        with mock.patch.object(context_builder, "CONTEXT_MIN_K", 10), \
+                mock.patch.object(context_builder, "CONTEXT_TOKEN_BUDGET", header_tokens + 2 * row_tokens):
+            context, stats = build_context("list the rows", store, list(range(5)), {}, [])
+        self.assertEqual(context.splitlines(), ["Columns: a, b", store.fetch_by_id([0])[0], store.fetch_by_id([1])[1]])
+        self.assertEqual(stats["rows"], 2)
+        self.assertEqual(stats["tokens"], header_tokens + 2 * row_tokens)
+        self.assertEqual(stats["tokens_saved"], stats["baseline_tokens"] - stats["tokens"])
+        self.assertGreater(stats["tokens_saved"], 0)
+
+    def test_build_context_projects_onto_named_columns(self):
+        rows = {1: {"region": "north", "amount": 5, "order_date": "2026-01-02"}}
+        store = FakeRowStore(rows, ["region", "amount", "order_date"])
+        context, stats = build_context("amount by region", store, [1], {1: 0.1}, [])
+        self.assertEqual(context, "region: north; amount: 5")
+        self.assertEqual(stats["columns"], 2)
+
+
+class MetadataResponseTests(SimpleTestCase):
+    def setUp(self):
+        self.cached = MetadataCache(ttl=60).set(("databases",), ["shop", "plant"])
+        self.etag = self.cached[1]
+
+    def _get(self, if_none_match: str = None):
+        headers = {"HTTP_IF_NONE_MATCH": if_none_match} if if_none_match is not None else {}
+        return metadata_response(RequestFactory().get("/list_databases/", **headers), self.cached, "databases")
+
+    def test_full_response_carries_the_etag(self):
+        response = self._get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {"databases": ["shop", "plant"]})
+        self.assertEqual(response["ETag"], self.etag)
+        self.assertEqual(response["Cache-Control"], "no-cache")
+
+    def test_matching_tags_get_an_empty_304(self):
+        for header in (self.etag, f"W/{self.etag}", f'"stale", {self.etag}', "*"):
+            with self.subTest(header=header):
+                response = self._get(header)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response.content, b"")
+                self.assertEqual(response["ETag"], self.etag)
+
+    def test_other_tags_get_the_listing(self):
+        for header in ('"stale"', 'W/"stale"', self.etag.strip('"'), ""):
+            with self.subTest(header=header):
+                self.assertEqual(self._get(header).status_code, 200)
+
+    def test_etag_follows_the_value(self):
+        cache = MetadataCache(ttl=60)
+        self.assertEqual(cache.set(("databases",), ["shop", "plant"])[1], self.etag)
+        self.assertNotEqual(cache.set(("databases",), ["shop"])[1], self.etag)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_concurrent_callers_share_one_run(self):
+        flights, started, release, joined = SingleFlight(), threading.Event(), threading.Event(), threading.Semaphore(0)
+        calls, results = [], []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "done"
+
+        def call():
+            results.append(flights.do("key", work))
+
+        threads = [threading.Thread(target=call)]
+        threads[0].start()
+        started.wait(5)
+        with mock.patch.object(single_flight.logger, "info", side_effect=lambda message: joined.release()):
+            threads += [threading.Thread(target=call) for _ in range(3)]
+            for thread in threads[1:]:
+                thread.start()
+            for _ in range(3):
+                self.assertTrue(joined.acquire(timeout=5))
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [("done", False)] + [("done", True)] * 3)
+
+    def test_errors_are_shared_and_the_key_is_released(self):
+        flights, started, release = SingleFlight(), threading.Event(), threading.Event()
+        errors = []
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise ValueError("bad upload")
+
+        def call():
+            try:
+                flights.do("key", fail)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call)]
+        threads[0].start()
+        started.wait(5)
+        threads.append(threading.Thread(target=call))
+        threads[1].start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(flights.do("key", lambda: "retried"), ("retried", False))
+
+    def test_different_keys_run_separately(self):
+        flights = SingleFlight()
+        self.assertEqual(flights.do(("shop", "abc", "", ""), lambda: 1), (1, False))
+        self.assertEqual(flights.do(("shop", "abc", "pq", ""), lambda: 2), (2, False))
+
+
+class ProcessedUploadTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory)
+        os.makedirs("clean_data")
+        patcher = mock.patch.object(index_cache, "VECTOR_DB_DIR", directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.vector_db_path, rows_path = index_cache.index_paths("transformed_sales.csv")
+        report_path = os.path.join(directory, "sales_report.md")
+        for path in (os.path.join("clean_data", "transformed_sales.csv"), self.vector_db_path, rows_path, report_path):
+            with open(path, "w") as f:
+                f.write("x")
+        embedded_at = datetime.fromtimestamp(os.path.getmtime(self.vector_db_path) + 60).isoformat(timespec='milliseconds')
+        self.dataset = {"filename": "sales.csv", "clean_file": "transformed_sales.csv", "category": "Sales", "valid": 1,
+                        "report_path": report_path, "vectors": 4, "embedded_at": embedded_at}
+        columns = ["region", "amount"]
+        self.meta = {"db_name": "shop", "columns": columns, "primary_key": None,
+                     "chunking": parse_chunking("size:8", columns), "index": {"ntotal": 4, "storage": "float32"}}
+        for target, attribute, value in ((views.dataset_registry, "find_by_hash", lambda db_name, content_hash: self.dataset),
+                                         (row_store, "RowStore", lambda path: mock.Mock(meta=self.meta))):
+            patcher = mock.patch.object(target, attribute, side_effect=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_matches_the_same_storage_and_chunking(self):
+        result = processed_upload("shop", "abc", "float32", "size:8")
+        self.assertTrue(result["deduplicated"])
+        self.assertEqual(result["vector_db_path"], self.vector_db_path)
+        self.assertTrue(result["valid"])
+
+    def test_other_storage_or_chunking_is_processed_again(self):
+        self.assertIsNone(processed_upload("shop", "abc", "pq", "size:8"))
+        self.assertIsNone(processed_upload("shop", "abc", "float32", "size:16"))
+        self.assertIsNone(processed_upload("shop", "abc", "float32", "group_by:region"))
+        self.assertIsNone(processed_upload("shop", "abc", "float32", "sentences"))
+
+    def test_index_must_still_hold_the_upload(self):
+        self.assertIsNone(processed_upload("plant", "abc", "float32", "size:8"))
+        self.meta["db_name"] = "plant"
+        self.assertIsNone(processed_upload("shop", "abc", "float32", "size:8"))
+        self.meta["db_name"] = "shop"
+        self.meta["index"]["ntotal"] = 5
+        self.assertIsNone(processed_upload("shop", "abc", "float32", "size:8"))
+        self.meta["index"]["ntotal"] = 4
+        self.dataset["embedded_at"] = "2000-01-01T00:00:00.000"
+        self.assertIsNone(processed_upload("shop", "abc", "float32", "size:8"))
+
+    def test_missing_or_failed_uploads_are_processed_again(self):
+        self.dataset["valid"] = None
+        self.assertIsNone(processed_upload("shop", "abc", "float32", "size:8"))
+        self.dataset["valid"] = 1
+        os.remove(self.vector_db_path)
+        self.assertIsNone(processed_upload("shop", "abc", "float32", "size:8"))
+
+
+class RowHashTests(SimpleTestCase):
+    def test_stable_across_key_order_and_stored_fields(self):
+        record = {"invoice_id": 7, "region": "north", "amount": 12.5}
+        digest = row_hash(record)
+        self.assertRegex(digest, r"^[0-9a-f]{32}$")
+        self.assertEqual(row_hash({"amount": 12.5, "region": "north", "invoice_id": 7}), digest)
+        self.assertEqual(row_hash(dict(record, _id="65f0c0ffee", **{ROW_HASH_FIELD: digest})), digest)
+
+    def test_changes_with_the_content(self):
+        record = {"invoice_id": 7, "region": "north"}
+        self.assertNotEqual(row_hash(dict(record, region="south")), row_hash(record))
+        self.assertNotEqual(row_hash(dict(record, invoice_id="7")), row_hash(record))
+        self.assertNotEqual(row_hash(dict(record, note=None)), row_hash(record))
+
+
+class InsertToMongoTests(SimpleTestCase):
+    def setUp(self):
+        try:
+            self.client = mongo_client()
+        except CommandError as e:
+            raise SkipTest(str(e))
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.path = os.path.join(directory, "sales.csv")
+        for patcher in (mock.patch.object(data_ingestion, "get_mongo_client", lambda: self.client),
+                        mock.patch.object(data_ingestion.dataset_registry, "record")):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _ingest(self, rows: list, primary_key: str) -> str:
+        pd.DataFrame(rows).to_csv(self.path, index=False)
+        return data_ingestion.insert_to_mongo_tool.invoke({
+            "filepath": self.path, "filename": "sales.csv", "db_name": "shop",
+            "category": "Sales", "primary_key": primary_key,
+        })
+
+    def _stored(self) -> list:
+        return sorted((doc["region"], doc["amount"]) for doc in self.client["shop"]["sales"].find())
+
+    def test_unkeyed_duplicate_rows_are_kept(self):
+        repeated, other = {"region": "north", "amount": 5}, {"region": "south", "amount": 8}
+        self.assertEqual(self._ingest([repeated, repeated, other], "invoice_id"), "Inserted/Updated 3 records, Skipped 0 duplicates")
+        self.assertEqual(self._stored(), [("north", 5), ("north", 5), ("south", 8)])
+
+        # Re-ingesting the same file changes nothing; a third copy of the row is a new record
+        self.assertEqual(self._ingest([repeated, repeated, other], "invoice_id"), "Inserted/Updated 0 records, Skipped 3 duplicates")
+        self.assertEqual(self._ingest([repeated, other, repeated, repeated], "invoice_id"), "Inserted/Updated 1 records, Skipped 3 duplicates")
+        self.assertEqual(self._stored(), [("north", 5)] * 3 + [("south", 8)])
+
+    def test_keyed_rows_are_written_once_per_key(self):
+        rows = [{"invoice_id": 1, "region": "north", "amount": 5}, {"invoice_id": 2, "region": "south", "amount": 8},
+                {"invoice_id": 2, "region": "south", "amount": 8}]
+        self.assertEqual(self._ingest(rows, "invoice_id"), "Inserted/Updated 2 records, Skipped 1 duplicates")
+        rows[1] = rows[2] = dict(rows[1], amount=9)
+        self.assertEqual(self._ingest(rows, "invoice_id"), "Inserted/Updated 1 records, Skipped 2 duplicates")
+        self.assertEqual(self._stored(), [("north", 5), ("south", 9)])
+
+
+class ShardQueryTests(SimpleTestCase):
+    results = [
+        {"filename": "north.csv", "category": "Sales", "db_name": "shop", "row_id": 1, "distance": 0.2, "text": "north | 5"},
+        {"filename": "south.csv", "category": "Sales", "db_name": "shop", "row_id": 7, "distance": 0.3, "text": "south | 8"},
+        {"filename": "north.csv", "category": "Sales", "db_name": "shop", "row_id": 2, "distance": 1.5, "text": "east | 1"},
+    ]
+    datasets = [{"filename": "north.csv", "category": "Sales", "db_name": "shop"},
+                {"filename": "south.csv", "category": "Sales", "db_name": "shop"}]
+
+    def setUp(self):
+        self.generate = mock.Mock(return_value="North and south both sold.")
+        for patcher in (
+            mock.patch.object(query_agent, "list_shards", return_value=["north.csv", "south.csv"]),
+            mock.patch.object(query_agent, "shards_signature", return_value=("sig",)),
+            mock.patch.object(query_agent, "merged_meta", return_value={"columns": [], "primary_key": None}),
+            mock.patch.object(query_agent, "shard_sources", return_value=self.datasets),
+            mock.patch.object(query_agent, "encode", return_value=[[1.0, 0.0]]),
+            mock.patch.object(query_agent, "sharded_search", return_value=self.results),
+            mock.patch.object(query_agent, "generate_answer", self.generate),
+            mock.patch.object(query_agent, "answer_cache", AnswerCache()),
+            mock.patch.object(query_agent, "ANSWER_CACHE_ENABLED", True),
+            mock.patch.object(context_builder, "CONTEXT_MIN_K", 1),
+            mock.patch.object(context_builder, "CONTEXT_DISTANCE_MARGIN", 0.25),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_merged_hits_go_through_build_context(self):
+        with mock.patch.object(query_agent, "is_analytical", return_value=False):
+            response, sources = query_agent.process_shard_query("what sold in each region", "Sales")
+        self.assertEqual(response, "North and south both sold.")
+        # The far row is left out by adaptive k, and only rows in the context are cited
+        self.generate.assert_called_once_with("what sold in each region", "[north.csv] north | 5\n[south.csv] south | 8")
+        self.assertEqual(sources, [{key: value for key, value in result.items() if key != "text"} for result in self.results[:2]])
+
+    def test_cached_answers_are_plain_strings(self):
+        with mock.patch.object(query_agent, "is_analytical", return_value=False):
+            query_agent.process_shard_query("what sold in each region", "Sales")
+            response, sources = query_agent.process_shard_query("what sold in each region", "Sales")
+        self.assertEqual(response, "North and south both sold.")
+        self.assertEqual(sources, self.datasets)
+        self.assertEqual(self.generate.call_count, 1)
+        self.assertEqual(query_agent.answer_cache.stats()["hits"], 1)
+
+    def test_aggregates_run_per_shard(self):
+        answers = {"north.csv": "Total 5.", "south.csv": "Total 8."}
+        stores = {name: mock.Mock(meta={"filename": name}) for name in answers}
+        with mock.patch.object(query_agent, "is_analytical", return_value=True), \
+                mock.patch.object(query_agent, "open_dataset", side_effect=lambda name: (None, stores[name])), \
+                mock.patch.object(query_agent, "aggregate_answer", side_effect=lambda query, store: answers[store.meta["filename"]]):
+            response, sources = query_agent.process_shard_query("total amount by file", db_name="shop")
+        self.assertEqual(response, "north.csv: Total 5.\nsouth.csv: Total 8.")
+        self.assertEqual(sources, self.datasets)
+        self.generate.assert_not_called()
+
+    def test_no_shards(self):
+        with mock.patch.object(query_agent, "list_shards", return_value=[]):
+            response, sources = query_agent.process_shard_query("anything", "Inventory")
+        self.assertTrue(response.startswith("Error: No vector DBs found"))
+        self.assertEqual(sources, [])
+
+
+class AsyncMongoClientTests(SimpleTestCase):
+    def test_one_client_per_loop_closed_at_shutdown(self):
+        clients = []
+
+        def make_client(uri):
+            clients.append(mock.Mock())
+            return clients[-1]
+
+        async def use():
+            first = async_mongo.get_async_mongo_client()
+            self.assertIs(async_mongo.get_async_mongo_client(), first)
+            self.assertFalse(first.close.called)
+
+        with mock.patch.dict(os.environ, {"MONGO_URI": "mongodb://localhost:27017"}), \
+                mock.patch("motor.motor_asyncio.AsyncIOMotorClient", side_effect=make_client):
+            asyncio.run(use())
+            asyncio.run(use())
+        self.assertEqual(len(clients), 2)
+        for client in clients:
+            client.close.assert_called_once_with()
+        self.assertEqual(async_mongo._clients, {})
+
+
+class AsyncQueryRagTests(SimpleTestCase):
+    def setUp(self):
+        async def stream(query, filename):
+            yield "token", "North "
+            yield "token", "leads."
+            yield "metadata", {"source": "rag"}
+
+        self.agent = mock.Mock(astream_query=stream,
+                               process_shard_query=mock.Mock(return_value=("North leads.", [{"filename": "north.csv"}])),
+                               aprocess_query=mock.AsyncMock(return_value="North leads."))
+        patcher = mock.patch.object(async_views, "load_query_agent", mock.AsyncMock(return_value=self.agent))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _post(self, data: dict, **headers):
+        return asyncio.run(async_views.query_rag(RequestFactory().post("/async/query_rag/", data, **headers)))
+
+    def test_streams_when_asked(self):
+        async def read(response):
+            return b"".join([part async for part in response.streaming_content]).decode()
+
+        for data, headers in (({"query": "top region", "filename": "sales.csv", "stream": "1"}, {}),
+                              ({"query": "top region", "filename": "sales.csv"}, {"HTTP_ACCEPT": "text/event-stream"})):
+            with self.subTest(data=data, headers=headers):
+                response = self._post(data, **headers)
+                self.assertEqual(response["Content-Type"], "text/event-stream")
+                body = asyncio.run(read(response))
+                self.assertIn('event: token\ndata: "North "', body)
+                self.assertTrue(body.endswith('event: metadata\ndata: {"source": "rag"}\n\n'))
+
+    def test_queries_shards_without_a_filename(self):
+        response = self._post({"query": "top region", "category": "Sales", "db_name": "shop"})
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(response.content)
+        self.assertEqual((body["response"], body["sources"]), ("North leads.", [{"filename": "north.csv"}]))
+        self.agent.process_shard_query.assert_called_once_with("top region", "Sales", "shop")
+
+    def test_single_file_and_missing_fields(self):
+        response = self._post({"query": "top region", "filename": "sales.csv"})
+        self.assertEqual(json.loads(response.content)["response"], "North leads.")
+        self.agent.aprocess_query.assert_awaited_once_with("top region", "sales.csv")
+        self.assertEqual(self._post({"query": "top region"}).status_code, 400)
+
+
+class WriteRowStoreTests(SimpleTestCase):
+    def test_threads_rewriting_one_store(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        path = os.path.join(directory, "sales_rows.sqlite3")
+        errors = []
+
+        def write(version):
+            try:
+                rows = [(i, f"north | {i * version}", {"region": "north", "amount": i * version}) for i in range(200)]
+                write_row_store(path, rows, {"version": version, "columns": ["region", "amount"]})
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write, args=(version,)) for version in range(1, 9)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        store = RowStore(path)
+        version = store.meta["version"]
+        self.assertEqual(store.fetch_by_id([3]), {3: f"north | {3 * version}"})
+        self.assertEqual(store.count(), 200)
+        self.assertEqual(os.listdir(directory), ["sales_rows.sqlite3"])
@@ -1,9 +1,11 @@
 from django.urls import path
 from .views import *
+from . import async_views
 
 urlpatterns = [
     path('upload/', upload_and_analyze, name='upload_and_analyze'),
     path('query_rag/', query_rag, name='query_rag'),
+    path('query_batch/', query_batch, name='query_batch'),
     path('available_files/', available_files, name='available_files'),
     path('save_schema/', save_schema, name='save_schema'),
     path('list_databases/', list_databases, name='list_databases'),
@@ -13,4 +15,13 @@ urlpatterns = [
     path('get_schema/', get_schema, name='get_schema'),
     path('get_logs/', get_logs, name='get_logs'),
     path('download_pdf/', download_pdf, name='download_pdf'),
+    path('cache_stats/', cache_stats, name='cache_stats'),
+    # Async (ASGI) variants of the metadata endpoints and query_rag
+    path('async/list_databases/', async_views.list_databases, name='async_list_databases'),
+    path('async/list_collections/', async_views.list_collections, name='async_list_collections'),
+    path('async/list_schemas/', async_views.list_schemas, name='async_list_schemas'),
+    path('async/get_schema/', async_views.get_schema, name='async_get_schema'),
+    path('async/save_schema/', async_views.save_schema, name='async_save_schema'),
+    path('async/delete_schema/', async_views.delete_schema, name='async_delete_schema'),
+    path('async/query_rag/', async_views.query_rag, name='async_query_rag'),
 ]
\ No newline at end of file
@@ -1,43 +1,91 @@
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.conf import settings
+from django.utils.http import parse_etags
 import os
-import pandas as pd
 import logging
-from pymongo import MongoClient
-from .agents.data_ingestion import ingest_file
-from .agents.transformation_agent import transform_file
-from .agents.report_agent import run_report_agent
-from .agents.rag_agent import run_rag_agent
-from .agents.query_agent import process_query
+from .agents.metadata_cache import metadata_cache
+from .agents.ingestion_log import LOG_PAGE_SIZE, read_forward, read_backward
+from .agents.tracing import start_trace, span, metrics
+from .agents.profiling import profile_session, job_profiling_enabled, admit_job, WorkerBusy
+from .agents import dataset_registry
+from .agents.single_flight import SingleFlight
 import json
-import markdown
 import subprocess
 import tempfile
 import re
+import hmac
+from datetime import datetime
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+QUERY_BATCH_MAX = int(os.getenv("QUERY_BATCH_MAX", "500"))
+
+# Uploads being processed, keyed by (db_name, content hash), so identical ones run once
+upload_flights = SingleFlight()
+
+def sse_event(event: str, data) -> str:
+    """Formats one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+def profiling_requested(request) -> bool:
+    """
+    True when the request asks to be profiled (X-Profile header or ?profile=1) and comes
+    from a staff user or carries the PROFILE_TOKEN in X-Profile-Token.
+    """
+    flag = request.headers.get('X-Profile') or request.GET.get('profile')
+    if str(flag).lower() not in ('1', 'true', 'yes'):
+        return False
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated and user.is_staff:
+        return True
+    token = os.getenv("PROFILE_TOKEN")
+    if token and hmac.compare_digest(request.headers.get('X-Profile-Token', ''), token):
+        return True
+    logger.warning("Ignoring profiling request from a non-admin client")
+    return False
+
 def get_mongo_client():
     """Initialize MongoDB client from environment variable."""
     mongo_uri = os.getenv("MONGO_URI")
     if not mongo_uri:
         logger.error("MONGO_URI not set in environment variables")
         raise ValueError("MONGO_URI not set")
+    from pymongo import MongoClient
     return MongoClient(mongo_uri)
 
+def metadata_response(request, cached: tuple, body_key: str):
+    """
+    Serves a (value, etag) metadata listing from the cache. Responses carry the ETag; an
+    If-None-Match of "*" or listing this exact tag (weak or strong) gets an empty 304
+    (these POST endpoints are reads).
+    """
+    value, etag = cached
+    listed = {tag[2:] if tag.startswith('W/') else tag for tag in parse_etags(request.headers.get('If-None-Match', ''))}
+    if '*' in listed or etag in listed:
+        response = HttpResponse(status=304)
+    else:
+        response = JsonResponse({body_key: value}, status=200)
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+    return response
+
 @csrf_exempt
 def list_databases(request):
     if request.method == 'GET':
-        try:
+        def load():
             client = get_mongo_client()
             databases = client.list_database_names()
             client.close()
             system_dbs = ['admin', 'local', 'config']
             databases = [db for db in databases if db not in system_dbs]
             logger.info(f"Retrieved database list: {databases}")
-            return JsonResponse({'databases': databases}, status=200)
+            return databases
+
+        try:
+            key = ('databases',)
+            return metadata_response(request, metadata_cache.get(key) or metadata_cache.set(key, load()), 'databases')
         except Exception as e:
             logger.error(f"Error listing databases: {str(e)}")
             return JsonResponse({'error': str(e)}, status=500)
@@ -53,13 +101,17 @@ def list_collections(request):
                 logger.error("Missing db_name")
                 return JsonResponse({'error': 'Missing db_name'}, status=400)
 
-            client = get_mongo_client()
-            db = client[db_name]
-            collections = db.list_collection_names()
-            client.close()
-            collections = [col for col in collections if col != 'schemas']
-            logger.info(f"Retrieved collections for {db_name}: {collections}")
-            return JsonResponse({'collections': collections}, status=200)
+            def load():
+                client = get_mongo_client()
+                db = client[db_name]
+                collections = db.list_collection_names()
+                client.close()
+                collections = [col for col in collections if col not in ('schemas', 'dataset_versions')]
+                logger.info(f"Retrieved collections for {db_name}: {collections}")
+                return collections
+
+            key = ('collections', db_name)
+            return metadata_response(request, metadata_cache.get(key) or metadata_cache.set(key, load()), 'collections')
         except Exception as e:
             logger.error(f"Error listing collections for {db_name}: {str(e)}")
             return JsonResponse({'error': str(e)}, status=500)
@@ -75,13 +127,17 @@ def list_schemas(request):
                 logger.error("Missing db_name")
                 return JsonResponse({'error': 'Missing db_name'}, status=400)
 
-            client = get_mongo_client()
-            db = client[db_name]
-            schemas_collection = db['schemas']
-            schemas = list(schemas_collection.find({}, {'_id': 0, 'category': 1, 'columns': 1}))
-            client.close()
-            logger.info(f"Retrieved schemas for {db_name}: {schemas}")
-            return JsonResponse({'schemas': schemas}, status=200)
+            def load():
+                client = get_mongo_client()
+                db = client[db_name]
+                schemas_collection = db['schemas']
+                schemas = list(schemas_collection.find({}, {'_id': 0, 'category': 1, 'columns': 1}))
+                client.close()
+                logger.info(f"Retrieved schemas for {db_name}: {schemas}")
+                return schemas
+
+            key = ('schemas', db_name)
+            return metadata_response(request, metadata_cache.get(key) or metadata_cache.set(key, load()), 'schemas')
         except Exception as e:
             logger.error(f"Error listing schemas for {db_name}: {str(e)}")
             return JsonResponse({'error': str(e)}, status=500)
@@ -141,6 +197,7 @@ def save_schema(request):
                 upsert=True
             )
             client.close()
+            metadata_cache.invalidate('schemas', db_name)
 
             logger.info(f"Saved schema for {db_name}.{category}: {columns}")
             return JsonResponse({'message': 'Schema saved successfully'})
@@ -166,6 +223,7 @@ def delete_schema(request):
             schemas_collection = db['schemas']
             result = schemas_collection.delete_one({"category": category})
             client.close()
+            metadata_cache.invalidate('schemas', db_name)
             if result.deleted_count == 0:
                 logger.info(f"No schema found to delete for {db_name}.{category}")
                 return JsonResponse({'message': 'No schema found to delete'}, status=200)
@@ -176,20 +234,53 @@ def delete_schema(request):
             return JsonResponse({'error': str(e)}, status=500)
     return JsonResponse({'error': 'Invalid request method'}, status=400)
 
+def log_time(value: str) -> datetime:
+    """
+    Parses an ISO time for the log filters. Log entries carry naive local times, so a time
+    with an offset is converted to local time and made naive to be comparable.
+    """
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
 @csrf_exempt
 def get_logs(request):
+    """
+    Pages through the ingestion log. Without parameters returns the newest entries;
+    `before` pages further back, `offset` tails from a previous `next_offset`. Entries can
+    be filtered by filename, category and ISO `since`/`until` times. `logs` keeps the
+    plain-text view of the returned lines.
+    """
     if request.method == 'GET':
         try:
-            log_file = os.path.join('logs', 'ingestion.log')
-            if not os.path.exists(log_file):
-                logger.info(f"Log file {log_file} not found")
-                return JsonResponse({'logs': 'No logs available'}, status=200)
-            
-            with open(log_file, 'r', encoding='utf-8') as f:
-                logs = f.read()
-            
-            logger.info(f"Retrieved logs from {log_file}")
-            return JsonResponse({'logs': logs}, status=200)
+            params = request.GET
+            try:
+                limit = min(max(int(params.get('limit', LOG_PAGE_SIZE)), 1), 1000)
+                offset = int(params['offset']) if params.get('offset') else None
+                before = int(params['before']) if params.get('before') else None
+                since = log_time(params['since']) if params.get('since') else None
+                until = log_time(params['until']) if params.get('until') else None
+            except ValueError as e:
+                logger.error(f"Invalid log query parameters: {str(e)}")
+                return JsonResponse({'error': f'Invalid parameter: {str(e)}'}, status=400)
+
+            filters = {
+                'filename': params.get('filename', ''),
+                'category': params.get('category', ''),
+                'since': since,
+                'until': until,
+            }
+            if offset is not None:
+                page = read_forward(offset, limit, **filters)
+            else:
+                page = read_backward(before, limit, **filters)
+
+            if not page['entries'] and offset is None and before is None and not any(params.values()):
+                return JsonResponse(dict(page, logs='No logs available'), status=200)
+            page['logs'] = "".join(entry['text'] + "\n" for entry in page['entries'])
+            logger.info(f"Retrieved {len(page['entries'])} log entries up to offset {page['next_offset']}")
+            return JsonResponse(page, status=200)
         except Exception as e:
             logger.error(f"Error reading logs: {str(e)}")
             return JsonResponse({'error': str(e)}, status=500)
@@ -216,6 +307,7 @@ def download_pdf(request):
                 markdown_content = f.read()
 
             # Convert Markdown to HTML
+            import markdown
             html_content = markdown.markdown(markdown_content, extensions=['tables', 'fenced_code'])
 
             # Sanitize HTML to escape LaTeX special characters
@@ -294,12 +386,172 @@ def download_pdf(request):
 
     return JsonResponse({'error': 'Invalid request method'}, status=400)
 
+def save_upload(upload) -> tuple:
+    """Streams an upload to a temporary file in MEDIA_ROOT, hashing it on the way. Returns (path, content hash)."""
+    digest = dataset_registry.content_hasher()
+    with tempfile.NamedTemporaryFile('wb', dir=settings.MEDIA_ROOT, prefix='.upload-', delete=False) as f:
+        for chunk in upload.chunks():
+            f.write(chunk)
+            digest.update(chunk)
+    return f.name, digest.hexdigest()
+
+def processed_upload(db_name: str, content_hash: str, vector_storage: str = None, chunking: str = None) -> dict:
+    """
+    The results of an earlier upload of the same content to db_name, embedded with the
+    requested vector storage and chunking, as the pipeline reports them. None when there
+    is none, its outputs are gone or its index no longer holds that upload: index files are
+    named after the file alone, so another upload of the same name may have replaced them.
+    """
+    dataset = dataset_registry.find_by_hash(db_name, content_hash)
+    if dataset is None or dataset['valid'] is None:
+        return None
+    from .agents.index_cache import index_paths
+    from .agents.row_store import RowStore
+    from .agents.chunker import parse_chunking
+
+    clean_path = os.path.abspath(os.path.join('clean_data', dataset['clean_file']))
+    vector_db_path, rows_path = index_paths(dataset['clean_file'])
+    if not all(os.path.exists(path) for path in (clean_path, vector_db_path, rows_path, dataset['report_path'])):
+        return None
+    meta = RowStore(rows_path).meta
+    index_params = meta.get('index', {})
+    written_at = datetime.fromtimestamp(os.path.getmtime(vector_db_path)).isoformat(timespec='milliseconds')
+    if meta.get('db_name') != db_name or index_params.get('ntotal') != dataset['vectors'] or written_at > dataset['embedded_at']:
+        logger.info(f"Index of {dataset['clean_file']} was rebuilt since {dataset['filename']} was processed in {db_name}")
+        return None
+    if vector_storage and index_params.get('storage') != vector_storage:
+        return None
+    try:
+        if parse_chunking(chunking, meta.get('columns', []), meta.get('primary_key')) != meta.get('chunking'):
+            return None
+    except ValueError:
+        # An invalid chunking spec is reported by the pipeline
+        return None
+    return {
+        'message': 'Identical upload already processed, returning the existing results',
+        'category': dataset['category'],
+        'valid': bool(dataset['valid']),
+        'transformation_result': clean_path,
+        'vector_db_path': vector_db_path,
+        'report_path': dataset['report_path'],
+        'deduplicated': True,
+        'dataset': dataset,
+    }
+
+def run_upload_pipeline(filepath: str, filename: str, db_name: str, vector_storage: str, chunking: str, logs: list) -> tuple:
+    """Ingests, transforms, reports on and embeds a saved upload. Returns (body, status)."""
+    # The agents and their dependencies (langchain, pandas, faiss, the embedding model)
+    # are imported on first use, so the server and manage.py start without them
+    import pandas as pd
+    from .agents.data_ingestion import ingest_file
+    from .agents.transformation_agent import transform_file
+    from .agents.report_agent import run_report_agent
+    from .agents.rag_agent import run_rag_agent
+
+    logger.info("Starting data ingestion")
+    logs.append("Starting data ingestion")
+    ingestion_result = ingest_file(filepath, filename, db_name)
+    logger.debug(f"Ingestion result: {ingestion_result}")
+    logs.append(f"Ingestion result: {ingestion_result}")
+    if "error" in ingestion_result:
+        logs.append(f"Ingestion error: {ingestion_result['error']}")
+        return {'error': ingestion_result["error"], 'logs': logs}, 500
+
+    category = ingestion_result["category"]
+    valid = ingestion_result["valid"]
+
+    organized_path = os.path.join("organized_data", category, filename)
+    if not os.path.exists(organized_path):
+        logger.error(f"File not found at {organized_path} after ingestion")
+        logs.append(f"Error: File not found at {organized_path} after ingestion")
+        return {'error': f'File not found at {organized_path} after ingestion', 'logs': logs}, 500
+
+    logger.info("Starting transformation")
+    logs.append("Starting transformation")
+    transformation_result = transform_file(filename, category, db_name)
+    logger.debug(f"Transformation result: {transformation_result}")
+    logs.append(f"Transformation result: {transformation_result}")
+    if not transformation_result:
+        logs.append("Transformation error: No output file generated")
+        return {'error': 'Transformation failed: No output file generated', 'logs': logs}, 500
+
+    clean_path = transformation_result
+    if not clean_path or not os.path.exists(clean_path):
+        logger.error(f"Transformed file not found at {clean_path}")
+        logs.append(f"Error: Transformed file not found at {clean_path}")
+        return {'error': f'Transformed file not found at {clean_path}', 'logs': logs}, 500
+
+    try:
+        transformed_df = pd.read_csv(clean_path)
+        if transformed_df.empty or transformed_df.columns.empty:
+            logger.error(f"Transformed file {clean_path} is invalid: Empty or missing headers")
+            logs.append(f"Error: Transformed file {clean_path} is invalid: Empty or missing headers")
+            return {'error': f'Transformed file {clean_path} is invalid', 'logs': logs}, 500
+        with open(clean_path, 'r', encoding='utf-8') as f:
+            # Only the start of the file is logged
+            csv_data = f.read(1000)
+            logger.debug(f"Transformed file content at {clean_path}:\n{csv_data}")
+            logs.append(f"Transformed file content at {clean_path}:\n{csv_data}")
+    except pd.errors.ParserError:
+        logger.error(f"Transformed file {clean_path} has invalid CSV format")
+        logs.append(f"Error: Transformed file {clean_path} has invalid CSV format")
+        return {'error': f'Transformed file {clean_path} has invalid CSV format', 'logs': logs}, 500
+
+    logger.info("Starting report generation")
+    logs.append("Starting report generation")
+    try:
+        report_result = run_report_agent(os.path.basename(clean_path), category, db_name)
+        if report_result is None or not os.path.exists(report_result):
+            logger.error(f"Report generation failed for {clean_path}")
+            logs.append(f"Error: Report generation failed for {clean_path}")
+            return {'error': f'Report generation failed for {clean_path}', 'logs': logs}, 500
+        logger.debug(f"Report generated: {report_result}")
+        logs.append(f"Report generated: {report_result}")
+    except Exception as e:
+        logger.error(f"Report generation error: {str(e)}")
+        logs.append(f"Report generation error: {str(e)}")
+        return {'error': f'Report generation failed: {str(e)}', 'logs': logs}, 500
+
+    logger.info("Starting RAG embedding creation")
+    logs.append("Starting RAG embedding creation")
+    rag_result = run_rag_agent(
+        os.path.basename(clean_path), csv_data, ingestion_result.get("primary_key"), vector_storage,
+        category, db_name, chunking
+    )
+    logger.debug(f"RAG embedding result: {rag_result}")
+    logs.append(f"RAG embedding result: {rag_result}")
+    # Handle error string from run_rag_agent
+    if isinstance(rag_result, str) and rag_result.startswith("Error:"):
+        logger.error(f"RAG embedding failed: {rag_result}")
+        logs.append(f"RAG embedding failed: {rag_result}")
+        return {'error': rag_result, 'logs': logs}, 500
+
+    vector_db_path = rag_result  # rag_result is a string (path to FAISS index)
+    if not vector_db_path or not os.path.exists(vector_db_path):
+        logger.error(f"Vector DB not found at {vector_db_path}")
+        logs.append(f"Error: Vector DB not found at {vector_db_path}")
+        return {'error': f'Vector DB not found at {vector_db_path}', 'logs': logs}, 500
+
+    return {
+        'message': 'Upload + Ingestion + Transformation + Report + RAG Embedding Complete',
+        'category': category,
+        'valid': valid,
+        'transformation_result': clean_path,
+        'vector_db_path': vector_db_path,
+        'report_path': report_result,
+        'logs': logs
+    }, 200
+
 @csrf_exempt
 def upload_and_analyze(request):
     if request.method == 'POST' and request.FILES.get('file'):
         filename = request.FILES['file'].name
         db_name = request.POST.get('db_name')
+        vector_storage = request.POST.get('vector_storage')
+        chunking = request.POST.get('chunking')
         filepath = os.path.join(settings.MEDIA_ROOT, filename)
+        # Reprocess even when the same content was already processed for this database
+        force = request.POST.get('force', '').lower() in ('1', 'true')
         logs = []
 
         os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
@@ -310,113 +562,60 @@ def upload_and_analyze(request):
             return JsonResponse({'error': 'Missing db_name', 'logs': logs}, status=400)
 
         try:
-            logger.info(f"Saving file to: {filepath}")
-            logs.append(f"Saving file to: {filepath}")
-            with open(filepath, 'wb+') as f:
-                for chunk in request.FILES['file'].chunks():
-                    f.write(chunk)
-
-            if not os.path.exists(filepath):
-                logger.error(f"File {filepath} was not created")
-                logs.append(f"Error: File {filepath} was not created")
-                return JsonResponse({'error': f'File {filepath} was not created', 'logs': logs}, status=500)
-
-            logger.info("Starting data ingestion")
-            logs.append("Starting data ingestion")
-            ingestion_result = ingest_file(filepath, filename, db_name)
-            logger.debug(f"Ingestion result: {ingestion_result}")
-            logs.append(f"Ingestion result: {ingestion_result}")
-            if "error" in ingestion_result:
-                logs.append(f"Ingestion error: {ingestion_result['error']}")
-                return JsonResponse({'error': ingestion_result["error"], 'logs': logs}, status=500)
-
-            category = ingestion_result["category"]
-            valid = ingestion_result["valid"]
-
-            organized_path = os.path.join("organized_data", category, filename)
-            if not os.path.exists(organized_path):
-                logger.error(f"File not found at {organized_path} after ingestion")
-                logs.append(f"Error: File not found at {organized_path} after ingestion")
-                return JsonResponse({'error': f'File not found at {organized_path} after ingestion', 'logs': logs}, status=500)
-
-            logger.info("Starting transformation")
-            logs.append("Starting transformation")
-            transformation_result = transform_file(filename, category, db_name)
-            logger.debug(f"Transformation result: {transformation_result}")
-            logs.append(f"Transformation result: {transformation_result}")
-            if not transformation_result:
-                logs.append("Transformation error: No output file generated")
-                return JsonResponse({'error': 'Transformation failed: No output file generated', 'logs': logs}, status=500)
-
-            clean_path = transformation_result
-            if not clean_path or not os.path.exists(clean_path):
-                logger.error(f"Transformed file not found at {clean_path}")
-                logs.append(f"Error: Transformed file not found at {clean_path}")
-                return JsonResponse({'error': f'Transformed file not found at {clean_path}', 'logs': logs}, status=500)
-
-            try:
-                transformed_df = pd.read_csv(clean_path)
-                if transformed_df.empty or transformed_df.columns.empty:
-                    logger.error(f"Transformed file {clean_path} is invalid: Empty or missing headers")
-                    logs.append(f"Error: Transformed file {clean_path} is invalid: Empty or missing headers")
-                    return JsonResponse({'error': f'Transformed file {clean_path} is invalid', 'logs': logs}, status=500)
-                with open(clean_path, 'r', encoding='utf-8') as f:
-                    csv_data = f.read()
-                    logger.debug(f"Transformed file content at {clean_path}:\n{csv_data[:1000]}")
-                    logs.append(f"Transformed file content at {clean_path}:\n{csv_data[:1000]}")
-                import time
-                time.sleep(0.1)
-            except pd.errors.ParserError:
-                logger.error(f"Transformed file {clean_path} has invalid CSV format")
-                logs.append(f"Error: Transformed file {clean_path} has invalid CSV format")
-                return JsonResponse({'error': f'Transformed file {clean_path} has invalid CSV format', 'logs': logs}, status=500)
-
-            logger.info("Starting report generation")
-            logs.append("Starting report generation")
+            job = admit_job(filename, profiling_requested(request) or job_profiling_enabled(filename))
+        except WorkerBusy as e:
+            logger.warning(str(e))
+            response = JsonResponse({'error': str(e), 'logs': logs}, status=503)
+            response['Retry-After'] = '30'
+            return response
+        with job, start_trace("upload") as trace, profile_session(filename, trace, job.profiled) as profiler:
+            def respond(body: dict, status: int = 200):
+                # Every pipeline response carries the per-stage trace
+                body['trace'] = trace.to_dict()
+                if profiler is not None:
+                    body['profile_dir'] = profiler.directory
+                return JsonResponse(body, status=status)
+
+            upload_path = None
             try:
-                report_result = run_report_agent(os.path.basename(clean_path), category, db_name)
-                if report_result is None or not os.path.exists(report_result):
-                    logger.error(f"Report generation failed for {clean_path}")
-                    logs.append(f"Error: Report generation failed for {clean_path}")
-                    return JsonResponse({'error': f'Report generation failed for {clean_path}', 'logs': logs}, status=500)
-                logger.debug(f"Report generated: {report_result}")
-                logs.append(f"Report generated: {report_result}")
-            except Exception as e:
-                logger.error(f"Report generation error: {str(e)}")
-                logs.append(f"Report generation error: {str(e)}")
-                return JsonResponse({'error': f'Report generation failed: {str(e)}', 'logs': logs}, status=500)
-
-            logger.info("Starting RAG embedding creation")
-            logs.append("Starting RAG embedding creation")
-            rag_result = run_rag_agent(os.path.basename(clean_path), csv_data)
-            logger.debug(f"RAG embedding result: {rag_result}")
-            logs.append(f"RAG embedding result: {rag_result}")
-            # Handle error string from run_rag_agent
-            if isinstance(rag_result, str) and rag_result.startswith("Error:"):
-                logger.error(f"RAG embedding failed: {rag_result}")
-                logs.append(f"RAG embedding failed: {rag_result}")
-                return JsonResponse({'error': rag_result, 'logs': logs}, status=500)
-
-            vector_db_path = rag_result  # rag_result is a string (path to FAISS index)
-            if not vector_db_path or not os.path.exists(vector_db_path):
-                logger.error(f"Vector DB not found at {vector_db_path}")
-                logs.append(f"Error: Vector DB not found at {vector_db_path}")
-                return JsonResponse({'error': f'Vector DB not found at {vector_db_path}', 'logs': logs}, status=500)
+                logger.info(f"Saving file to: {filepath}")
+                logs.append(f"Saving file to: {filepath}")
+                with span("save_upload", bytes=request.FILES['file'].size) as save_span:
+                    upload_path, content_hash = save_upload(request.FILES['file'])
+                    save_span.set(content_hash=content_hash)
+                logs.append(f"Content hash: {content_hash}")
+
+                if not force:
+                    existing = processed_upload(db_name, content_hash, vector_storage, chunking)
+                    if existing is not None:
+                        logger.info(f"{filename} matches already processed dataset {existing['dataset']['filename']} in {db_name}")
+                        logs.append(f"Same content as {existing['dataset']['filename']}, skipping the pipeline")
+                        return respond(dict(existing, logs=logs))
+
+                def run():
+                    os.replace(upload_path, filepath)
+                    if not os.path.exists(filepath):
+                        logger.error(f"File {filepath} was not created")
+                        logs.append(f"Error: File {filepath} was not created")
+                        return {'error': f'File {filepath} was not created', 'logs': logs}, 500
+                    return run_upload_pipeline(filepath, filename, db_name, vector_storage, chunking, logs)
+
+                # Only uploads that would build the same index share a run
+                flight_key = (db_name, content_hash, vector_storage or '', chunking or '')
+                (body, status), shared = upload_flights.do(flight_key, run)
+                if shared:
+                    logs.append("Joined an identical upload already in progress")
+                    body = dict(body, logs=logs + body.get('logs', []), coalesced=True)
+                return respond(dict(body), status)
 
-            return JsonResponse({
-                'message': 'Upload + Ingestion + Transformation + Report + RAG Embedding Complete',
-                'category': category,
-                'valid': valid,
-                'transformation_result': clean_path,
-                'vector_db_path': vector_db_path,
-                'report_path': report_result,
-                'logs': logs
-            })
-
-        except Exception as e:
-            logger.error(f"Pipeline error: {str(e)}")
-            logs.append(f"Pipeline error: {str(e)}")
-            return JsonResponse({'error': str(e), 'logs': logs}, status=500)
+            except Exception as e:
+                logger.error(f"Pipeline error: {str(e)}")
+                logs.append(f"Pipeline error: {str(e)}")
+                return respond({'error': str(e), 'logs': logs}, 500)
+            finally:
+                # Left behind when the upload was deduplicated, coalesced or failed early
+                if upload_path and os.path.exists(upload_path):
+                    os.remove(upload_path)
 
     return JsonResponse({'error': 'No file uploaded', 'logs': logs if 'logs' in locals() else []}, status=400)
 
@@ -425,16 +624,44 @@ def query_rag(request):
     if request.method == 'POST':
         query = request.POST.get('query')
         filename = request.POST.get('filename')
+        category = request.POST.get('category')
+        db_name = request.POST.get('db_name')
         logs = []
 
-        logger.debug(f"Received query: '{query}', filename: '{filename}'")
+        logger.debug(f"Received query: '{query}', filename: '{filename}', category: '{category}', db_name: '{db_name}'")
 
-        if not query or not filename:
+        if not query or not (filename or category or db_name):
             logger.error("Missing query or filename in RAG query request")
             logs.append("Error: Missing query or filename")
             return JsonResponse({'error': 'Missing query or filename', 'logs': logs}, status=400)
 
+        from .agents.query_agent import process_query, process_shard_query, stream_query
+        if filename and (request.POST.get('stream') == '1' or 'text/event-stream' in request.headers.get('Accept', '')):
+            # Tokens are sent as they are generated, then timings as a trailing metadata event
+            logger.info(f"Streaming RAG query: {query} for {filename}")
+            events = (sse_event(event, data) for event, data in stream_query(query, filename))
+            response = StreamingHttpResponse(events, content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            response['X-Accel-Buffering'] = 'no'
+            return response
+
         try:
+            if not filename:
+                # Search every index of the category and/or database as shards
+                logger.info(f"Processing sharded RAG query: {query} for category={category}, db_name={db_name}")
+                logs.append(f"Processing sharded RAG query: {query} for category={category}, db_name={db_name}")
+                response, sources = process_shard_query(query, category, db_name)
+                logs.append(f"Query response: {response}")
+                if response.startswith("Error:"):
+                    logs.append(f"Query error: {response}")
+                    return JsonResponse({'error': response, 'logs': logs}, status=500)
+                return JsonResponse({
+                    'message': 'Query processed successfully',
+                    'response': response,
+                    'sources': sources,
+                    'logs': logs
+                })
+
             logger.info(f"Processing RAG query: {query} for {filename}")
             logs.append(f"Processing RAG query: {query} for {filename}")
             response = process_query(query, filename)
@@ -457,15 +684,100 @@ def query_rag(request):
 
     return JsonResponse({'error': 'Invalid request method', 'logs': []}, status=400)
 
+@csrf_exempt
+def query_batch(request):
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+            default_filename = data.get('filename')
+            items = []
+            for entry in data.get('queries') or []:
+                if isinstance(entry, str):
+                    entry = {'query': entry}
+                query = entry.get('query') if isinstance(entry, dict) else None
+                filename = (entry.get('filename') if isinstance(entry, dict) else None) or default_filename
+                if not query or not filename:
+                    logger.error("Missing query or filename in batch query request")
+                    return JsonResponse({'error': 'Each query needs a query and a filename'}, status=400)
+                items.append({'query': query, 'filename': filename})
+            if not items:
+                logger.error("Missing queries in batch query request")
+                return JsonResponse({'error': 'Missing queries'}, status=400)
+            if len(items) > QUERY_BATCH_MAX:
+                return JsonResponse({'error': f'At most {QUERY_BATCH_MAX} queries per batch'}, status=400)
+
+            logger.info(f"Processing batch of {len(items)} RAG queries")
+            from .agents.query_agent import process_batch
+            results = process_batch(items)
+            errors = sum(1 for result in results if 'error' in result)
+            return JsonResponse({
+                'message': f'Processed {len(results)} queries with {errors} errors',
+                'results': results
+            }, status=200)
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'Invalid JSON body'}, status=400)
+        except Exception as e:
+            logger.error(f"Batch query error: {str(e)}")
+            return JsonResponse({'error': str(e)}, status=500)
+    return JsonResponse({'error': 'Invalid request method'}, status=400)
+
 @csrf_exempt
 def available_files(request):
+    """
+    Lists queryable datasets from the dataset registry, most recently updated first.
+    `files` keeps the plain list of distinct file names; `datasets` carries category,
+    database, sizes, index type and stage times. Filters: category, db_name and stale
+    (index older than its data). Paged when a limit is given, otherwise everything is
+    returned, as the chat page lists all files.
+    """
     if request.method == 'GET':
         try:
-            vector_db_dir = "vector_db"
-            files = [f for f in os.listdir(vector_db_dir) if f.endswith('_index.faiss')]
-            files = [f.replace('_index.faiss', '.csv') for f in files]
-            return JsonResponse({'files': files}, status=200)
+            params = request.GET
+            try:
+                limit = max(int(params['limit']), 1) if params.get('limit') else None
+                offset = max(int(params.get('offset', 0)), 0)
+            except ValueError as e:
+                logger.error(f"Invalid dataset query parameters: {str(e)}")
+                return JsonResponse({'error': f'Invalid parameter: {str(e)}'}, status=400)
+            stale = params.get('stale')
+            datasets, total = dataset_registry.list_datasets(
+                category=params.get('category') or None,
+                db_name=params.get('db_name') if 'db_name' in params else None,
+                embedded=True,
+                stale=stale in ('1', 'true') if stale else None,
+                offset=offset,
+                limit=limit,
+            )
+            next_offset = offset + len(datasets)
+            return JsonResponse({
+                # The same file can be listed for several databases (or backfilled without one)
+                'files': list(dict.fromkeys(dataset['clean_file'] for dataset in datasets if dataset['clean_file'])),
+                'datasets': datasets,
+                'total': total,
+                'next_offset': next_offset if next_offset < total else None,
+            }, status=200)
         except Exception as e:
             logger.error(f"Error fetching available files: {str(e)}")
             return JsonResponse({'error': str(e)}, status=500)
-    return JsonResponse({'error': 'Invalid request method'}, status=400)
\ No newline at end of file
+    return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+@csrf_exempt
+def cache_stats(request):
+    if request.method == 'GET':
+        from .agents.answer_cache import answer_cache
+        from .agents.index_cache import index_cache
+        from .agents.embedder import embedder_stats
+        return JsonResponse({
+            'answer_cache': answer_cache.stats(),
+            'index_cache': index_cache.stats(),
+            'metadata_cache': metadata_cache.stats(),
+            # Model load time and memory; the model itself is not loaded by this call
+            'embedder': embedder_stats(),
+        }, status=200)
+    return JsonResponse({'error': 'Invalid request method'}, status=400)
+
+def metrics_view(request):
+    """Prometheus text exposition of the pipeline stage histograms and counters of all worker processes."""
+    if request.method == 'GET':
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+    return JsonResponse({'error': 'Invalid request method'}, status=400)